@@ -1,13 +1,44 @@
-# Drop-in FastAPI include for health and ready endpoints
+# Drop-in FastAPI include for liveness and readiness endpoints
+import time
+from typing import Dict, Optional, Set
+
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
 
 router = APIRouter(tags=["health"])
 
-@router.get("/health")  # liveness
-async def health():
+class Warmup:
+    """Startup work running in the background; ready once it is over and the required steps succeeded."""
+
+    def __init__(self):
+        self.t0 = time.monotonic()
+        self.steps: Dict[str, str] = {}  # name -> pending | ok | error text
+        self.required: Set[str] = set()  # steps that must succeed; the others only warn
+        self.done_s: Optional[float] = None
+
+    def begin(self, name: str, required: bool = False) -> None:
+        self.steps[name] = "pending"
+        if required: self.required.add(name)
+
+    def end(self, name: str, error: Optional[BaseException] = None) -> None:
+        self.steps[name] = "ok" if error is None else f"failed: {error!r}"[:300]
+
+    def finish(self) -> None:
+        self.done_s = round(time.monotonic() - self.t0, 3)
+
+    @property
+    def ready(self) -> bool:
+        return self.done_s is not None and all(self.steps[n] == "ok" for n in self.required)
+
+warmup = Warmup()
+
+@router.get("/live")  # liveness: the process serves requests
+async def live():
     return {"status": "ok"}
 
-@router.get("/ready")   # readiness
+@router.get("/ready")  # readiness: warm-up (migrations, seed, pool) is over
 async def ready():
-    # optionally check db connection here
-    return {"status": "ready"}
+    status = "ready" if warmup.ready else ("warming" if warmup.done_s is None else "failed")
+    body = {"status": status, "steps": warmup.steps,
+            "uptime_s": round(time.monotonic() - warmup.t0, 3), "warmup_s": warmup.done_s}
+    return JSONResponse(body, status_code=200 if warmup.ready else 503)
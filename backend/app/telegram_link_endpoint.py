@@ -1,17 +1,94 @@
-# Example FastAPI endpoint for linking telegram chat to restaurant
+"""Telegram chat linking: one-time codes from the merchant cabinet, redeemed through the bot.
+
+The merchant asks for a code (``POST /link_code``) and sends ``/link CODE`` to the bot; the
+bot calls ``POST /link`` with the code and its chat id, which stores ``telegram_chat_id`` on
+the restaurant. The outbox then sends that restaurant's notifications to the chat (the id
+travels with every message), and the bot keeps a restaurant -> chat map it can load in one
+call from ``GET /chats``. Bot-only calls carry the shared ``x-foody-secret``.
+"""
+import os, json, secrets
+from typing import Dict
+
 from pydantic import BaseModel
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
+
+import db
+import outbox
+from db import acquire
+
+LINK_CODE_TTL_S = int(os.getenv("TELEGRAM_LINK_CODE_TTL_S", "900"))
+TELEGRAM_LINK_SECRET = os.getenv("TELEGRAM_LINK_SECRET") or outbox.BOT_NOTIFY_SECRET
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # no 0/O or 1/I to mistype
+CODE_LEN = 8
 
 router = APIRouter(prefix="/api/v1/telegram", tags=["telegram"])
 
+class CodeIn(BaseModel):
+    restaurant_id: str
+
 class LinkIn(BaseModel):
     code: str
     chat_id: int
 
-@router.post("/link")  # POST /api/v1/telegram/link
-async def link_chat(payload: LinkIn):
-    # 1) find restaurant by one-time code (issued in LK)
-    # 2) if found & valid -> save telegram_chat_id = payload.chat_id; invalidate code
-    # 3) else raise HTTPException(404)
-    # NOTE: integrate with your DB layer / ORM
-    raise HTTPException(status_code=501, detail="Implement persistence here")
+def _bot_only(secret: str) -> None:
+    if not TELEGRAM_LINK_SECRET or not secrets.compare_digest(secret, TELEGRAM_LINK_SECRET):
+        raise HTTPException(401, "bad secret")
+
+@router.post("/link_code")  # POST /api/v1/telegram/link_code (merchant)
+async def link_code(payload: CodeIn, x_foody_key: str = Header(default="")):
+    code = "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LEN))
+    async with acquire() as conn:
+        # key check, the restaurant's earlier codes dropped and the new one stored, in one statement
+        expires_at = await conn.fetchval(
+            """WITH me AS (SELECT id FROM foody_restaurants WHERE id=$1 AND api_key=$2),
+                    old AS (DELETE FROM foody_telegram_link_codes c USING me WHERE c.restaurant_id=me.id)
+               INSERT INTO foody_telegram_link_codes(code, restaurant_id, expires_at)
+               SELECT $3, id, NOW() + make_interval(secs => $4) FROM me RETURNING expires_at""",
+            payload.restaurant_id, x_foody_key, code, float(LINK_CODE_TTL_S))
+    if expires_at is None:
+        raise HTTPException(401, "Invalid API key or restaurant_id")
+    return {"code": code, "command": f"/link {code}", "expires_at": expires_at.isoformat()}
+
+@router.post("/link")  # POST /api/v1/telegram/link (bot)
+async def link_chat(payload: LinkIn, x_foody_secret: str = Header(default="")):
+    _bot_only(x_foody_secret)
+    async with acquire() as conn:
+        # the code is consumed whether or not it is still valid
+        r = await conn.fetchrow(
+            """WITH c AS (DELETE FROM foody_telegram_link_codes WHERE code=$1 RETURNING restaurant_id, expires_at)
+               UPDATE foody_restaurants r SET telegram_chat_id=$2, telegram_linked_at=NOW()
+               FROM c WHERE r.id=c.restaurant_id AND c.expires_at > NOW()
+               RETURNING r.id, r.title""",
+            payload.code.strip().upper(), payload.chat_id)
+    if not r:
+        raise HTTPException(404, "Code not found or expired")
+    db.pin(r["id"])
+    return {"ok": True, "restaurant_id": r["id"], "title": r["title"], "chat_id": payload.chat_id}
+
+@router.delete("/link")  # DELETE /api/v1/telegram/link?restaurant_id= (merchant)
+async def unlink_chat(restaurant_id: str, x_foody_key: str = Header(default="")):
+    async with acquire() as conn:
+        async with conn.transaction():
+            old = await conn.fetchrow(
+                "SELECT telegram_chat_id FROM foody_restaurants WHERE id=$1 AND api_key=$2 FOR UPDATE",
+                restaurant_id, x_foody_key)
+            if not old:
+                raise HTTPException(401, "Invalid API key or restaurant_id")
+            if old["telegram_chat_id"] is None:
+                return {"ok": True, "unlinked": False}
+            await conn.execute("UPDATE foody_restaurants SET telegram_chat_id=NULL, telegram_linked_at=NULL WHERE id=$1",
+                               restaurant_id)
+            if outbox.ENABLED:
+                # tells the old chat, and the bot drops it from its map
+                await conn.execute(outbox.ENQUEUE_SQL, restaurant_id, "unlinked",
+                                   json.dumps({"chat_id": old["telegram_chat_id"]}))
+    db.pin(restaurant_id)
+    outbox.kick()
+    return {"ok": True, "unlinked": True}
+
+@router.get("/chats")  # GET /api/v1/telegram/chats (bot): the whole restaurant -> chat map
+async def linked_chats(x_foody_secret: str = Header(default="")) -> Dict[str, int]:
+    _bot_only(x_foody_secret)
+    async with acquire(read=True) as conn:
+        rows = await conn.fetch("SELECT id, telegram_chat_id FROM foody_restaurants WHERE telegram_chat_id IS NOT NULL")
+    return {r["id"]: r["telegram_chat_id"] for r in rows}
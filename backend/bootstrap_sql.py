@@ -1,4 +1,13 @@
-import os, asyncio, asyncpg
+"""Schema bootstrap, versioned migrations and the demo seed.
+
+The app runs these in the background at startup when RUN_MIGRATIONS / SEED_DEMO are set;
+deploy pipelines can run them ahead of time instead:
+
+    python bootstrap_sql.py migrate     # DDL + pending MIGRATIONS, then exit
+    python bootstrap_sql.py seed        # demo restaurant RID_TEST / KEY_TEST with three offers
+"""
+import os, re, sys, asyncio, secrets, datetime as dt, asyncpg
+from typing import List, Optional
 
 DDL_CREATE = [
     """CREATE TABLE IF NOT EXISTS foody_restaurants (
@@ -34,11 +43,24 @@ DDL_CREATE = [
         status TEXT NOT NULL DEFAULT 'reserved',
         created_at TIMESTAMPTZ DEFAULT NOW(),
         redeemed_at TIMESTAMPTZ
+    )""",
+    """CREATE TABLE IF NOT EXISTS foody_kpi_daily (
+        restaurant_id TEXT NOT NULL REFERENCES foody_restaurants(id) ON DELETE CASCADE,
+        day DATE NOT NULL,
+        reserved INTEGER NOT NULL DEFAULT 0,
+        redeemed INTEGER NOT NULL DEFAULT 0,
+        canceled INTEGER NOT NULL DEFAULT 0,
+        revenue_cents BIGINT NOT NULL DEFAULT 0,
+        saved_cents BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (restaurant_id, day)
     )"""
 ]
 
 DDL_ALTER = [
     "ALTER TABLE IF EXISTS foody_reservations ADD COLUMN IF NOT EXISTS qty INT NOT NULL DEFAULT 1",
+    "ALTER TABLE IF EXISTS foody_reservations ADD COLUMN IF NOT EXISTS unit_price_cents INTEGER",
+    "ALTER TABLE IF EXISTS foody_reservations ADD COLUMN IF NOT EXISTS unit_original_cents INTEGER",
+    "ALTER TABLE IF EXISTS foody_reservations ADD COLUMN IF NOT EXISTS canceled_at TIMESTAMPTZ",
     "ALTER TABLE IF EXISTS foody_restaurants ADD COLUMN IF NOT EXISTS phone TEXT",
     "ALTER TABLE IF EXISTS foody_restaurants ADD COLUMN IF NOT EXISTS city TEXT",
     "ALTER TABLE IF EXISTS foody_restaurants ADD COLUMN IF NOT EXISTS address TEXT",
@@ -54,17 +76,168 @@ DDL_ALTER = [
     "ALTER TABLE IF EXISTS foody_offers ADD COLUMN IF NOT EXISTS photo_url TEXT"
 ]
 
-async def run():
+# Versioned migrations, applied once each in order and recorded in foody_schema_version.
+# DDL_CREATE/DDL_ALTER above stay idempotent and run on every boot; anything that should run
+# once (indexes, backfills) goes here as a new version -- never edit an applied one.
+# A migration whose statements use CONCURRENTLY runs them one by one outside a transaction
+# (so index builds don't block writes); any other migration runs in a single transaction.
+MIGRATIONS = [
+    (1, "feed and lookup indexes", [
+        # bounding-box prefilter for geo queries on the public feed
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_restaurants_lat_lon_idx ON foody_restaurants(lat, lon) WHERE lat IS NOT NULL AND lon IS NOT NULL",
+        # join path from restaurants found by bbox to their offers; merchant offer list
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_restaurant_created_idx ON foody_offers(restaurant_id, created_at DESC)",
+        # keyset pagination of the public feed, one index per sort, active rows only
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_feed_expiry_idx ON foody_offers((COALESCE(expires_at, 'infinity'::timestamptz)), id) WHERE archived_at IS NULL",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_feed_price_idx ON foody_offers(price_cents, id) WHERE archived_at IS NULL",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_feed_new_idx ON foody_offers((COALESCE(created_at, '-infinity'::timestamptz)) DESC, id DESC) WHERE archived_at IS NULL",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_restaurants_city_idx ON foody_restaurants(lower(city))",
+        # merchant auth looks restaurants up by key on every call (not unique: keys were never
+        # enforced unique, and a duplicate would fail this migration on every boot)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_restaurants_api_key_idx ON foody_restaurants(api_key)",
+    ]),
+    (2, "kpi rollup backfill", [
+        # seed the KPI rollup from raw reservations (only while it is still empty)
+        """INSERT INTO foody_kpi_daily (restaurant_id, day, reserved, redeemed, canceled, revenue_cents, saved_cents)
+           SELECT o.restaurant_id, (r.created_at AT TIME ZONE 'UTC')::date,
+                  COUNT(*),
+                  COUNT(*) FILTER (WHERE r.status='redeemed'),
+                  COUNT(*) FILTER (WHERE r.status='canceled'),
+                  COALESCE(SUM(r.qty * COALESCE(r.unit_price_cents, o.price_cents)) FILTER (WHERE r.status='redeemed'), 0),
+                  COALESCE(SUM(r.qty * GREATEST(COALESCE(r.unit_original_cents, NULLIF(o.original_price_cents, 0), o.price_cents)
+                                                - COALESCE(r.unit_price_cents, o.price_cents), 0)) FILTER (WHERE r.status='redeemed'), 0)
+           FROM foody_reservations r JOIN foody_offers o ON o.id=r.offer_id
+           WHERE r.created_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM foody_kpi_daily)
+           GROUP BY 1, 2
+           ON CONFLICT (restaurant_id, day) DO NOTHING""",
+    ]),
+    (3, "sweeper, merchant and recovery indexes", [
+        # sweeper: unarchived offers by expiry (tiny once it runs), reservations by offer and status
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_unarchived_expiry_idx ON foody_offers(expires_at) WHERE archived_at IS NULL",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_reservations_offer_status_idx ON foody_reservations(offer_id, status)",
+        # merchant ?status=active
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_offers_active_restaurant_idx ON foody_offers(restaurant_id, created_at DESC) WHERE archived_at IS NULL",
+        # merchant recovery by phone (latest restaurant first)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_restaurants_phone_idx ON foody_restaurants(phone, created_at DESC) WHERE phone IS NOT NULL",
+    ]),
+    (4, "merchant notification outbox", [
+        """CREATE TABLE IF NOT EXISTS foody_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            restaurant_id TEXT REFERENCES foody_restaurants(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMPTZ
+        )""",
+        # dispatcher claims due rows; everything else is history for the sweeper to purge
+        "CREATE INDEX IF NOT EXISTS foody_outbox_due_idx ON foody_outbox(next_attempt_at, id) WHERE status='pending'",
+        "CREATE INDEX IF NOT EXISTS foody_outbox_done_idx ON foody_outbox(created_at) WHERE status<>'pending'",
+    ]),
+    (5, "offer photo variants", [
+        # {"320": url, "640": url} WebP thumbnails and a BlurHash placeholder, filled in by images.py
+        "ALTER TABLE foody_offers ADD COLUMN IF NOT EXISTS photo_variants JSONB",
+        "ALTER TABLE foody_offers ADD COLUMN IF NOT EXISTS photo_blurhash TEXT",
+    ]),
+    (6, "reservation idempotency keys", [
+        # written in the reservation statement itself; a repeated key conflicts on the primary key
+        """CREATE TABLE IF NOT EXISTS foody_idempotency (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            response JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )""",
+        "CREATE INDEX IF NOT EXISTS foody_idempotency_created_idx ON foody_idempotency(created_at)",
+    ]),
+    (7, "telegram chat linking", [
+        "ALTER TABLE foody_restaurants ADD COLUMN IF NOT EXISTS telegram_chat_id BIGINT",
+        "ALTER TABLE foody_restaurants ADD COLUMN IF NOT EXISTS telegram_linked_at TIMESTAMPTZ",
+        # one-time codes shown in the merchant cabinet and sent to the bot as /link CODE
+        """CREATE TABLE IF NOT EXISTS foody_telegram_link_codes (
+            code TEXT PRIMARY KEY,
+            restaurant_id TEXT NOT NULL REFERENCES foody_restaurants(id) ON DELETE CASCADE,
+            expires_at TIMESTAMPTZ NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )""",
+        "CREATE INDEX IF NOT EXISTS foody_telegram_link_codes_restaurant_idx ON foody_telegram_link_codes(restaurant_id)",
+    ]),
+    (8, "open reservations index", [
+        # sweeper: only open reservations, so a pass costs what is open now, not the whole history
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_reservations_reserved_offer_idx ON foody_reservations(offer_id) WHERE status='reserved'",
+    ]),
+    (9, "drop list price feed index", [
+        # sort=price orders by the timer-discounted price, which depends on NOW() and has no index
+        "DROP INDEX CONCURRENTLY IF EXISTS foody_offers_feed_price_idx",
+    ]),
+    (10, "non-unique api key index", [
+        # where migration 1 built the earlier unique key index, swap it for the plain one
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS foody_restaurants_api_key_idx ON foody_restaurants(api_key)",
+        "DROP INDEX CONCURRENTLY IF EXISTS foody_restaurants_api_key_uidx",
+    ]),
+]
+
+DDL_SCHEMA_VERSION = """CREATE TABLE IF NOT EXISTS foody_schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+)"""
+MIGRATION_LOCK_ID = 0x666F6F6479  # pg_advisory_lock key, one migrator at a time across replicas
+
+def _index_name(sql: str) -> Optional[str]:
+    m = re.search(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", sql, re.I)
+    return m.group(1) if m else None
+
+async def _apply(conn: asyncpg.Connection, version: int, name: str, statements: List[str]) -> None:
+    if any("CONCURRENTLY" in sql.upper() for sql in statements):
+        for sql in statements:
+            idx = _index_name(sql)
+            # a failed concurrent build leaves an INVALID index that IF NOT EXISTS would skip forever
+            if idx and await conn.fetchval(
+                    "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid=i.indexrelid WHERE c.relname=$1 AND NOT i.indisvalid", idx):
+                print("BOOTSTRAP: dropping invalid index", idx)
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {idx}")
+            await conn.execute(sql)
+        await conn.execute("INSERT INTO foody_schema_version(version, name) VALUES($1, $2)", version, name)
+        return
+    async with conn.transaction():
+        for sql in statements:
+            await conn.execute(sql)
+        await conn.execute("INSERT INTO foody_schema_version(version, name) VALUES($1, $2)", version, name)
+
+async def migrate(conn: asyncpg.Connection) -> List[int]:
+    """Apply pending MIGRATIONS in order; returns the versions applied. Raises at the first failure
+    (the migrations before it stay applied)."""
+    await conn.execute(DDL_SCHEMA_VERSION)
+    done = {r["version"] for r in await conn.fetch("SELECT version FROM foody_schema_version")}
+    applied: List[int] = []
+    for version, name, statements in MIGRATIONS:
+        if version in done:
+            continue
+        try:
+            await _apply(conn, version, name, statements)
+        except Exception as e:
+            print(f"BOOTSTRAP MIGRATION {version} ({name}) FAILED:", repr(e))
+            raise RuntimeError(f"migration {version} ({name}) failed: {e!r}") from e
+        print(f"BOOTSTRAP: applied migration {version} ({name})")
+        applied.append(version)
+    return applied
+
+async def run() -> List[int]:
+    """Create/alter the base tables and apply pending migrations; returns the versions applied."""
     url = os.getenv("DATABASE_URL")
     if not url:
         print("BOOTSTRAP: DATABASE_URL not set, skip migrations")
-        return
-    try:
-        conn = await asyncpg.connect(url)
-    except Exception as e:
-        print("BOOTSTRAP: Cannot connect to DB:", repr(e))
-        return
+        return []
+    conn = await asyncpg.connect(url)
     try:
+        # session lock: replicas booting together wait here instead of racing the DDL. Poll with
+        # try-lock: a backend blocked in pg_advisory_lock() holds a snapshot, which CREATE INDEX
+        # CONCURRENTLY in the lock holder would wait on (deadlock).
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+            await asyncio.sleep(0.5)
         for sql in DDL_CREATE:
             try:
                 await conn.execute(sql)
@@ -75,17 +248,65 @@ async def run():
                 await conn.execute(sql)
             except Exception as e:
                 print("BOOTSTRAP ALTER WARN:", sql, "->", repr(e))
+        return await migrate(conn)
     finally:
         try:
             await conn.close()
         except Exception:
             pass
 
-async def ensure():
-    if os.getenv("RUN_MIGRATIONS", "0").lower() not in ("1","true","yes","on"):
-        print("BOOTSTRAP: RUN_MIGRATIONS disabled")
-        return
+def env_flag(name: str) -> bool:
+    return os.getenv(name, "0").lower() in ("1","true","yes","on")
+
+# ---- Demo seed ----
+TEST_RID = "RID_TEST"
+TEST_KEY = "KEY_TEST"
+SEED_DEMO = env_flag("SEED_DEMO")
+
+async def seed(conn: asyncpg.Connection) -> bool:
+    """Create the demo restaurant and its offers unless it exists; True if it was created."""
+    created = await conn.fetchval(
+        """INSERT INTO foody_restaurants(id, api_key, title, phone, city, address, geo, lat, lon)
+           VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9) ON CONFLICT (id) DO NOTHING RETURNING id""",
+        TEST_RID, TEST_KEY, "Пекарня №1", "+7 900 000-00-00", "Москва", "ул. Пекарная, 10", "55.7558,37.6173", 55.7558, 37.6173
+    )
+    if not created:
+        return False
+    now = dt.datetime.now(dt.timezone.utc)
+    def exp(minutes): return now + dt.timedelta(minutes=minutes)
+    demo = [
+        ("Эклеры", "Набор свежих эклеров", 19900, 34900, 5, 5, exp(110), None),
+        ("Пирожки", "Пирожки с мясом", 14900, 29900, 8, 8, exp(55), None),
+        ("Круассаны", "Круассаны с маслом", 9900, 32900, 6, 6, exp(25), None),
+    ]
+    await conn.executemany(
+        """INSERT INTO foody_offers(id, restaurant_id, title, description, price_cents, original_price_cents,
+                                    qty_left, qty_total, expires_at, photo_url)
+           VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)""",
+        [("OFF_" + secrets.token_hex(6), TEST_RID) + row for row in demo])
+    return True
+
+async def _cli(cmd: str) -> int:
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        print("DATABASE_URL not set")
+        return 2
+    if cmd == "migrate":
+        try:
+            applied = await run()
+        except RuntimeError:
+            return 1
+        print("BOOTSTRAP: applied", applied if applied else "nothing, schema is up to date")
+        return 0
+    conn = await asyncpg.connect(url)
     try:
-        await run()
-    except Exception as e:
-        print("BOOTSTRAP ensure warn:", repr(e))
+        print("BOOTSTRAP: demo seed", "created" if await seed(conn) else "already present")
+    finally:
+        await conn.close()
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("migrate", "seed"):
+        print("usage: python bootstrap_sql.py migrate|seed")
+        sys.exit(2)
+    sys.exit(asyncio.run(_cli(sys.argv[1])))
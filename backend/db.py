@@ -0,0 +1,251 @@
+"""asyncpg pools configured from the environment, with acquire and query instrumentation.
+
+With ``DATABASE_READ_URL`` set, ``acquire(read=True)`` may hand out a connection to that
+replica instead. It falls back to the primary while the replica is down or lags more than
+``DB_READ_MAX_LAG_S`` (checked every ``DB_READ_CHECK_S`` by a background task), and for
+``DB_READ_PIN_S`` after ``pin(restaurant_id)`` so merchants read their own writes. Pins are
+per process: behind several workers, keep the pin window above the replica's usual lag.
+"""
+import os, time, asyncio, contextlib
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+import asyncpg
+from fastapi import HTTPException
+
+import metrics
+from cache import TTLCache
+
+DB_URL = os.getenv("DATABASE_URL")
+DB_READ_URL = os.getenv("DATABASE_READ_URL", "").strip() or None
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    v = os.getenv(name, "").strip()
+    return float(v) if v else default
+
+POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+ACQUIRE_TIMEOUT = _env_float("DB_ACQUIRE_TIMEOUT", 5.0)            # seconds before a waiting request gets 503
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # 0 behind pgbouncer in transaction mode
+MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", "50000"))             # recycle a connection after this many queries
+MAX_INACTIVE_LIFETIME = _env_float("DB_MAX_INACTIVE_LIFETIME", 300.0)
+COMMAND_TIMEOUT = _env_float("DB_COMMAND_TIMEOUT", None)
+READ_POOL_MAX = int(os.getenv("DB_READ_POOL_MAX", str(POOL_MAX)))
+READ_MAX_LAG_S = float(os.getenv("DB_READ_MAX_LAG_S", "5"))
+READ_CHECK_S = float(os.getenv("DB_READ_CHECK_S", "1"))
+READ_PIN_S = float(os.getenv("DB_READ_PIN_S", "10"))
+
+ACQUIRE_SECONDS = metrics.Histogram("foody_db_acquire_seconds", "Time spent waiting for a pooled connection")
+ACQUIRE_TIMEOUTS = metrics.Counter("foody_db_acquire_timeouts_total", "Acquires that exceeded DB_ACQUIRE_TIMEOUT (answered 503)")
+ACQUIRE_WAITING = metrics.Gauge("foody_db_acquire_waiting", "Requests currently waiting for a pooled connection")
+QUERY_SECONDS = metrics.Histogram("foody_db_query_seconds", "Query latency by asyncpg method", ["op"])
+metrics.Gauge("foody_db_pool_size", "Open connections in the pool", fn=lambda: _pool.get_size() if _pool else 0)
+metrics.Gauge("foody_db_pool_idle", "Idle connections in the pool", fn=lambda: _pool.get_idle_size() if _pool else 0)
+metrics.Gauge("foody_db_pool_max", "Configured DB_POOL_MAX", fn=lambda: POOL_MAX)
+READS = metrics.Counter("foody_db_reads_total", "Read-only acquires by where they went and why", ["route"])
+metrics.Gauge("foody_db_replica_lag_seconds", "Replica replay lag at the last check (-1: down or unknown)",
+              fn=lambda: -1 if _replica_lag is None else _replica_lag)
+
+TRACE_MAX_QUERIES = 50
+
+class QueryTrace:
+    """DB time of one request: pool wait, query time and the statements that ran."""
+    __slots__ = ("wait_s", "db_s", "queries")
+
+    def __init__(self):
+        self.wait_s = 0.0
+        self.db_s = 0.0
+        self.queries: List[Tuple[str, str, float]] = []
+
+_trace: ContextVar[Optional[QueryTrace]] = ContextVar("foody_query_trace", default=None)
+
+def start_trace() -> QueryTrace:
+    tr = QueryTrace()
+    _trace.set(tr)
+    return tr
+
+class TimedConnection(asyncpg.Connection):
+    """Connection that records the latency of every query it runs."""
+
+    def _observe(self, op: str, query: str, t0: float) -> None:
+        elapsed = time.perf_counter() - t0
+        QUERY_SECONDS.observe(elapsed, op=op)
+        tr = _trace.get()
+        if tr is not None:
+            tr.db_s += elapsed
+            if len(tr.queries) < TRACE_MAX_QUERIES:
+                tr.queries.append((op, " ".join(query.split())[:500], round(elapsed * 1000, 3)))
+
+    async def execute(self, query, *args, **kw):
+        t0 = time.perf_counter()
+        try: return await super().execute(query, *args, **kw)
+        finally: self._observe("execute", query, t0)
+
+    async def executemany(self, command, args, **kw):
+        t0 = time.perf_counter()
+        try: return await super().executemany(command, args, **kw)
+        finally: self._observe("executemany", command, t0)
+
+    async def fetch(self, query, *args, **kw):
+        t0 = time.perf_counter()
+        try: return await super().fetch(query, *args, **kw)
+        finally: self._observe("fetch", query, t0)
+
+    async def fetchrow(self, query, *args, **kw):
+        t0 = time.perf_counter()
+        try: return await super().fetchrow(query, *args, **kw)
+        finally: self._observe("fetchrow", query, t0)
+
+    async def fetchval(self, query, *args, **kw):
+        t0 = time.perf_counter()
+        try: return await super().fetchval(query, *args, **kw)
+        finally: self._observe("fetchval", query, t0)
+
+    async def copy_records_to_table(self, table_name, **kw):
+        t0 = time.perf_counter()
+        try: return await super().copy_records_to_table(table_name, **kw)
+        finally: self._observe("copy", f"COPY {table_name}", t0)
+
+_pool: Optional[asyncpg.pool.Pool] = None
+_pool_lock = asyncio.Lock()
+_read_pool: Optional[asyncpg.pool.Pool] = None
+_read_pool_lock = asyncio.Lock()
+
+def _create_pool(url: str, max_size: int):
+    return asyncpg.create_pool(
+        url, min_size=min(POOL_MIN, max_size), max_size=max_size, max_queries=MAX_QUERIES,
+        max_inactive_connection_lifetime=MAX_INACTIVE_LIFETIME,
+        statement_cache_size=STATEMENT_CACHE_SIZE, command_timeout=COMMAND_TIMEOUT,
+        connection_class=TimedConnection)
+
+async def pool() -> asyncpg.pool.Pool:
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                if not DB_URL:
+                    raise RuntimeError("DATABASE_URL not set")
+                _pool = await _create_pool(DB_URL, POOL_MAX)
+    return _pool
+
+async def read_pool() -> asyncpg.pool.Pool:
+    global _read_pool
+    if _read_pool is None:
+        async with _read_pool_lock:
+            if _read_pool is None:
+                _read_pool = await _create_pool(DB_READ_URL, READ_POOL_MAX)
+    return _read_pool
+
+async def _take(p: asyncpg.pool.Pool):
+    t0 = time.perf_counter()
+    ACQUIRE_WAITING.inc()
+    try:
+        return await p.acquire(timeout=ACQUIRE_TIMEOUT)
+    finally:
+        ACQUIRE_WAITING.dec()
+        waited = time.perf_counter() - t0
+        ACQUIRE_SECONDS.observe(waited)
+        tr = _trace.get()
+        if tr is not None: tr.wait_s += waited
+
+# ---- replica routing ----
+# 0 when the replica has replayed everything it received (an idle primary writes no new
+# transactions, so the last replay timestamp alone would look like growing lag)
+REPLICA_LAG_SQL = """SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                     ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0) END::float8"""
+
+_replica_lag: Optional[float] = None  # None until checked, and while the replica is unreachable
+_pins = TTLCache(int(os.getenv("DB_READ_PIN_SIZE", "10000")), READ_PIN_S)
+_watch_task: Optional[asyncio.Task] = None
+
+def pin(restaurant_id: Optional[str]) -> None:
+    """Send this restaurant's reads to the primary for DB_READ_PIN_S (call after its writes)."""
+    if DB_READ_URL and restaurant_id:
+        _pins.set(restaurant_id, True)
+
+def route(restaurant_id: Optional[str] = None) -> str:
+    """replica, or why a read goes to the primary: pinned | lagging | down."""
+    if restaurant_id and _pins.get(restaurant_id):
+        return "pinned"
+    if _replica_lag is None:
+        return "down"
+    return "lagging" if _replica_lag > READ_MAX_LAG_S else "replica"
+
+def replica_status() -> dict:
+    return {"configured": bool(DB_READ_URL), "lag_s": _replica_lag, "max_lag_s": READ_MAX_LAG_S, "pinned": len(_pins)}
+
+def _replica_down(e: BaseException) -> None:
+    global _replica_lag
+    if _replica_lag is not None:
+        print("DB replica down, reading from primary:", repr(e))
+    _replica_lag = None
+
+async def check_replica() -> Optional[float]:
+    global _replica_lag
+    async def lag() -> float:
+        async with (await read_pool()).acquire() as conn:
+            return float(await conn.fetchval(REPLICA_LAG_SQL))
+    try:
+        _replica_lag = await asyncio.wait_for(lag(), max(5.0, 2 * READ_CHECK_S))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        _replica_down(e)
+    return _replica_lag
+
+async def _watch_replica():
+    while True:
+        await check_replica()
+        await asyncio.sleep(READ_CHECK_S)
+
+def start() -> None:
+    global _watch_task
+    if DB_READ_URL and _watch_task is None:
+        _watch_task = asyncio.create_task(_watch_replica())
+
+async def stop() -> None:
+    """Stop the lag watcher and close both pools (called last at shutdown, after the workers)."""
+    global _watch_task, _read_pool, _pool
+    if _watch_task is not None:
+        _watch_task.cancel()
+        try: await _watch_task
+        except asyncio.CancelledError: pass
+        _watch_task = None
+    if _read_pool is not None:
+        await _read_pool.close()
+        _read_pool = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+@contextlib.asynccontextmanager
+async def acquire(read: bool = False, restaurant_id: Optional[str] = None):
+    """Pooled connection, or 503 once the wait exceeds DB_ACQUIRE_TIMEOUT.
+
+    ``read=True``: the caller only reads and tolerates replica staleness, so the connection
+    may come from the replica; ``restaurant_id`` honours that merchant's read-your-writes pin.
+    """
+    p = conn = None
+    if read and DB_READ_URL:
+        why = route(restaurant_id)
+        if why == "replica":
+            try:
+                p = await read_pool()
+                conn = await _take(p)
+            except asyncio.TimeoutError:
+                p, why = None, "busy"  # replica saturated: spill over to the primary
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                _replica_down(e)
+                p, why = None, "down"
+        READS.inc(route=why)
+    if p is None:
+        p = await pool()
+        try:
+            conn = await _take(p)
+        except asyncio.TimeoutError:
+            ACQUIRE_TIMEOUTS.inc()
+            raise HTTPException(503, "Database is busy, please retry", headers={"Retry-After": "1"})
+    try:
+        yield conn
+    finally:
+        await p.release(conn)
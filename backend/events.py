@@ -0,0 +1,144 @@
+"""Offer change events: Postgres LISTEN/NOTIFY fanned out to in-process subscribers.
+
+Writers call ``pg_notify(CHANNEL, json)`` in the same transaction as the change (see
+``OFFER_EVENT_SQL`` users in main), so events are delivered only after commit, to every
+backend process. Each process keeps one dedicated listening connection and hands events
+to its subscribers: SSE clients and plain callbacks (cross-worker cache invalidation).
+
+Slow clients never block the listener: a subscriber keeps only the latest event per offer,
+and once more than ``EVENTS_CLIENT_BUFFER`` offers are pending it is told to resync instead.
+"""
+import os, json, asyncio
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+import metrics
+
+CHANNEL = "foody_offers"
+EVENTS_CLIENT_BUFFER = int(os.getenv("EVENTS_CLIENT_BUFFER", "256"))
+EVENTS_MAX_CLIENTS = int(os.getenv("EVENTS_MAX_CLIENTS", "2000"))
+EVENTS_RECONNECT_S = 2.0
+
+EVENTS_RECEIVED = metrics.Counter("foody_events_received_total", "Offer change notifications received from Postgres")
+EVENTS_RESYNCS = metrics.Counter("foody_events_resyncs_total", "Subscribers that fell behind and were told to resync")
+metrics.Gauge("foody_events_clients", "Connected offer-stream subscribers", fn=lambda: len(_subscribers))
+
+Box = Tuple[float, float, float, float]  # min_lon, min_lat, max_lon, max_lat
+
+class Subscriber:
+    """One stream client: its filter and the events waiting to be sent, coalesced per offer."""
+
+    def __init__(self, city: Optional[str] = None, box: Optional[Box] = None):
+        self.city = city.lower() if city else None
+        self.box = box
+        self.pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.resync = False
+        self.wake = asyncio.Event()
+
+    def wants(self, ev: Dict[str, Any]) -> bool:
+        if self.city and ev.get("city") != self.city:
+            return False
+        if self.box:
+            lat, lon = ev.get("lat"), ev.get("lon")
+            if lat is None or lon is None: return False
+            if not (self.box[0] <= lon <= self.box[2] and self.box[1] <= lat <= self.box[3]): return False
+        return True
+
+    def push(self, ev: Dict[str, Any]) -> None:
+        if ev.get("op") == "resync":
+            self.pending.clear()
+            self.resync = True
+        elif self.resync or not self.wants(ev):
+            return
+        else:
+            self.pending.pop(ev["id"], None)
+            self.pending[ev["id"]] = ev
+            if len(self.pending) > EVENTS_CLIENT_BUFFER:
+                self.pending.clear()
+                self.resync = True
+                EVENTS_RESYNCS.inc()
+        self.wake.set()
+
+    def drain(self) -> Tuple[bool, List[Dict[str, Any]]]:
+        out = (self.resync, list(self.pending.values()))
+        self.pending.clear()
+        self.resync = False
+        self.wake.clear()
+        return out
+
+_subscribers: Set[Subscriber] = set()
+_callbacks: List[Callable[[Dict[str, Any]], None]] = []
+_task: Optional[asyncio.Task] = None
+_listening = False
+
+def listening() -> bool:
+    """True while the LISTEN connection is up, i.e. every committed change reaches ``on_event``."""
+    return _listening
+
+def subscribe(city: Optional[str] = None, box: Optional[Box] = None) -> Optional[Subscriber]:
+    """New subscriber, or None once EVENTS_MAX_CLIENTS are connected."""
+    if len(_subscribers) >= EVENTS_MAX_CLIENTS:
+        return None
+    sub = Subscriber(city, box)
+    _subscribers.add(sub)
+    return sub
+
+def unsubscribe(sub: Subscriber) -> None:
+    _subscribers.discard(sub)
+
+def on_event(fn: Callable[[Dict[str, Any]], None]) -> None:
+    _callbacks.append(fn)
+
+def dispatch(ev: Dict[str, Any]) -> None:
+    EVENTS_RECEIVED.inc()
+    for fn in _callbacks:
+        try: fn(ev)
+        except Exception as e: print("EVENTS callback warn:", repr(e))
+    for sub in _subscribers:
+        sub.push(ev)
+
+def _on_notify(_conn, _pid, _channel, payload: str) -> None:
+    try:
+        ev = json.loads(payload)
+    except ValueError:
+        return
+    dispatch(ev)
+
+async def _listen(url: str) -> None:
+    global _listening
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(url)
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _c: lost.set())
+            await conn.add_listener(CHANNEL, _on_notify)
+            _listening = True
+            # anything missed while disconnected is unknown: make every client refetch
+            dispatch({"op": "resync"})
+            await lost.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("EVENTS listener warn:", repr(e))
+        finally:
+            _listening = False
+            if conn is not None and not conn.is_closed():
+                try: await conn.close()
+                except Exception: pass
+        await asyncio.sleep(EVENTS_RECONNECT_S)
+
+def start(url: Optional[str]) -> None:
+    global _task
+    if url and _task is None:
+        _task = asyncio.create_task(_listen(url))
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try: await _task
+        except asyncio.CancelledError: pass
+        _task = None
@@ -0,0 +1,149 @@
+"""Offer photo variants: resized WebP thumbnails plus a BlurHash placeholder.
+
+Decoding and encoding are CPU-bound, so ``process_image`` runs in a process pool; the async
+side reads the original from storage, stores the variants next to it and hands back their
+URLs. Work is single-flight per storage key and results are cached, so confirming an upload
+and then saving the offer with that photo only processes it once.
+"""
+import io, os, re, math, asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Sequence
+
+import metrics
+import storage
+from cache import TTLCache
+
+IMAGE_WIDTHS = tuple(int(w) for w in os.getenv("IMAGE_WIDTHS", "320,640").split(",") if w.strip())
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "75"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+BLURHASH_COMPONENTS = (4, 3)
+
+IMAGE_SECONDS = metrics.Histogram("foody_image_process_seconds", "Photo variant generation (read, resize, store)",
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+IMAGE_FAILURES = metrics.Counter("foody_image_failures_total", "Photos that could not be processed")
+
+# ---- BlurHash (https://blurha.sh), pure Python on a 32px thumbnail ----
+_B83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+def _b83(value: int, length: int) -> str:
+    return "".join(_B83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+def _to_linear(v: int) -> float:
+    v = v / 255.0
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+def _to_srgb(v: float) -> int:
+    v = max(0.0, min(1.0, v))
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def blurhash(pixels: Sequence[Sequence[int]], width: int, height: int, cx: int = 4, cy: int = 3) -> str:
+    """BlurHash of row-major RGB ``pixels`` (``width * height`` tuples)."""
+    lin = [(_to_linear(p[0]), _to_linear(p[1]), _to_linear(p[2])) for p in pixels]
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(cx)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(cy)]
+    factors = []
+    for j in range(cy):
+        for i in range(cx):
+            norm = (1.0 if i == 0 and j == 0 else 2.0) / (width * height)
+            r = g = b = 0.0
+            for y in range(height):
+                cyv, row = cos_y[j][y], y * width
+                for x in range(width):
+                    basis = cos_x[i][x] * cyv
+                    pr, pg, pb = lin[row + x]
+                    r += basis * pr; g += basis * pg; b += basis * pb
+            factors.append((r * norm, g * norm, b * norm))
+    dc, ac = factors[0], factors[1:]
+    out = _b83((cx - 1) + (cy - 1) * 9, 1)
+    if ac:
+        quant = max(0, min(82, int(max(abs(v) for f in ac for v in f) * 166 - 0.5)))
+        max_ac = (quant + 1) / 166.0
+        out += _b83(quant, 1)
+    else:
+        max_ac = 1.0
+        out += _b83(0, 1)
+    out += _b83((_to_srgb(dc[0]) << 16) + (_to_srgb(dc[1]) << 8) + _to_srgb(dc[2]), 4)
+    def q(v: float) -> int:
+        return max(0, min(18, int(math.floor(math.copysign(abs(v / max_ac) ** 0.5, v) * 9 + 9.5))))
+    for f in ac:
+        out += _b83(q(f[0]) * 19 * 19 + q(f[1]) * 19 + q(f[2]), 2)
+    return out
+
+def process_image(data: bytes, widths: Sequence[int] = IMAGE_WIDTHS, quality: int = IMAGE_QUALITY) -> Dict[str, Any]:
+    """{width, height, variants: {w: webp bytes}, blurhash} for an uploaded photo. Runs in a worker process."""
+    from PIL import Image, ImageOps
+    im = Image.open(io.BytesIO(data))
+    # JPEG: let libjpeg decode at reduced scale straight away (phone photos are 12+ MP)
+    im.draft("RGB", (max(widths) * 2, max(widths) * 2))
+    im = ImageOps.exif_transpose(im).convert("RGB")
+    variants: Dict[int, bytes] = {}
+    for w in sorted(set(widths)):
+        v = im if im.width <= w else im.resize((w, max(1, round(im.height * w / im.width))), Image.LANCZOS)
+        buf = io.BytesIO()
+        v.save(buf, "WEBP", quality=quality, method=4)
+        variants[w] = buf.getvalue()
+    tw = 32
+    th = max(1, round(im.height * tw / im.width))
+    px = im.resize((tw, th), Image.BILINEAR).tobytes()
+    return {"width": im.width, "height": im.height, "variants": variants,
+            "blurhash": blurhash(list(zip(px[0::3], px[1::3], px[2::3])), tw, th, *BLURHASH_COMPONENTS)}
+
+# ---- async side ----
+_pool: Optional[ProcessPoolExecutor] = None
+_jobs: Dict[str, "asyncio.Future"] = {}
+_results = TTLCache(1024, 3600)
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+def variant_key(key: str, width: int) -> str:
+    return f"{key.rsplit('.', 1)[0] if '.' in key.rsplit('/', 1)[-1] else key}_w{width}.webp"
+
+_VARIANT_RE = re.compile(r"_w\d+\.webp$")
+
+def is_variant_key(key: str) -> bool:
+    """True for keys written by variant_key (never an original worth processing again)."""
+    return bool(_VARIANT_RE.search(key))
+
+async def _process(key: str) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    data = await loop.run_in_executor(None, storage.read, key)
+    out = await loop.run_in_executor(_executor(), process_image, data)
+    urls: Dict[str, str] = {}
+    for w, blob in out["variants"].items():
+        vk = variant_key(key, w)
+        await loop.run_in_executor(None, storage.write, vk, blob, "image/webp")
+        urls[str(w)] = storage.public_url(vk)
+    IMAGE_SECONDS.observe(loop.time() - t0)
+    return {"variants": urls, "blurhash": out["blurhash"], "width": out["width"], "height": out["height"]}
+
+def _finished(key: str, fut: "asyncio.Future") -> None:
+    _jobs.pop(key, None)
+    if fut.cancelled():
+        return
+    if fut.exception() is not None:
+        IMAGE_FAILURES.inc()
+    else:
+        _results.set(key, fut.result())
+
+async def variants_for(key: str) -> Dict[str, Any]:
+    """Variant URLs and blurhash for the stored original ``key`` (processed at most once)."""
+    done = _results.get(key)
+    if done is not None:
+        return done
+    fut = _jobs.get(key)
+    if fut is None:
+        fut = _jobs[key] = asyncio.ensure_future(_process(key))
+        fut.add_done_callback(lambda f: _finished(key, f))
+    # a caller going away must not cancel the work others are waiting on
+    return await asyncio.shield(fut)
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -1,20 +1,30 @@
-import os, io, csv, json, secrets, datetime as dt, base64, math, uuid
-from typing import Optional, Dict, Any, List
+import os, io, csv, json, secrets, datetime as dt, base64, math, uuid, asyncio, time, zlib, hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional, Dict, Any, List, Iterable, Deque, Tuple
 
 import asyncpg
 from fastapi import FastAPI, Header, HTTPException, Query, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
 
 import bootstrap_sql
-import httpx
-
-DB_URL = os.getenv("DATABASE_URL")
+import metrics
+from cache import TTLCache
+import db
+import sweeper
+import events
+import outbox
+import storage
+import images
+from db import acquire
+from app.health_endpoints import router as health_router, warmup
+from app.telegram_link_endpoint import router as telegram_router
 
 app = FastAPI(title="Foody Backend — MVP+R2")
+app.include_router(health_router)  # /live, /ready
+app.include_router(telegram_router)  # /api/v1/telegram: chat linking
 
-BOT_NOTIFY_URL = os.getenv('BOT_NOTIFY_URL','').strip()
-BOT_NOTIFY_SECRET = os.getenv('BOT_NOTIFY_SECRET','').strip()
 
 origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 if origins:
@@ -24,17 +34,9 @@ if origins:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"],  # the storefront is on another origin and pages with it
     )
 
-_pool: Optional[asyncpg.pool.Pool] = None
-async def pool() -> asyncpg.pool.Pool:
-    global _pool
-    if _pool is None:
-        if not DB_URL:
-            raise RuntimeError("DATABASE_URL not set")
-        _pool = await asyncpg.create_pool(DB_URL, min_size=1, max_size=5)
-    return _pool
-
 def rid() -> str: return "RID_" + secrets.token_hex(4)
 def apikey() -> str: return "KEY_" + secrets.token_hex(8)
 def offid() -> str: return "OFF_" + secrets.token_hex(6)
@@ -42,6 +44,7 @@ def resid() -> str: return "RES_" + secrets.token_hex(6)
 def rescode() -> str: return secrets.token_urlsafe(8).upper()
 
 def row_offer(r: asyncpg.Record) -> Dict[str, Any]:
+    variants = r.get("photo_variants")
     return {
         "id": r["id"],
         "restaurant_id": r["restaurant_id"],
@@ -54,43 +57,147 @@ def row_offer(r: asyncpg.Record) -> Dict[str, Any]:
         "expires_at": r["expires_at"].isoformat() if r.get("expires_at") else None,
         "archived_at": r["archived_at"].isoformat() if r.get("archived_at") else None,
         "photo_url": r.get("photo_url"),
+        "photo_variants": json.loads(variants) if isinstance(variants, str) else variants,
+        "photo_blurhash": r.get("photo_blurhash"),
         "created_at": r["created_at"].isoformat() if r.get("created_at") else None,
     }
 
+# api_key -> restaurant_id; only successful lookups are cached so unknown keys cannot flood it
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+_auth_cache = TTLCache(int(os.getenv("AUTH_CACHE_SIZE", "4096")), AUTH_CACHE_TTL)
+
+def invalidate_auth(key: Optional[str] = None, restaurant_id: Optional[str] = None):
+    if key: _auth_cache.pop(key)
+    if restaurant_id: _auth_cache.pop_where(lambda _k, v: v == restaurant_id)
+
 async def auth(conn: asyncpg.Connection, key: str, restaurant_id: Optional[str]) -> str:
     if not key:
         return ""
-    if restaurant_id:
-        r = await conn.fetchrow("SELECT id FROM foody_restaurants WHERE id=$1 AND api_key=$2", restaurant_id, key)
-        return r["id"] if r else ""
-    r = await conn.fetchrow("SELECT id FROM foody_restaurants WHERE api_key=$1", key)
-    return r["id"] if r else ""
+    owner = _auth_cache.get(key)
+    if owner is None:
+        r = await conn.fetchrow("SELECT id FROM foody_restaurants WHERE api_key=$1", key)
+        if not r:
+            return ""
+        owner = r["id"]
+        _auth_cache.set(key, owner)
+    if restaurant_id and owner != restaurant_id:
+        return ""
+    return owner
+
+# ---- Startup ----
+# The app accepts requests at once; migrations (RUN_MIGRATIONS), the demo seed (SEED_DEMO) and
+# opening pool connections run in the background, and /ready answers 503 until they are over.
+# Background workers start afterwards, when the schema is in place.
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(db.POOL_MIN)))
+WARMUP_RETRY_S = 2.0
+_warmup_task: Optional[asyncio.Task] = None
+
+async def _warm_step(name: str, fn, required: bool = False, retry: bool = False):
+    warmup.begin(name, required)
+    while True:
+        try:
+            await fn()
+            warmup.end(name)
+            return
+        except Exception as e:
+            warmup.end(name, e)
+            print(f"WARMUP {name} warn:", repr(e))
+            if not retry: return
+            await asyncio.sleep(WARMUP_RETRY_S)
+
+async def _migrate_and_seed():
+    if bootstrap_sql.env_flag("RUN_MIGRATIONS"):
+        await _warm_step("migrations", bootstrap_sql.run, required=True, retry=True)
+    if bootstrap_sql.SEED_DEMO:
+        async def seed():
+            async with acquire() as conn:
+                if await bootstrap_sql.seed(conn): invalidate_feed()
+        await _warm_step("seed", seed)
+
+async def _warm_pool():
+    # open the first connections side by side instead of one per early request
+    async def one():
+        async with acquire() as conn:
+            await conn.execute("SELECT 1")
+    await asyncio.gather(*(one() for _ in range(max(1, min(DB_POOL_WARM, db.POOL_MAX)))))
+
+async def _warm():
+    async def qr():  # segno import and executor start-up, off the first reservation's path
+        await qr_image("FOODY-WARMUP", "png")
+    steps = [_migrate_and_seed(), _warm_step("db_pool", _warm_pool, required=True, retry=True), _warm_step("qr", qr)]
+    if db.DB_READ_URL:
+        async def replica():
+            if await db.check_replica() is None: raise RuntimeError("replica unreachable, reading from primary")
+        steps.append(_warm_step("read_replica", replica))
+    await asyncio.gather(*steps)
+    db.start()
+    sweeper.start()
+    events.start(db.DB_URL)
+    outbox.start()
+    warmup.finish()
+    print("WARMUP done in", warmup.done_s, "s:", warmup.steps)
 
 @app.on_event("startup")
 async def _startup():
-    await bootstrap_sql.ensure()
-    try:
-        p = await pool()
-        async with p.acquire() as conn:
-            await seed_if_needed(conn)
-    except Exception as e:
-        print("Startup seed warn:", repr(e))
+    global _warmup_task
+    _warmup_task = asyncio.create_task(_warm())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if _warmup_task is not None and not _warmup_task.done():
+        _warmup_task.cancel()
+        try: await _warmup_task
+        except asyncio.CancelledError: pass
+    await sweeper.stop()
+    await events.stop()
+    await outbox.stop()
+    images.shutdown()
+    await db.stop()
+
+# ---- Request instrumentation ----
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+HTTP_SECONDS = metrics.Histogram("foody_http_request_seconds", "Request latency by route", ["method", "route"])
+HTTP_DB_SECONDS = metrics.Histogram("foody_http_db_seconds", "Query time spent per request by route", ["method", "route"])
+HTTP_APP_SECONDS = metrics.Histogram("foody_http_app_seconds", "Non-DB (Python + pool wait) time per request by route", ["method", "route"])
+HTTP_REQUESTS = metrics.Counter("foody_http_requests_total", "Requests by route and status code", ["method", "route", "status"])
+HTTP_INFLIGHT = metrics.Gauge("foody_http_inflight", "Requests being handled")
 
 @app.middleware("http")
 async def guard(request: Request, call_next):
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    trace = db.start_trace()
+    t0 = time.perf_counter()
+    HTTP_INFLIGHT.inc()
     try:
-        return await call_next(request)
+        response = await call_next(request)
     except HTTPException as he:
         raise he
     except Exception as e:
         import traceback; traceback.print_exc()
-        return JSONResponse({"detail": "Internal Server Error"}, status_code=500)
+        response = JSONResponse({"detail": "Internal Server Error"}, status_code=500)
+    finally:
+        HTTP_INFLIGHT.dec()
+    elapsed = time.perf_counter() - t0
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    HTTP_SECONDS.observe(elapsed, method=request.method, route=path)
+    HTTP_DB_SECONDS.observe(trace.db_s, method=request.method, route=path)
+    HTTP_APP_SECONDS.observe(max(elapsed - trace.db_s, 0.0), method=request.method, route=path)
+    HTTP_REQUESTS.inc(method=request.method, route=path, status=response.status_code)
+    response.headers["X-Request-ID"] = request_id
+    response.headers["Server-Timing"] = (f"db;dur={trace.db_s*1000:.1f}, wait;dur={trace.wait_s*1000:.1f}, "
+                                         f"app;dur={max(elapsed - trace.db_s - trace.wait_s, 0.0)*1000:.1f}")
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        print("SLOW REQUEST:", json.dumps({
+            "request_id": request_id, "method": request.method, "path": request.url.path, "route": path,
+            "status": response.status_code, "ms": round(elapsed*1000, 1), "db_ms": round(trace.db_s*1000, 1),
+            "wait_ms": round(trace.wait_s*1000, 1), "sql": trace.queries}, ensure_ascii=False))
+    return response
 
 @app.get("/health")
 async def health():
     try:
-        p = await pool()
-        async with p.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("SELECT 1")
         return {"ok": True}
     except Exception as e:
@@ -117,20 +224,20 @@ async def register_public(raw: Request):
     lon = float(data.get("lon") or 0) or None
     if not title:
         raise HTTPException(422, "title is required")
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         rid_new = rid()
         key_new = apikey()
         await conn.execute(
             "INSERT INTO foody_restaurants(id, api_key, title, phone, city, address, geo, lat, lon) VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9)",
             rid_new, key_new, title, phone, city, address, geo, lat, lon
         )
+    db.pin(rid_new)
+    invalidate_auth(key_new, rid_new)
     return {"restaurant_id": rid_new, "api_key": key_new}
 
 @app.get("/api/v1/merchant/profile")
 async def get_profile(restaurant_id: str, x_foody_key: str = Header(default="")):
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire(read=True, restaurant_id=restaurant_id) as conn:
         rid_ok = await auth(conn, x_foody_key, restaurant_id)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
@@ -150,8 +257,7 @@ async def set_profile(body: Dict[str, Any] = Body(...), x_foody_key: str = Heade
     geo = (body.get("geo") or "").strip() or None
     lat = body.get("lat"); lat = float(lat) if lat not in (None,"") else None
     lon = body.get("lon"); lon = float(lon) if lon not in (None,"") else None
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         rid_ok = await auth(conn, x_foody_key, rid_in)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
@@ -159,21 +265,83 @@ async def set_profile(body: Dict[str, Any] = Body(...), x_foody_key: str = Heade
             "UPDATE foody_restaurants SET title=COALESCE($1,title), phone=$2, city=$3, address=$4, geo=$5, lat=$6, lon=$7 WHERE id=$8",
             title, phone, city, address, geo, lat, lon, rid_in
         )
+        await conn.execute(OFFER_EVENTS_BY_RESTAURANT_SQL, rid_in)  # city/location moved
+    db.pin(rid_in)
+    invalidate_feed()
     return {"ok": True}
 
 # ---- Offers CRUD ----
 
-def parse_iso(ts: Optional[str]):
+def parse_iso(ts: Optional[str], field: str = "expires_at"):
     if not ts: return None
     try:
         return dt.datetime.fromisoformat(ts.replace("Z","+00:00"))
     except Exception:
-        raise HTTPException(422, "expires_at must be ISO8601")
+        raise HTTPException(422, f"{field} must be ISO8601")
+
+def to_cents(v, field: str = "price", exact: bool = False) -> Optional[int]:
+    # prices in RUB accepted -> convert to cents if < 100000 (``exact``: v is already cents)
+    if v is None or v == "": return None
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        raise HTTPException(422, f"{field} must be a number")
+    return int(round(v*100)) if v < 100000 and not exact else int(v)
+
+def to_int(v, field: str) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        raise HTTPException(422, f"{field} must be an integer")
+
+OFFER_INSERT_COLUMNS = ["id", "restaurant_id", "title", "description", "price_cents", "original_price_cents",
+                        "qty_left", "qty_total", "expires_at", "photo_url"]
+
+def offer_record(oid: str, restaurant_id: str, body: Dict[str, Any], exact_cents: bool = False) -> tuple:
+    """Validated values for a new offer, in OFFER_INSERT_COLUMNS order.
+
+    ``exact_cents``: *_cents fields hold cents as-is (CSV exports) instead of the RUB heuristic.
+    """
+    title = (body.get("title") or "").strip()
+    if not title: raise HTTPException(422, "title is required")
+    price_cents = (to_cents(body.get("price")) if "price" in body
+                   else to_cents(body.get("price_cents"), "price_cents", exact_cents))
+    original_price_cents = (to_cents(body.get("original_price"), "original_price") if "original_price" in body
+                            else to_cents(body.get("original_price_cents"), "original_price_cents", exact_cents))
+    if price_cents is None: raise HTTPException(422, "price/price_cents is required")
+    qty_total = to_int(body.get("qty_total") or body.get("qty") or 0, "qty_total")
+    qty_left = to_int(body.get("qty_left") or qty_total, "qty_left")
+    expires_ts = parse_iso(body.get("expires_at"))
+    photo_url = (body.get("photo_url") or "").strip() or None
+    return (oid, restaurant_id, title, (body.get("description") or None), price_cents, original_price_cents,
+            qty_left, qty_total, expires_ts, photo_url)
+
+def offer_changes(body: Dict[str, Any], exact_cents: bool = False) -> Dict[str, Any]:
+    """Validated column -> value for the offer fields present in ``body`` (partial update)."""
+    ch: Dict[str, Any] = {}
+    if "title" in body: ch["title"] = (body.get("title") or "").strip()
+    if "description" in body: ch["description"] = body.get("description") or None
+    if "price" in body or "price_cents" in body:
+        ch["price_cents"] = to_cents(body.get("price") or body.get("price_cents") or 0, exact=exact_cents and "price" not in body)
+    if "original_price" in body or "original_price_cents" in body:
+        v = to_cents(body.get("original_price") or body.get("original_price_cents"), "original_price",
+                     exact=exact_cents and "original_price" not in body)
+        if v is not None: ch["original_price_cents"] = v
+    if "qty_total" in body: ch["qty_total"] = to_int(body.get("qty_total"), "qty_total")
+    if "qty_left" in body: ch["qty_left"] = to_int(body.get("qty_left"), "qty_left")
+    if "expires_at" in body: ch["expires_at"] = parse_iso(body.get("expires_at"))
+    if "photo_url" in body: ch["photo_url"] = body.get("photo_url") or None
+    return ch
+
+def photo_reset_sql(new_url: str, prefix: str = "") -> str:
+    """SET fragment dropping stale variants when photo_url changes to ``new_url``."""
+    changed = f"{new_url} IS DISTINCT FROM {prefix}photo_url"
+    return (f"photo_variants = CASE WHEN {changed} THEN NULL ELSE {prefix}photo_variants END, "
+            f"photo_blurhash = CASE WHEN {changed} THEN NULL ELSE {prefix}photo_blurhash END")
 
 @app.get("/api/v1/merchant/offers")
 async def merchant_offers(restaurant_id: str, status: Optional[str] = None, x_foody_key: str = Header(default="")):
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire(read=True, restaurant_id=restaurant_id) as conn:
         rid_ok = await auth(conn, x_foody_key, restaurant_id)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
@@ -188,366 +356,868 @@ async def merchant_offers(restaurant_id: str, status: Optional[str] = None, x_fo
 @app.post("/api/v1/merchant/offers")
 async def create_offer(body: Dict[str, Any] = Body(...), x_foody_key: str = Header(default="")):
     rid_in = (body.get("restaurant_id") or "").strip()
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         rid_ok = await auth(conn, x_foody_key, rid_in)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
-        oid = offid()
-        title = (body.get("title") or "").strip()
-        if not title: raise HTTPException(422, "title is required")
-        # prices in RUB accepted -> convert to cents if <= 100000
-        def to_cents(v):
-            if v is None or v == "": return None
-            v = float(v)
-            return int(round(v*100)) if v < 100000 else int(v)
-        price_cents = to_cents(body.get("price") if "price" in body else body.get("price_cents"))
-        original_price_cents = to_cents(body.get("original_price") if "original_price" in body else body.get("original_price_cents"))
-        if price_cents is None: raise HTTPException(422, "price/price_cents is required")
-        qty_total = int(body.get("qty_total") or body.get("qty") or 0)
-        qty_left = int(body.get("qty_left") or qty_total)
-        expires_ts = parse_iso(body.get("expires_at"))
-        photo_url = (body.get("photo_url") or "").strip() or None
-        await conn.execute(
-            """INSERT INTO foody_offers(id, restaurant_id, title, description, price_cents, original_price_cents,
-                                        qty_left, qty_total, expires_at, photo_url)
-               VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)""",
-            oid, rid_in, title, (body.get("description") or None), price_cents, original_price_cents, qty_left, qty_total, expires_ts, photo_url
-        )
-        r = await conn.fetchrow("SELECT * FROM foody_offers WHERE id=$1", oid)
-        return row_offer(r)
+        rec = offer_record(offid(), rid_in, body)
+        r = await conn.fetchrow(
+            f"""INSERT INTO foody_offers({', '.join(OFFER_INSERT_COLUMNS)})
+               VALUES({', '.join(f'${i+1}' for i in range(len(OFFER_INSERT_COLUMNS)))}) RETURNING *""", *rec)
+        await publish_offers(conn, [r["id"]])
+        db.pin(rid_in)
+        invalidate_feed()
+        out = row_offer(r)
+    schedule_photo_variants([out])
+    return out
+
+# ---- Bulk publish ----
+# One request for a whole drop: rows without an id are created, rows with an id update that
+# offer (only the fields present). Bad rows are reported per row and skipped; the good ones go
+# in with a single COPY plus a single UPDATE, in one transaction. JSON rows follow the same price
+# rules as create/edit; CSV rows use export_csv's columns, so *_cents there are taken as cents.
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+BULK_UPDATE_TYPES = {"title": "text", "description": "text", "price_cents": "int", "original_price_cents": "int",
+                     "qty_left": "int", "qty_total": "int", "expires_at": "timestamptz", "photo_url": "text"}
+BULK_IGNORED_COLUMNS = ("restaurant_id", "archived_at", "created_at")  # present in export_csv files
+
+def bulk_rows(raw: bytes, is_csv: bool) -> List[Dict[str, Any]]:
+    """Rows of a JSON array or a CSV with export_csv's columns (empty cells count as absent)."""
+    if is_csv:
+        text = raw.decode("utf-8-sig")
+        return [{k: v for k, v in row.items() if k and v not in (None, "")} for row in csv.DictReader(io.StringIO(text))]
+    try:
+        rows = json.loads(raw or b"null")
+    except ValueError:
+        raise HTTPException(422, "Body must be a JSON array or text/csv")
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        raise HTTPException(422, "Body must be a JSON array of offers")
+    return rows
+
+BULK_UPDATE_SQL = f"""
+    UPDATE foody_offers o SET {", ".join(
+        f"{c} = CASE WHEN u.v ? '{c}' THEN (u.v->>'{c}')::{t} ELSE o.{c} END" for c, t in BULK_UPDATE_TYPES.items())},
+        {photo_reset_sql("CASE WHEN u.v ? 'photo_url' THEN u.v->>'photo_url' ELSE o.photo_url END", "o.")}
+    FROM jsonb_array_elements($2::jsonb) AS u(v)
+    WHERE o.id = u.v->>'id' AND o.restaurant_id = $1
+    RETURNING o.id"""
+
+@app.post("/api/v1/merchant/offers/bulk")
+async def bulk_offers(request: Request, restaurant_id: str, x_foody_key: str = Header(default="")):
+    """Create/update many offers at once from a JSON array or CSV; returns a result per row."""
+    is_csv = "csv" in request.headers.get("content-type", "")
+    rows = bulk_rows(await request.body(), is_csv)
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(413, f"At most {BULK_MAX_ROWS} rows per request")
+    results: List[Dict[str, Any]] = []
+    inserts: List[tuple] = []
+    updates: List[Dict[str, Any]] = []
+    seen = set()
+    for i, body in enumerate(rows):
+        oid = str(body.get("id") or "").strip()
+        try:
+            if (body.get("restaurant_id") or restaurant_id) != restaurant_id:
+                raise HTTPException(403, "Offer belongs to another restaurant")
+            if oid in seen: raise HTTPException(422, "duplicate id in request")
+            if oid:
+                ch = offer_changes({k: v for k, v in body.items() if k not in BULK_IGNORED_COLUMNS}, exact_cents=is_csv)
+                if isinstance(ch.get("expires_at"), dt.datetime) and ch["expires_at"].tzinfo is None:
+                    ch["expires_at"] = ch["expires_at"].replace(tzinfo=dt.timezone.utc)  # as asyncpg sends naive values
+                updates.append(dict({k: v.isoformat() if isinstance(v, dt.datetime) else v for k, v in ch.items()}, id=oid))
+                results.append({"row": i, "ok": True, "id": oid, "action": "updated"})
+                seen.add(oid)
+            else:
+                rec = offer_record(offid(), restaurant_id, body, exact_cents=is_csv)
+                inserts.append(rec)
+                results.append({"row": i, "ok": True, "id": rec[0], "action": "created"})
+        except HTTPException as e:
+            results.append({"row": i, "ok": False, "error": e.detail})
+    async with acquire() as conn:
+        rid_ok = await auth(conn, x_foody_key, restaurant_id)
+        if not rid_ok:
+            raise HTTPException(401, "Invalid API key or restaurant_id")
+        async with conn.transaction():
+            if inserts:
+                await conn.copy_records_to_table("foody_offers", records=inserts, columns=OFFER_INSERT_COLUMNS)
+            updated = set()
+            if updates:
+                updated = {r["id"] for r in await conn.fetch(BULK_UPDATE_SQL, restaurant_id, json.dumps(updates))}
+            ok_ids = [r["id"] for r in results if r["ok"] and (r["action"] == "created" or r["id"] in updated)]
+            await publish_offers(conn, ok_ids)
+        offers = {r["id"]: row_offer(r) for r in await conn.fetch("SELECT * FROM foody_offers WHERE id = ANY($1::text[])", ok_ids)}
+    for r in results:
+        if r["ok"] and r["action"] == "updated" and r["id"] not in updated:
+            r.update(ok=False, error="Offer not found")
+            del r["action"]
+        elif r["ok"]:
+            r["offer"] = offers.get(r["id"])
+    if inserts or updated:
+        db.pin(restaurant_id)
+        invalidate_feed()
+    schedule_photo_variants(offers.values())
+    return {"created": len(inserts), "updated": len(updated), "failed": sum(not r["ok"] for r in results), "results": results}
 
 @app.post("/api/v1/merchant/offers/{offer_id}")
 async def edit_offer(offer_id: str, body: Dict[str, Any] = Body(...), x_foody_key: str = Header(default="")):
     rid_in = (body.get("restaurant_id") or "").strip()
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         rid_ok = await auth(conn, x_foody_key, rid_in)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
-        fields = []
-        vals: List[Any] = []
-        def setf(name, val):
-            nonlocal fields, vals
-            fields.append(f"{name}=${len(vals)+1}"); vals.append(val)
-        if "title" in body: setf("title", (body.get("title") or "").strip())
-        if "description" in body: setf("description", (body.get("description") or None))
-        if "price" in body or "price_cents" in body:
-            v = float(body.get("price") or body.get("price_cents") or 0)
-            setf("price_cents", int(round(v*100)) if v < 100000 else int(v))
-        if "original_price" in body or "original_price_cents" in body:
-            v = body.get("original_price") or body.get("original_price_cents")
-            if v not in (None,""):
-                v = float(v); setf("original_price_cents", int(round(v*100)) if v < 100000 else int(v))
-        if "qty_total" in body: setf("qty_total", int(body.get("qty_total")))
-        if "qty_left" in body: setf("qty_left", int(body.get("qty_left")))
-        if "expires_at" in body: setf("expires_at", parse_iso(body.get("expires_at")))
-        if "photo_url" in body: setf("photo_url", (body.get("photo_url") or None))
-        if not fields: return {"ok": True}
-        vals += [offer_id]
-        await conn.execute(f"UPDATE foody_offers SET {', '.join(fields)} WHERE id=${len(vals)}", *vals)
-        r = await conn.fetchrow("SELECT * FROM foody_offers WHERE id=$1", offer_id)
-        return row_offer(r)
+        changes = offer_changes(body)
+        if not changes: return {"ok": True}
+        vals: List[Any] = list(changes.values()) + [offer_id]
+        fields = [f"{name}=${i+1}" for i, name in enumerate(changes)]
+        if "photo_url" in changes:
+            fields.append(photo_reset_sql(f"${list(changes).index('photo_url') + 1}"))
+        r = await conn.fetchrow(f"UPDATE foody_offers SET {', '.join(fields)} WHERE id=${len(vals)} RETURNING *", *vals)
+        if not r: raise HTTPException(404, "Offer not found")
+        await publish_offers(conn, [offer_id])
+        db.pin(rid_ok)
+        invalidate_feed()
+        out = row_offer(r)
+    schedule_photo_variants([out])
+    return out
 
 @app.delete("/api/v1/merchant/offers/{offer_id}")
 async def delete_offer(offer_id: str, restaurant_id: Optional[str] = None, x_foody_key: str = Header(default="")):
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         rid_ok = await auth(conn, x_foody_key, restaurant_id)
         if not rid_ok: raise HTTPException(401, "Invalid API key or restaurant_id")
         chk = await conn.fetchrow("SELECT id, restaurant_id FROM foody_offers WHERE id=$1", offer_id)
         if not chk: raise HTTPException(404, "Offer not found")
         if restaurant_id and chk["restaurant_id"] != restaurant_id: raise HTTPException(403, "Offer belongs to another restaurant")
         await conn.execute("UPDATE foody_offers SET archived_at=NOW() WHERE id=$1", offer_id)
+        await publish_offers(conn, [offer_id])
+        db.pin(chk["restaurant_id"])
+        invalidate_feed()
         return {"ok": True, "deleted": offer_id}
 
 # ---- Offers public with sorting and discount ----
 
-def with_timer_discount(r: Dict[str, Any]) -> Dict[str, Any]:
-    out = dict(r)
-    now = dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
-    expires_at = None
-    if r["expires_at"]:
-        try: expires_at = dt.datetime.fromisoformat(r["expires_at"].replace("Z","+00:00"))
-        except Exception: expires_at = None
-    discount_percent = 0; step = None
-    if expires_at:
-        delta = (expires_at - now).total_seconds() / 60.0
-        if delta <= 30: discount_percent=70; step="-70%"
-        elif delta <= 60: discount_percent=50; step="-50%"
-        elif delta <= 120: discount_percent=30; step="-30%"
-    original = r.get("original_price_cents") or r.get("price_cents")
-    current = r.get("price_cents")
-    if (original and original>0) and discount_percent>0:
-        current = int(round(original * (1 - discount_percent/100)))
-    out["timer_discount_percent"] = discount_percent
-    out["timer_step"] = step
-    out["price_cents_effective"] = current
-    return out
+# (minutes left, discount percent, badge): the closer to expiry, the deeper the discount
+TIMER_TIERS = ((30, 70, "-70%"), (60, 50, "-50%"), (120, 30, "-30%"))
+TIMER_BOUNDARIES_MIN = (120, 60, 30, 0)
+
+def timer_discount(expires_at: Optional[dt.datetime], price_cents: Optional[int], original_price_cents: Optional[int],
+                   now: dt.datetime):
+    """(discount percent, badge, effective price) for an offer at ``now``."""
+    if expires_at is None: return 0, None, price_cents
+    left_min = (expires_at - now).total_seconds() / 60.0
+    for limit, percent, step in TIMER_TIERS:
+        if left_min <= limit:
+            original = original_price_cents or price_cents
+            if original and original > 0:
+                return percent, step, (original * (100 - percent) + 50) // 100  # integer half-up, same as SQL below
+            return percent, step, price_cents
+    return 0, None, price_cents
+
+def sql_effective_price(t: str = "o") -> str:
+    """timer_discount()'s effective price as a SQL expression over offer alias ``t``."""
+    base = f"COALESCE(NULLIF({t}.original_price_cents, 0), {t}.price_cents)"
+    whens = " ".join(f"WHEN {t}.expires_at - NOW() <= interval '{limit} minutes' THEN "
+                     f"CASE WHEN {base} > 0 THEN ({base} * {100 - percent} + 50) / 100 ELSE {t}.price_cents END"
+                     for limit, percent, _ in TIMER_TIERS)
+    return f"(CASE WHEN {t}.expires_at IS NULL THEN {t}.price_cents {whens} ELSE {t}.price_cents END)"
+
+def enrich_feed(rows, now: dt.datetime):
+    """Feed items for a page of joined rows in one pass with a single ``now``.
+
+    Also returns how long the page stays valid: until the next discount tier or
+    expiry boundary of any offer on it.
+    """
+    items = []
+    valid_s = float("inf")
+    for r in rows:
+        o = row_offer(r)
+        exp = r["expires_at"]
+        o["timer_discount_percent"], o["timer_step"], o["price_cents_effective"] = timer_discount(
+            exp, r["price_cents"], r["original_price_cents"], now)
+        o["distance_km"] = r["distance_km"]
+        o["city"] = r["rcity"]
+        items.append(o)
+        if exp is not None:
+            left_min = (exp - now).total_seconds() / 60.0
+            for boundary in TIMER_BOUNDARIES_MIN:
+                if left_min > boundary:
+                    valid_s = min(valid_s, (left_min - boundary) * 60.0); break
+    return items, valid_s
+
+# ---- Geo: bbox prefilter on foody_restaurants(lat, lon), exact distance in SQL ----
+
+KM_PER_DEG_LAT = 111.32
+NEAREST_RADII_KM = (2.0, 10.0, 50.0, 250.0)  # widening rings for k-nearest without a radius
+
+SQL_DISTANCE_KM = ("6371.0*2*asin(least(1.0, sqrt(power(sin(radians(r.lat-{lat})/2),2)"
+                   " + cos(radians({lat}))*cos(radians(r.lat))*power(sin(radians(r.lon-{lon})/2),2))))")
+
+def parse_bbox(bbox: Optional[str]):
+    if not bbox: return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = [float(x) for x in bbox.split(",")]
+    except Exception:
+        raise HTTPException(422, "bbox must be min_lon,min_lat,max_lon,max_lat")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise HTTPException(422, "bbox min must not exceed max")
+    return (min_lon, min_lat, max_lon, max_lat)
+
+def radius_bbox(lat: float, lon: float, radius_km: float):
+    dlat = radius_km / KM_PER_DEG_LAT
+    dlon = radius_km / (KM_PER_DEG_LAT * max(math.cos(math.radians(lat)), 0.01))
+    return (max(lon-dlon, -180.0), max(lat-dlat, -90.0), min(lon+dlon, 180.0), min(lat+dlat, 90.0))
+
+def bbox_intersect(a, b):
+    if not a or not b: return a or b
+    return (max(a[0],b[0]), max(a[1],b[1]), min(a[2],b[2]), min(a[3],b[3]))
+
+# ---- Feed ordering: (sort key, id) keysets over partial indexes on active offers ----
+
+FEED_SORTS = {
+    "expiry": ("COALESCE(o.expires_at, 'infinity'::timestamptz)", "ASC"),
+    "price": (sql_effective_price("o"), "ASC"),  # what the cards show; a top-N sort over live offers
+    "new": ("COALESCE(o.created_at, '-infinity'::timestamptz)", "DESC"),
+    "distance": ("COALESCE({dist}, 'Infinity'::float8)", "ASC"),
+}
+FEED_SORT_ALIASES = {"newest": "new"}
+
+# Materialized feed pages keyed by (version, sort, city, cursor, limit, geo). Every write that
+# changes the feed bumps the version, so a page loaded concurrently with a write is never served.
+# Offer events only drop the pages whose city and box could hold that offer; a page whose load
+# overlapped such an event is not cached (FEED_RECENT_EVENTS remembers where they hit).
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", "5"))
+FEED_RECENT_EVENTS = 256
+_feed_cache = TTLCache(int(os.getenv("FEED_CACHE_SIZE", "512")), FEED_CACHE_TTL)
+_feed_inflight: Dict[Any, "asyncio.Future"] = {}
+_feed_version = 0
+_feed_event_seq = 0
+_feed_recent: Deque[Tuple[int, Optional[str], Optional[float], Optional[float]]] = deque(maxlen=FEED_RECENT_EVENTS)
+
+def invalidate_feed():
+    global _feed_version
+    _feed_version += 1
+    _feed_cache.clear()
+
+def feed_key_covers(key, city: Optional[str], lat: Optional[float], lon: Optional[float]) -> bool:
+    """Could the page cached under ``key`` contain an offer in ``city`` at (lat, lon)?"""
+    key_city, box = key[2], key[8]
+    if key_city is not None and key_city != city:
+        return False
+    if box is not None:
+        return lat is not None and lon is not None and box[0] <= lon <= box[2] and box[1] <= lat <= box[3]
+    return True
+
+def invalidate_feed_event(ev: Dict[str, Any]) -> None:
+    global _feed_event_seq
+    if ev.get("op") == "resync" or "id" not in ev:
+        return invalidate_feed()
+    city, lat, lon = ev.get("city"), ev.get("lat"), ev.get("lon")
+    _feed_event_seq += 1
+    _feed_recent.append((_feed_event_seq, city, lat, lon))
+    _feed_cache.pop_where(lambda key, _page: feed_key_covers(key, city, lat, lon))
 
-def haversine_km(lat1, lon1, lat2, lon2):
-    R=6371.0
-    from math import radians, sin, cos, sqrt, asin
-    φ1, λ1, φ2, λ2 = map(radians, [lat1,lon1,lat2,lon2])
-    dφ = φ2-φ1; dλ = λ2-λ1
-    a = sin(dφ/2)**2 + cos(φ1)*cos(φ2)*sin(dλ/2)**2
-    c = 2*asin(sqrt(a))
-    return R*c
+def feed_page_stale(key, since_seq: int) -> bool:
+    """True if an offer event that could touch ``key`` arrived after ``since_seq``."""
+    if _feed_event_seq == since_seq:
+        return False
+    if not _feed_recent or _feed_recent[0][0] > since_seq + 1:
+        return True  # the log no longer reaches back that far
+    return any(seq > since_seq and feed_key_covers(key, city, lat, lon) for seq, city, lat, lon in _feed_recent)
+
+# ---- Offer change events ----
+# Writers notify in their own transaction; every worker's listener (events.py) fans the event
+# out to its /offers/stream clients and drops its feed cache, so other workers see writes too.
+OFFER_LIVE_SQL = "o.archived_at IS NULL AND (o.expires_at IS NULL OR o.expires_at > NOW())"
+EVENTS_HEARTBEAT_S = float(os.getenv("EVENTS_HEARTBEAT_S", "15"))
+
+def offer_event_sql(o: str = "o", effective: Optional[str] = None, op: str = "'upsert'") -> str:
+    """pg_notify() of an offer delta; expects restaurant alias ``r`` joined in."""
+    return (f"pg_notify('{events.CHANNEL}', json_build_object('op', {op}, 'id', {o}.id, 'qty_left', {o}.qty_left, "
+            f"'price_cents_effective', {effective or sql_effective_price(o)}, 'expires_at', {o}.expires_at, "
+            f"'city', lower(r.city), 'lat', r.lat, 'lon', r.lon)::text)")
+
+OFFER_EVENT_OP_SQL = f"CASE WHEN {OFFER_LIVE_SQL} THEN 'upsert' ELSE 'remove' END"
+OFFER_EVENTS_SQL = (f"SELECT {offer_event_sql(op=OFFER_EVENT_OP_SQL)} "
+                    "FROM foody_offers o JOIN foody_restaurants r ON r.id=o.restaurant_id WHERE o.id = ANY($1::text[])")
+OFFER_EVENTS_BY_RESTAURANT_SQL = (f"SELECT {offer_event_sql()} FROM foody_offers o JOIN foody_restaurants r ON r.id=o.restaurant_id "
+                                  f"WHERE o.restaurant_id=$1 AND {OFFER_LIVE_SQL}")
+
+async def publish_offers(conn: asyncpg.Connection, offer_ids: List[str]) -> None:
+    if offer_ids:
+        await conn.execute(OFFER_EVENTS_SQL, list(offer_ids))
+
+events.on_event(invalidate_feed_event)
+
+def encode_cursor(sort: str, key: Any, offer_id: str) -> str:
+    if isinstance(key, dt.datetime): key = key.isoformat()
+    raw = json.dumps([sort, key, offer_id], separators=(",",":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, sort: str):
+    try:
+        s, key, offer_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if sort in ("expiry", "new"): key = dt.datetime.fromisoformat(key)
+        elif sort == "distance": key = float(key)
+        else: key = int(key)
+    except Exception:
+        raise HTTPException(422, "Invalid cursor")
+    if s != sort: raise HTTPException(422, "cursor does not match sort")
+    return key, str(offer_id)
+
+async def fetch_active_offers(conn: asyncpg.Connection, limit: int, sort: str, lat: Optional[float], lon: Optional[float],
+                              box=None, radius_km: Optional[float] = None, city: Optional[str] = None, after=None):
+    where = ["(o.archived_at IS NULL)", "(o.expires_at IS NULL OR o.expires_at > NOW())", "(o.qty_left IS NULL OR o.qty_left > 0)"]
+    params: List[Any] = []
+    def arg(v):
+        params.append(v); return f"${len(params)}"
+    dist = "NULL::float8"
+    if lat is not None and lon is not None:
+        dist = SQL_DISTANCE_KM.format(lat=arg(lat), lon=arg(lon))
+    if box:
+        where.append(f"r.lat BETWEEN {arg(box[1])} AND {arg(box[3])} AND r.lon BETWEEN {arg(box[0])} AND {arg(box[2])}")
+        if radius_km is not None and lat is not None and lon is not None:
+            where.append(f"{dist} <= {arg(radius_km)}")
+    if city:
+        where.append(f"lower(r.city) = lower({arg(city)})")
+    key, direction = FEED_SORTS[sort]
+    key = key.format(dist=dist)
+    if after:
+        where.append(f"({key}, o.id) {'>' if direction == 'ASC' else '<'} ({arg(after[0])}, {arg(after[1])})")
+    return await conn.fetch(
+        f"""SELECT o.*, r.lat as rlat, r.lon as rlon, r.city as rcity, {dist} AS distance_km, {key} AS sort_key
+            FROM foody_offers o
+            JOIN foody_restaurants r ON r.id=o.restaurant_id
+            WHERE {' AND '.join(where)}
+            ORDER BY sort_key {direction}, o.id {direction}
+            LIMIT {arg(limit)}""", *params
+    )
 
 @app.get("/api/v1/offers")
-async def public_offers(limit: int = Query(200, ge=1, le=500), sort: str = "expiry",
-                        lat: Optional[float] = None, lon: Optional[float] = None, city: Optional[str] = None):
-    p = await pool()
-    async with p.acquire() as conn:
-        rows = await conn.fetch(
-            """SELECT o.*, r.lat as rlat, r.lon as rlon, r.city as rcity FROM foody_offers o
-               JOIN foody_restaurants r ON r.id=o.restaurant_id
-               WHERE (o.archived_at IS NULL)
-                 AND (o.expires_at IS NULL OR o.expires_at > NOW())
-                 AND (o.qty_left IS NULL OR o.qty_left > 0)
-               ORDER BY o.expires_at NULLS LAST, o.id
-               LIMIT $1""", limit
-        )
-        base = [row_offer(r) for r in rows]
-        base = [with_timer_discount(o) for o in base]
-        # attach distance if lat/lon present
-        enriched = []
-        for r,raw in zip(base, rows):
-            d=None
-            if lat is not None and lon is not None and raw["rlat"] and raw["rlon"]:
-                d = haversine_km(lat, lon, raw["rlat"], raw["rlon"])
-            r["distance_km"]=d
-            r["city"]=raw["rcity"]
-            enriched.append(r)
-        if city:
-            enriched = [e for e in enriched if (e.get("city") or "").lower()==city.lower()]
-        if sort=="price":
-            enriched.sort(key=lambda x: (x.get("price_cents_effective") or x.get("price_cents") or 10**12))
-        elif sort=="new":
-            enriched.sort(key=lambda x: x.get("created_at") or "", reverse=True)
-        elif sort=="distance" and lat is not None and lon is not None:
-            enriched.sort(key=lambda x: (x.get("distance_km") if x.get("distance_km") is not None else 10**6))
-        else: # expiry default
-            def eta(o):
-                if not o.get("expires_at"): return 10**12
+async def public_offers(response: Response, limit: int = Query(200, ge=1, le=500), sort: str = "expiry",
+                        lat: Optional[float] = None, lon: Optional[float] = None, city: Optional[str] = None,
+                        radius_km: Optional[float] = Query(None, gt=0, le=1000), bbox: Optional[str] = None,
+                        cursor: Optional[str] = None):
+    """Active offers, one keyset page at a time.
+
+    Without ``cursor`` the body stays a bare list (what the storefront expects) and
+    the next page token is sent in ``X-Next-Cursor``; with ``cursor`` (empty for the
+    first page) the body is ``{"items": [...], "next_cursor": ...}``.
+    """
+    box = parse_bbox(bbox)
+    has_geo = lat is not None and lon is not None
+    if radius_km is not None:
+        if not has_geo: raise HTTPException(422, "radius_km requires lat and lon")
+        box = bbox_intersect(box, radius_bbox(lat, lon, radius_km))
+    sort = FEED_SORT_ALIASES.get(sort, sort)
+    if sort not in FEED_SORTS or (sort == "distance" and not has_geo):
+        sort = "expiry"
+    city = (city or "").strip() or None
+    after = decode_cursor(cursor, sort) if cursor else None
+    key = (_feed_version, sort, city and city.lower(), cursor or "", limit, lat, lon, radius_km, box)
+    page = _feed_cache.get(key)
+    if page is None:
+        inflight = _feed_inflight.get(key)
+        if inflight is None:
+            inflight = _feed_inflight[key] = asyncio.ensure_future(
+                load_feed_page(key, limit, sort, lat, lon, box, radius_km, city, after))
+            inflight.add_done_callback(lambda _f, k=key: _feed_inflight.pop(k, None))
+        page = await asyncio.shield(inflight)
+    items, next_cursor = page
+    if cursor is not None:
+        return {"items": items, "next_cursor": next_cursor}
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+async def load_feed_page(key, limit: int, sort: str, lat: Optional[float], lon: Optional[float],
+                         box, radius_km: Optional[float], city: Optional[str], after):
+    since_seq = _feed_event_seq
+    async with acquire(read=True) as conn:
+        if sort == "distance" and not box:
+            # k-nearest: try small rings first, each one served by the (lat, lon) index
+            rows = []
+            for ring in NEAREST_RADII_KM:
+                if after and ring <= after[0]: continue
+                rows = await fetch_active_offers(conn, limit+1, sort, lat, lon, radius_bbox(lat, lon, ring), ring, city, after)
+                if len(rows) > limit: break
+            else:
+                rows = await fetch_active_offers(conn, limit+1, sort, lat, lon, None, None, city, after)
+        else:
+            rows = await fetch_active_offers(conn, limit+1, sort, lat, lon, box, radius_km, city, after)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1]["sort_key"], rows[-1]["id"])
+    items, valid_s = enrich_feed(rows, dt.datetime.now(dt.timezone.utc))
+    page = (items, next_cursor)
+    if not feed_page_stale(key, since_seq):
+        _feed_cache.set(key, page, min(FEED_CACHE_TTL, valid_s))
+    return page
+
+@app.get("/api/v1/offers/stream")
+async def offers_stream(request: Request, city: Optional[str] = None, bbox: Optional[str] = None):
+    """Server-Sent Events: ``offer`` deltas (id, qty_left, price_cents_effective, ...) as stock and
+    prices change, optionally limited to a city or bbox; ``resync`` means refetch /offers."""
+    sub = events.subscribe((city or "").strip() or None, parse_bbox(bbox))
+    if sub is None:
+        raise HTTPException(503, "Too many stream clients", headers={"Retry-After": "5"})
+    async def gen():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
                 try:
-                    t = dt.datetime.fromisoformat(o["expires_at"].replace("Z","+00:00"))
-                except Exception:
-                    return 10**12
-                return (t - dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)).total_seconds()
-            enriched.sort(key=lambda x: eta(x))
-        return enriched
+                    await asyncio.wait_for(sub.wake.wait(), EVENTS_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected(): break
+                    yield ": ping\n\n"
+                    continue
+                resync, evs = sub.drain()
+                if resync: yield "event: resync\ndata: {}\n\n"
+                for ev in evs:
+                    yield f"event: offer\ndata: {json.dumps(ev, ensure_ascii=False, separators=(',', ':'))}\n\n"
+        finally:
+            events.unsubscribe(sub)
+    return StreamingResponse(gen(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ---- CSV ----
+CSV_COLUMNS = ["id","restaurant_id","title","description","price_cents","original_price_cents","qty_left","qty_total","expires_at","archived_at","photo_url","created_at"]
+CSV_CHUNK_ROWS = 500
+
+def csv_row(r: asyncpg.Record) -> List[Any]:
+    return [
+        r["id"], r["restaurant_id"], r["title"], r.get("description") or "",
+        r["price_cents"], r.get("original_price_cents") or "",
+        r["qty_left"], r["qty_total"],
+        r["expires_at"].isoformat() if r.get("expires_at") else "",
+        r["archived_at"].isoformat() if r.get("archived_at") else "",
+        r.get("photo_url") or "",
+        r["created_at"].isoformat() if r.get("created_at") else "",
+    ]
+
 @app.get("/api/v1/merchant/offers/csv")
-async def export_csv(restaurant_id: str):
-    p = await pool()
-    async with p.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM foody_offers WHERE restaurant_id=$1 ORDER BY created_at", restaurant_id)
-    def gen():
+async def export_csv(restaurant_id: str, x_foody_key: str = Header(default=""),
+                     date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to"),
+                     gzip: bool = False):
+    """Offers created in [from, to) as CSV, streamed from a server-side cursor.
+
+    A date-only ``to`` (YYYY-MM-DD) includes that whole day. ``gzip=1`` sends a .csv.gz.
+    """
+    where = ["restaurant_id=$1"]
+    params: List[Any] = [restaurant_id]
+    if date_from:
+        params.append(parse_iso(date_from, "from")); where.append(f"created_at >= ${len(params)}")
+    if date_to:
+        to_ts = parse_iso(date_to, "to")
+        if len(date_to) == 10: to_ts += dt.timedelta(days=1)
+        params.append(to_ts); where.append(f"created_at < ${len(params)}")
+    async with acquire(read=True, restaurant_id=restaurant_id) as conn:
+        rid_ok = await auth(conn, x_foody_key, restaurant_id)
+        if not rid_ok:
+            raise HTTPException(401, "Invalid API key or restaurant_id")
+    sql = f"SELECT * FROM foody_offers WHERE {' AND '.join(where)} ORDER BY created_at, id"
+    async def gen():
         buf = io.StringIO()
         w = csv.writer(buf)
-        w.writerow(["id","restaurant_id","title","description","price_cents","original_price_cents","qty_left","qty_total","expires_at","archived_at","photo_url","created_at"])
-        for r in rows:
-            w.writerow([
-                r["id"], r["restaurant_id"], r["title"], r.get("description") or "",
-                r["price_cents"], r.get("original_price_cents") or "",
-                r["qty_left"], r["qty_total"],
-                r["expires_at"].isoformat() if r.get("expires_at") else "",
-                r["archived_at"].isoformat() if r.get("archived_at") else "",
-                r.get("photo_url") or "",
-                r["created_at"].isoformat() if r.get("created_at") else "",
-            ])
-        yield buf.getvalue()
-    return StreamingResponse(gen(), media_type="text/csv",
-                             headers={"Content-Disposition": f"attachment; filename=offers_{restaurant_id}.csv"})
+        z = zlib.compressobj(wbits=31) if gzip else None  # wbits=31: gzip container
+        def take() -> bytes:
+            data = buf.getvalue().encode("utf-8")
+            buf.seek(0); buf.truncate(0)
+            return z.compress(data) if z else data
+        w.writerow(CSV_COLUMNS)
+        n = 0
+        async with acquire(read=True, restaurant_id=restaurant_id) as conn:
+            async with conn.transaction():  # cursors only live inside a transaction
+                async for r in conn.cursor(sql, *params, prefetch=CSV_CHUNK_ROWS):
+                    w.writerow(csv_row(r)); n += 1
+                    if n % CSV_CHUNK_ROWS == 0:
+                        chunk = take()
+                        if chunk: yield chunk
+        chunk = take() + (z.flush() if z else b"")
+        if chunk: yield chunk
+    filename = f"offers_{restaurant_id}.csv" + (".gz" if gzip else "")
+    return StreamingResponse(gen(), media_type="application/gzip" if gzip else "text/csv",
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 # ---- Reservations + QR ----
-def make_qr_png_b64(text: str) -> str:
-    import qrcode
-    from io import BytesIO
-    img = qrcode.make(text)
-    bio = BytesIO()
-    img.save(bio, format="PNG")
-    return base64.b64encode(bio.getvalue()).decode("ascii")
+# Codes never change, so rendered images are cached by (code, kind); rendering runs off the
+# event loop so a burst of reservations does not stall every other request on PNG encoding.
+QR_PLACEHOLDER_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg==")
+QR_PLACEHOLDER_SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"/>'
+QR_KINDS = {"png": "image/png", "svg": "image/svg+xml"}
+_qr_cache = TTLCache(int(os.getenv("QR_CACHE_SIZE", "2048")), float(os.getenv("QR_CACHE_TTL", "86400")))
+_qr_executor = (ProcessPoolExecutor if os.getenv("QR_EXECUTOR", "thread") == "process" else ThreadPoolExecutor)(
+    max_workers=int(os.getenv("QR_WORKERS", "2")))
+
+def render_qr(text: str, kind: str = "png") -> bytes:
+    try:
+        import segno
+    except ImportError:
+        return QR_PLACEHOLDER_SVG if kind == "svg" else QR_PLACEHOLDER_PNG
+    buf = io.BytesIO()
+    segno.make(text, micro=False).save(buf, kind=kind, scale=5)
+    return buf.getvalue()
+
+async def qr_image(text: str, kind: str = "png") -> bytes:
+    img = _qr_cache.get((text, kind))
+    if img is None:
+        img = await asyncio.get_running_loop().run_in_executor(_qr_executor, render_qr, text, kind)
+        _qr_cache.set((text, kind), img)
+    return img
+
+async def make_qr_png_b64(text: str) -> str:
+    return base64.b64encode(await qr_image(text, "png")).decode("ascii")
+
+# Per-offer reservation contention: attempts, outcomes and time spent in the conditional
+# decrement (which includes waiting on the offer's row lock). Bounded LRU by offer id.
+RESERVE_STATS_MAX = 1000
+_reserve_stats: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+
+def note_reservation(offer_id: str, outcome: str, elapsed_ms: float):
+    st = _reserve_stats.get(offer_id)
+    if st is None:
+        st = _reserve_stats[offer_id] = {"attempts": 0, "reserved": 0, "sold_out": 0, "inactive": 0, "stmt_ms_total": 0.0, "stmt_ms_max": 0.0}
+        if len(_reserve_stats) > RESERVE_STATS_MAX: _reserve_stats.popitem(last=False)
+    else:
+        _reserve_stats.move_to_end(offer_id)
+    st["attempts"] += 1
+    st[outcome] += 1
+    st["stmt_ms_total"] += elapsed_ms
+    st["stmt_ms_max"] = max(st["stmt_ms_max"], elapsed_ms)
+
+def hot_offers(n: int = 20) -> List[Dict[str, Any]]:
+    top = sorted(_reserve_stats.items(), key=lambda kv: kv[1]["attempts"], reverse=True)[:n]
+    return [dict(st, offer_id=oid, stmt_ms_avg=round(st["stmt_ms_total"]/st["attempts"], 3)) for oid, st in top]
+
+# foody_kpi_daily holds one row per (restaurant, UTC day of reservation), bumped in the same
+# statement/transaction as reserve, redeem and cancel; redeem and cancel count towards the day the
+# reservation was made, so a day's redemption rate is a cohort rate.
+KPI_DAY_SQL = "({ts} AT TIME ZONE 'UTC')::date"
+KPI_UPSERT = "INSERT INTO foody_kpi_daily AS k (restaurant_id, day, reserved, redeemed, canceled, revenue_cents, saved_cents)"
+KPI_ON_CONFLICT = ("ON CONFLICT (restaurant_id, day) DO UPDATE SET reserved=k.reserved+EXCLUDED.reserved, "
+                   "redeemed=k.redeemed+EXCLUDED.redeemed, canceled=k.canceled+EXCLUDED.canceled, "
+                   "revenue_cents=k.revenue_cents+EXCLUDED.revenue_cents, saved_cents=k.saved_cents+EXCLUDED.saved_cents")
+
+# merchant notification, queued in the reservation statement itself (delivered by outbox.py)
+OUTBOX_RESERVED_CTE = """, outbox AS (
+                    INSERT INTO foody_outbox(restaurant_id, kind, payload)
+                    SELECT restaurant_id, 'reserved', json_build_object('offer_id', id, 'title', title, 'qty', $3::int, 'code', $4::text) FROM upd
+                )"""
+
+# Idempotency-Key: the key is stored by the reservation statement itself, so a retry racing
+# the original fails on the primary key and the whole statement (decrement included) rolls
+# back; the stored {id, code, qty} is then replayed and the QR comes from the code cache.
+IDEMPOTENCY_KEY_MAX = 200
+IDEMPOTENCY_CTE = """, idem AS (
+                    INSERT INTO foody_idempotency(key, fingerprint, response)
+                    SELECT $5, $6, json_build_object('id', $2::text, 'code', $4::text, 'qty', $3::int) FROM upd
+                )"""
+
+def reservation_fingerprint(offer_id: str, qty: int) -> str:
+    return hashlib.sha256(f"{offer_id}\n{qty}".encode("utf-8")).hexdigest()
+
+async def idempotent_replay(conn: asyncpg.Connection, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+    row = await conn.fetchrow("SELECT fingerprint, response FROM foody_idempotency WHERE key=$1", key)
+    if not row:
+        return None
+    if row["fingerprint"] != fingerprint:
+        raise HTTPException(422, "Idempotency-Key was already used for a different request")
+    return json.loads(row["response"]) if isinstance(row["response"], str) else row["response"]
+
+async def reservation_response(out: Dict[str, Any], qr: str) -> Dict[str, Any]:
+    if qr == "png":
+        out["qrcode_png_base64"] = await make_qr_png_b64(out["code"])
+    elif qr == "svg":
+        out["qrcode_svg"] = (await qr_image(out["code"], "svg")).decode("utf-8")
+    return out
 
 @app.post("/api/v1/reservations")
-async def create_reservation(body: Dict[str, Any] = Body(...)):
+async def create_reservation(response: Response, body: Dict[str, Any] = Body(...),
+                             idempotency_key: str = Header(default="")):
     offer_id = (body.get("offer_id") or "").strip()
     if not offer_id: raise HTTPException(422, "offer_id required")
     qty = int(body.get("qty") or 1)
     if qty < 1: raise HTTPException(422, "qty must be >= 1")
-    p = await pool()
-    async with p.acquire() as conn:
-        off = await conn.fetchrow("SELECT id, qty_left FROM foody_offers WHERE id=$1 AND (archived_at IS NULL) AND (expires_at IS NULL OR expires_at>NOW())", offer_id)
-        if not off: raise HTTPException(404, "Offer not found or inactive")
-        if off["qty_left"] is not None and off["qty_left"] < qty: raise HTTPException(409, "Not enough items left")
-        code = rescode()
-        rid = resid()
-        async with conn.transaction():
-            await conn.execute("INSERT INTO foody_reservations(id, offer_id, code, status, qty) VALUES($1,$2,$3,'reserved',$4)", rid, offer_id, code, qty)
-            if off["qty_left"] is not None:
-                await conn.execute("UPDATE foody_offers SET qty_left=qty_left-$1 WHERE id=$2", qty, offer_id)
-    qr_b64 = make_qr_png_b64(code)
-    return {"id": rid, "code": code, "qty": qty, "qrcode_png_base64": qr_b64}
+    qr = body.get("qr") or "png"
+    if qr not in ("png", "svg", "none"): raise HTTPException(422, "qr must be png, svg or none")
+    idem_key = idempotency_key.strip()
+    if len(idem_key) > IDEMPOTENCY_KEY_MAX: raise HTTPException(422, f"Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX}")
+    fingerprint = reservation_fingerprint(offer_id, qty) if idem_key else ""
+    code = rescode()
+    rid = resid()
+    async with acquire() as conn:
+        # one statement: the decrement only matches while enough stock is left, so concurrent
+        # buyers serialize on the row lock and the loser sees zero rows instead of overselling
+        t0 = time.perf_counter()
+        try:
+            row = await conn.fetchrow(
+                f"""WITH upd AS (
+                        UPDATE foody_offers o SET qty_left=o.qty_left-$3
+                        WHERE o.id=$1 AND (o.archived_at IS NULL) AND (o.expires_at IS NULL OR o.expires_at>NOW())
+                          AND (o.qty_left IS NULL OR o.qty_left >= $3)
+                        RETURNING o.id, o.title, o.qty_left, o.expires_at, o.restaurant_id, {sql_effective_price("o")} AS unit_price,
+                                  COALESCE(NULLIF(o.original_price_cents, 0), o.price_cents) AS unit_original
+                    ), ins AS (
+                        INSERT INTO foody_reservations(id, offer_id, code, status, qty, unit_price_cents, unit_original_cents)
+                        SELECT $2, upd.id, $4, 'reserved', $3, upd.unit_price, upd.unit_original FROM upd
+                    ), kpi AS (
+                        {KPI_UPSERT} SELECT restaurant_id, {KPI_DAY_SQL.format(ts="NOW()")}, 1, 0, 0, 0, 0 FROM upd {KPI_ON_CONFLICT}
+                    ){OUTBOX_RESERVED_CTE if outbox.ENABLED else ""}{IDEMPOTENCY_CTE if idem_key else ""}
+                    SELECT o.qty_left, {offer_event_sql("o", "o.unit_price")} FROM upd o JOIN foody_restaurants r ON r.id=o.restaurant_id""",
+                offer_id, rid, qty, code, *((idem_key, fingerprint) if idem_key else ()))
+        except asyncpg.UniqueViolationError as e:
+            if not idem_key or e.constraint_name != "foody_idempotency_pkey": raise
+            row = None
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        if not row and idem_key:
+            # a retry: replay even if the original took the last items
+            prev = await idempotent_replay(conn, idem_key, fingerprint)
+            if prev is not None:
+                response.headers["Idempotent-Replayed"] = "true"
+                return await reservation_response(prev, qr)
+        if not row:
+            active = await conn.fetchval("SELECT 1 FROM foody_offers WHERE id=$1 AND (archived_at IS NULL) AND (expires_at IS NULL OR expires_at>NOW())", offer_id)
+            note_reservation(offer_id, "sold_out" if active else "inactive", elapsed_ms)
+            if not active: raise HTTPException(404, "Offer not found or inactive")
+            raise HTTPException(409, "Not enough items left")
+    note_reservation(offer_id, "reserved", elapsed_ms)
+    if not events.listening(): invalidate_feed()  # otherwise the offer event drops the affected pages
+    outbox.kick()
+    return await reservation_response({"id": rid, "code": code, "qty": qty}, qr)
+
+# Redeem and cancel are one statement each: the reservation row is locked in the first CTE
+# (FOR UPDATE re-reads it after a concurrent scan commits, so the status seen is current) and
+# the status change, stock, KPI rollup and outbox only happen when the status guard holds.
+REDEEM_SQL = f"""
+    WITH res AS (
+        SELECT r.id, r.status, r.qty, r.created_at, o.restaurant_id, m.id IS NOT NULL AS key_ok,
+               COALESCE(r.unit_price_cents, o.price_cents) AS unit,
+               -- reservations made before unit prices were recorded fall back to the offer's prices
+               COALESCE(NULLIF(r.unit_original_cents, 0), NULLIF(o.original_price_cents, 0), r.unit_price_cents, o.price_cents) AS unit_original
+        FROM foody_reservations r JOIN foody_offers o ON o.id=r.offer_id
+        LEFT JOIN foody_restaurants m ON m.id=o.restaurant_id AND m.api_key=$2
+        WHERE r.code=$1 FOR UPDATE OF r
+    ), upd AS (
+        UPDATE foody_reservations t SET status='redeemed', redeemed_at=NOW()
+        FROM res WHERE t.id=res.id AND res.key_ok AND res.status='reserved' RETURNING t.id
+    ), kpi AS (
+        {KPI_UPSERT} SELECT restaurant_id, {KPI_DAY_SQL.format(ts="created_at")}, 0, 1, 0,
+                            qty*unit::bigint, qty*GREATEST(unit_original::bigint-unit::bigint, 0)
+        FROM res JOIN upd USING (id) {KPI_ON_CONFLICT}
+    )
+    SELECT restaurant_id, status, key_ok, EXISTS (SELECT 1 FROM upd) AS done FROM res"""
 
 @app.post("/api/v1/reservations/redeem")
 async def redeem_reservation(body: Dict[str, Any] = Body(...), x_foody_key: str = Header(default="")):
     code = (body.get("code") or "").strip()
     if not code: raise HTTPException(422, "code required")
-    p = await pool()
-    async with p.acquire() as conn:
-        res = await conn.fetchrow("""SELECT r.*, o.restaurant_id FROM foody_reservations r 
-                                     JOIN foody_offers o ON o.id=r.offer_id WHERE r.code=$1""", code)
-        if not res: raise HTTPException(404, "Reservation not found")
-        # ensure merchant key matches the offer's restaurant
-        rid_ok = await auth(conn, x_foody_key, res["restaurant_id"])
-        if not rid_ok: raise HTTPException(401, "Invalid merchant key for this reservation")
-        if res["status"] == "redeemed": return {"ok": True, "status": "already_redeemed"}
-        await conn.execute("UPDATE foody_reservations SET status='redeemed', redeemed_at=NOW() WHERE id=$1", res["id"])
+    async with acquire() as conn:
+        res = await conn.fetchrow(REDEEM_SQL, code, x_foody_key)
+    if not res: raise HTTPException(404, "Reservation not found")
+    # ensure merchant key matches the offer's restaurant
+    if not res["key_ok"]: raise HTTPException(401, "Invalid merchant key for this reservation")
+    if res["done"]:
+        db.pin(res["restaurant_id"])
         return {"ok": True, "status": "redeemed"}
+    if res["status"] == "redeemed": return {"ok": True, "status": "already_redeemed"}
+    return {"ok": False, "status": res["status"]}
+
+def cancel_sql(with_outbox: bool) -> str:
+    outbox_cte = """, outbox AS (
+        INSERT INTO foody_outbox(restaurant_id, kind, payload)
+        SELECT restaurant_id, 'canceled', json_build_object('offer_id', oid, 'title', title, 'qty', qty, 'code', $1::text)
+        FROM res JOIN upd USING (id)
+    )""" if with_outbox else ""
+    return f"""
+    WITH res AS (
+        SELECT r.id, r.status, r.qty, r.created_at, o.id AS oid, o.restaurant_id, o.title,
+               o.expires_at IS NOT NULL AND o.expires_at < NOW() AS expired
+        FROM foody_reservations r JOIN foody_offers o ON o.id=r.offer_id
+        WHERE r.code=$1 FOR UPDATE OF r
+    ), upd AS (
+        UPDATE foody_reservations t SET status='canceled', canceled_at=NOW()
+        FROM res WHERE t.id=res.id AND res.status='reserved' AND NOT res.expired RETURNING t.id
+    ), back AS (
+        UPDATE foody_offers o SET qty_left=o.qty_left+res.qty
+        FROM res JOIN upd USING (id) WHERE o.id=res.oid RETURNING o.*
+    ), kpi AS (
+        {KPI_UPSERT} SELECT restaurant_id, {KPI_DAY_SQL.format(ts="created_at")}, 0, 0, 1, 0, 0
+        FROM res JOIN upd USING (id) {KPI_ON_CONFLICT}
+    ){outbox_cte}
+    SELECT status, expired, EXISTS (SELECT 1 FROM upd) AS done,
+           (SELECT count({offer_event_sql("o", op=OFFER_EVENT_OP_SQL)}) FROM back o JOIN foody_restaurants r ON r.id=o.restaurant_id) AS notified
+    FROM res"""
+
+CANCEL_SQL = {flag: cancel_sql(flag) for flag in (False, True)}
 
 @app.post("/api/v1/reservations/cancel")
 async def cancel_reservation(body: Dict[str, Any] = Body(...)):
     code = (body.get("code") or "").strip()
     if not code: raise HTTPException(422, "code required")
-    p = await pool()
-    async with p.acquire() as conn:
-        res = await conn.fetchrow("""SELECT r.*, o.expires_at, o.id as oid FROM foody_reservations r
-                                     JOIN foody_offers o ON o.id=r.offer_id WHERE r.code=$1""", code)
-        if not res: raise HTTPException(404, "Reservation not found")
-        if res["status"] != "reserved":
-            return {"ok": False, "status": res["status"]}
-        if res["expires_at"] and res["expires_at"] < dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc):
-            return {"ok": False, "status": "expired"}
-        async with conn.transaction():
-            await conn.execute("UPDATE foody_reservations SET status='canceled' WHERE id=$1", res["id"])
-            await conn.execute("UPDATE foody_offers SET qty_left=qty_left+$1 WHERE id=$2", res["qty"], res["oid"])
-        return {"ok": True, "status": "canceled"}
+    async with acquire() as conn:
+        res = await conn.fetchrow(CANCEL_SQL[outbox.ENABLED], code)
+    if not res: raise HTTPException(404, "Reservation not found")
+    if not res["done"]:
+        return {"ok": False, "status": "expired" if res["status"] == "reserved" and res["expired"] else res["status"]}
+    if not events.listening(): invalidate_feed()  # otherwise the offer event drops the affected pages
+    outbox.kick()
+    return {"ok": True, "status": "canceled"}
+
+# ---- KPI ----
+KPI_GRANULARITIES = ("day", "week", "month")
+
+def parse_day(v: Optional[str], field: str) -> Optional[dt.date]:
+    if not v: return None
+    try:
+        return dt.date.fromisoformat(v[:10])
+    except Exception:
+        raise HTTPException(422, f"{field} must be YYYY-MM-DD")
 
+def kpi_totals(r) -> Dict[str, Any]:
+    reserved, redeemed = int(r["reserved"] or 0), int(r["redeemed"] or 0)
+    return {"reserved": reserved, "redeemed": redeemed, "canceled": int(r["canceled"] or 0),
+            "redemption_rate": round(redeemed / reserved, 2) if reserved else 0.0,
+            "revenue_cents": int(r["revenue_cents"] or 0), "saved_cents": int(r["saved_cents"] or 0)}
 
-# ---- KPI stub ----
 @app.get("/api/v1/merchant/kpi")
-async def kpi(restaurant_id: str, x_foody_key: str = Header(default="")):
-    p = await pool()
-    async with p.acquire() as conn:
+async def kpi(restaurant_id: str, x_foody_key: str = Header(default=""),
+              date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to"),
+              granularity: Optional[str] = None):
+    """Totals over [from, to] (inclusive UTC days) and, with ``granularity``, a day/week/month series."""
+    if granularity is not None and granularity not in KPI_GRANULARITIES:
+        raise HTTPException(422, "granularity must be day, week or month")
+    d_from, d_to = parse_day(date_from, "from"), parse_day(date_to, "to")
+    async with acquire(read=True, restaurant_id=restaurant_id) as conn:
         rid_ok = await auth(conn, x_foody_key, restaurant_id)
         if not rid_ok:
             raise HTTPException(401, "Invalid API key or restaurant_id")
-        reserved = await conn.fetchval("""SELECT COUNT(*) FROM foody_reservations r 
-                                          JOIN foody_offers o ON o.id=r.offer_id 
-                                          WHERE o.restaurant_id=$1""", restaurant_id)
-        redeemed = await conn.fetchval("""SELECT COUNT(*) FROM foody_reservations r 
-                                          JOIN foody_offers o ON o.id=r.offer_id 
-                                          WHERE o.restaurant_id=$1 AND r.status='redeemed'""", restaurant_id)
-        revenue = await conn.fetchval("""SELECT COALESCE(SUM(o.price_cents),0) FROM foody_reservations r 
-                                         JOIN foody_offers o ON o.id=r.offer_id 
-                                         WHERE o.restaurant_id=$1 AND r.status='redeemed'""", restaurant_id)
-        rate = (redeemed / reserved) if reserved else 0.0
-        return {"reserved": reserved, "redeemed": redeemed, "redemption_rate": round(rate,2), "revenue_cents": int(revenue or 0), "saved_cents": 0}
-
-# ---- R2 presigned uploads ----
-import boto3
-R2_ENDPOINT = os.getenv("R2_ENDPOINT","").rstrip("/")
-R2_BUCKET = os.getenv("R2_BUCKET","")
-R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID","")
-R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY","")
-
-def _r2_client():
-    if not (R2_ENDPOINT and R2_BUCKET and R2_ACCESS_KEY_ID and R2_SECRET_ACCESS_KEY):
-        raise HTTPException(400, "R2 is not configured")
-    return boto3.client("s3", endpoint_url=R2_ENDPOINT, aws_access_key_id=R2_ACCESS_KEY_ID,
-                        aws_secret_access_key=R2_SECRET_ACCESS_KEY, region_name="auto")
+        # one pass over the rollup: the () grouping set is the totals row (bucket NULL)
+        rows = await conn.fetch(
+            """SELECT date_trunc($4, day::timestamp)::date AS bucket,
+                      SUM(reserved) AS reserved, SUM(redeemed) AS redeemed, SUM(canceled) AS canceled,
+                      SUM(revenue_cents) AS revenue_cents, SUM(saved_cents) AS saved_cents
+               FROM foody_kpi_daily
+               WHERE restaurant_id=$1 AND ($2::date IS NULL OR day >= $2) AND ($3::date IS NULL OR day <= $3)
+               GROUP BY GROUPING SETS ((date_trunc($4, day::timestamp)), ())
+               ORDER BY bucket NULLS FIRST""", restaurant_id, d_from, d_to, granularity or "day")
+    totals = next((r for r in rows if r["bucket"] is None), None)
+    out = kpi_totals(totals) if totals else kpi_totals({})
+    if granularity:
+        out["granularity"] = granularity
+        out["series"] = [dict(kpi_totals(r), bucket=r["bucket"].isoformat()) for r in rows if r["bucket"] is not None]
+    return out
 
+# ---- Uploads (presigned PUT; see storage.py) ----
 @app.post("/api/v1/uploads/presign")
 async def presign_upload(params: Dict[str, Any] = Body(...)):
-    filename = (params.get("filename") or "upload.bin")
-    content_type = (params.get("content_type") or "application/octet-stream")
-    ext = ""
-    if "." in filename:
-        ext = filename.rsplit(".",1)[-1].lower()
-        if len(ext) > 8: ext = ""
-    key = f"offers/{uuid.uuid4().hex}{('.'+ext) if ext else ''}"
+    item = (await storage.presign([params]))[0]
+    return {"put_url": item["put_url"], "public_url": item["public_url"], "key": item["key"]}
+
+@app.post("/api/v1/uploads/presign/batch")
+async def presign_upload_batch(body: Dict[str, Any] = Body(...)):
+    """Presigned PUTs for several photos at once: ``{"files": [{filename, content_type}, ...]}``."""
+    files = body.get("files")
+    if not isinstance(files, list) or not files or not all(isinstance(f, dict) for f in files):
+        raise HTTPException(422, "files must be a non-empty list of {filename, content_type}")
+    if len(files) > storage.PRESIGN_BATCH_MAX:
+        raise HTTPException(413, f"At most {storage.PRESIGN_BATCH_MAX} files per request")
+    return {"items": await storage.presign(files)}
+
+# ---- Photo variants (see images.py) ----
+# After the PUT, the client confirms the upload; the original is turned into WebP thumbnails
+# plus a BlurHash in a process pool. Saving an offer whose photo has no variants yet schedules
+# the same work in the background, so clients that skip the confirm still get thumbnails.
+PHOTO_ATTACH_SQL = """UPDATE foody_offers SET photo_variants=$3::jsonb, photo_blurhash=$4
+                      WHERE id=$1 AND photo_url=$2 AND photo_variants IS NULL"""
+_photo_tasks: set = set()
+
+async def photo_variants(key: str) -> Dict[str, Any]:
     try:
-        s3 = _r2_client()
-        put_url = s3.generate_presigned_url(
-            "put_object",
-            Params={"Bucket": R2_BUCKET, "Key": key, "ContentType": content_type},
-            ExpiresIn=3600
-        )
-        public_url = f"{R2_ENDPOINT}/{R2_BUCKET}/{key}"
-        return {"put_url": put_url, "public_url": public_url, "key": key}
+        return await images.variants_for(key)
+    except FileNotFoundError:
+        raise HTTPException(404, "Upload not found")
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(500, f"Cannot presign: {e}")
-
-# ---- Seed ----
-TEST_RID = "RID_TEST"
-TEST_KEY = "KEY_TEST"
-
-async def seed_if_needed(conn: asyncpg.Connection):
-    cnt = await conn.fetchval("SELECT COUNT(*) FROM foody_restaurants")
-    has_test = await conn.fetchrow("SELECT id FROM foody_restaurants WHERE id=$1", TEST_RID)
-    if cnt and has_test: return
-    if cnt and not has_test:
-        try: await conn.execute("TRUNCATE foody_reservations RESTART IDENTITY CASCADE")
-        except Exception: pass
-        try: await conn.execute("TRUNCATE foody_offers RESTART IDENTITY CASCADE")
-        except Exception: pass
-        try: await conn.execute("TRUNCATE foody_restaurants RESTART IDENTITY CASCADE")
-        except Exception: pass
-    await conn.execute(
-        "INSERT INTO foody_restaurants(id, api_key, title, phone, city, address, geo, lat, lon) VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9)",
-        TEST_RID, TEST_KEY, "Пекарня №1", "+7 900 000-00-00", "Москва", "ул. Пекарная, 10", "55.7558,37.6173", 55.7558, 37.6173
-    )
-    now = dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
-    def exp(minutes): return now + dt.timedelta(minutes=minutes)
-    demo = [
-        ("Эклеры", "Набор свежих эклеров", 19900, 34900, 5, 5, exp(110), None),
-        ("Пирожки", "Пирожки с мясом", 14900, 29900, 8, 8, exp(55), None),
-        ("Круассаны", "Круассаны с маслом", 9900, 32900, 6, 6, exp(25), None),
-    ]
-    for title, desc, price, orig, qty_left, qty_total, expires, photo in demo:
-        await conn.execute(
-            """INSERT INTO foody_offers(id, restaurant_id, title, description, price_cents, original_price_cents,
-                                        qty_left, qty_total, expires_at, photo_url)
-               VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)""",
-            offid(), TEST_RID, title, desc, price, orig, qty_left, qty_total, expires, photo
-        )
+        raise HTTPException(422, f"Cannot process image: {e}")
 
-# uvicorn main:app --host 0.0.0.0 --port 8080
+async def attach_photo(offer_id: str, url: str, key: str) -> None:
+    try:
+        out = await images.variants_for(key)
+        async with acquire() as conn:
+            async with conn.transaction():
+                done = await conn.execute(PHOTO_ATTACH_SQL, offer_id, url, json.dumps(out["variants"]), out["blurhash"])
+                if done.endswith(" 1"):
+                    await publish_offers(conn, [offer_id])
+        invalidate_feed()
+    except Exception as e:
+        print("IMAGE WARN:", offer_id, repr(e))
 
-@app.get("/api/v1/reservations/qr")
-async def reservation_qr(code: str):
-    if not code: raise HTTPException(422, "code required")
-    return {"qrcode_png_base64": make_qr_png_b64(code)}
+def schedule_photo_variants(offers: Iterable[Dict[str, Any]]) -> None:
+    """Background variant generation for saved offers whose own-storage photo has none yet."""
+    for o in offers:
+        key = storage.key_for_url(o.get("photo_url")) if not o.get("photo_variants") else None
+        if key and not images.is_variant_key(key):
+            task = asyncio.create_task(attach_photo(o["id"], o["photo_url"], key))
+            _photo_tasks.add(task)
+            task.add_done_callback(_photo_tasks.discard)
 
-# === DEV-ONLY merchant recovery by phone (guarded by RECOVERY_SECRET) ===
-@app.post("/api/v1/merchant/recover")
-async def merchant_recover(body: Dict[str, Any] = Body(...)):
-    secret = os.getenv("RECOVERY_SECRET", "")
-    if not secret:
-        raise HTTPException(503, "Recovery is not enabled")
-    if (body.get("secret") or "") != secret:
-        raise HTTPException(403, "Forbidden")
-    phone = (body.get("phone") or "").strip()
-    if not phone:
-        raise HTTPException(422, "phone required")
-    p = await pool()
-    async with p.acquire() as conn:
-        r = await conn.fetchrow("SELECT id, api_key, title FROM foody_restaurants WHERE phone=$1 ORDER BY created_at DESC LIMIT 1", phone)
-        if not r:
-            raise HTTPException(404, "Not found")
-        return {"restaurant_id": r["id"], "api_key": r["api_key"], "title": r["title"]}
+@app.post("/api/v1/uploads/confirm")
+async def confirm_upload(body: Dict[str, Any] = Body(...), x_foody_key: str = Header(default="")):
+    """``{key | public_url, restaurant_id[, offer_id]}`` -> variants; with an offer, also sets its photo."""
+    key = (body.get("key") or "").strip() or storage.key_for_url(body.get("public_url"))
+    if not key or not key.startswith("offers/") or ".." in key:
+        raise HTTPException(422, "key or public_url of an upload is required")
+    if images.is_variant_key(key):
+        raise HTTPException(422, "key is a generated variant, not an upload")
+    rid_in = (body.get("restaurant_id") or "").strip()
+    offer_id = (body.get("offer_id") or "").strip()
+    # Auth and ownership before the image work, so a bad key or a foreign offer costs no processing.
+    async with acquire() as conn:
+        if not rid_in or not await auth(conn, x_foody_key, rid_in):
+            raise HTTPException(401, "Invalid API key or restaurant_id")
+        if offer_id and not await conn.fetchval("SELECT 1 FROM foody_offers WHERE id=$1 AND restaurant_id=$2", offer_id, rid_in):
+            raise HTTPException(404, "Offer not found")
+    out = await photo_variants(key)
+    if not offer_id:
+        return {"key": key, "photo_url": storage.public_url(key), **out}
+    async with acquire() as conn:
+        async with conn.transaction():
+            r = await conn.fetchrow(
+                """UPDATE foody_offers SET photo_url=$3, photo_variants=$4::jsonb, photo_blurhash=$5
+                   WHERE id=$1 AND restaurant_id=$2 RETURNING *""",
+                offer_id, rid_in, storage.public_url(key), json.dumps(out["variants"]), out["blurhash"])
+            if not r: raise HTTPException(404, "Offer not found")
+            await publish_offers(conn, [offer_id])
+    db.pin(rid_in)
+    invalidate_feed()
+    return {"key": key, "photo_url": r["photo_url"], **out, "offer": row_offer(r)}
 
+@app.put(storage.LOCAL_PREFIX + "{key:path}")
+async def local_upload(key: str, request: Request, ct: str = "", exp: int = 0, sig: str = ""):
+    """Upload target for STORAGE_BACKEND=local presigned URLs."""
+    if storage.STORAGE_BACKEND != "local": raise HTTPException(404, "Not found")
+    if exp < time.time() or not secrets.compare_digest(sig, storage.local_signature(key, ct, exp)):
+        raise HTTPException(403, "Invalid or expired upload URL")
+    if (request.headers.get("content-type") or "application/octet-stream") != ct:
+        raise HTTPException(400, "Content-Type does not match the signed URL")
+    data = await request.body()
+    if len(data) > storage.STORAGE_MAX_BYTES: raise HTTPException(413, "File too large")
+    await asyncio.get_running_loop().run_in_executor(None, storage.write, key, data, ct)
+    return Response(status_code=200)
 
-# === DEV-ONLY merchant recovery by phone (guarded by RECOVERY_SECRET) ===
-from typing import Any, Dict
-import os as _os
-import datetime as _dt
+@app.get(storage.LOCAL_PREFIX + "{key:path}")
+async def local_file(key: str):
+    if storage.STORAGE_BACKEND != "local": raise HTTPException(404, "Not found")
+    path = storage.local_path(key)
+    if not os.path.isfile(path): raise HTTPException(404, "Not found")
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=86400, immutable"})
+
+# uvicorn main:app --host 0.0.0.0 --port 8080
 
+# === DEV-ONLY merchant recovery by phone (guarded by RECOVERY_SECRET) ===
 @app.post("/api/v1/merchant/recover")
 async def merchant_recover(body: Dict[str, Any] = Body(...)):
-    secret = _os.getenv("RECOVERY_SECRET", "")
+    secret = os.getenv("RECOVERY_SECRET", "")
     if not secret:
         raise HTTPException(503, "Recovery is not enabled")
     if (body.get("secret") or "") != secret:
@@ -555,31 +1225,41 @@ async def merchant_recover(body: Dict[str, Any] = Body(...)):
     phone = (body.get("phone") or "").strip()
     if not phone:
         raise HTTPException(422, "phone required")
-    p = await pool()
-    async with p.acquire() as conn:
+    async with acquire() as conn:
         r = await conn.fetchrow("SELECT id, api_key, title FROM foody_restaurants WHERE phone=$1 ORDER BY created_at DESC LIMIT 1", phone)
         if not r:
             raise HTTPException(404, "Not found")
-        return {"restaurant_id": r["id"], "api_key": r["api_key"], "title": r["title"]}
+    invalidate_auth(r["api_key"], r["id"])
+    return {"restaurant_id": r["id"], "api_key": r["api_key"], "title": r["title"]}
 
-# ---- Reservations + QR ----
-def make_qr_png_b64(text: str) -> str:
-    # Minimal inline QR using segno if available, else a tiny placeholder
-    try:
-        import base64, io, segno
-        buf = io.BytesIO()
-        segno.make(text, micro=False).save(buf, kind="png", scale=5)
-        return base64.b64encode(buf.getvalue()).decode("ascii")
-    except Exception:
-        # Fallback: return a tiny 1x1 png
-        import base64
-        return "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg=="
 
 @app.get("/api/v1/reservations/qr")
-async def reservation_qr(code: str):
+async def reservation_qr(code: str, format: str = "b64"):
+    """QR for a reservation code: base64 PNG in JSON (default), or raw ``png``/``svg`` bytes."""
     if not code:
         raise HTTPException(422, "code required")
-    return {"qrcode_png_base64": make_qr_png_b64(code)}
+    if format == "b64":
+        return {"qrcode_png_base64": await make_qr_png_b64(code)}
+    if format not in QR_KINDS:
+        raise HTTPException(422, "format must be b64, png or svg")
+    return Response(await qr_image(code, format), media_type=QR_KINDS[format],
+                    headers={"Cache-Control": "public, max-age=86400, immutable"})
+
+# cache counters, rendered from the caches themselves at scrape time
+CACHES = {"feed": _feed_cache, "auth": _auth_cache, "qr": _qr_cache}
+metrics.Counter("foody_cache_hits_total", "Cache hits", ["cache"], fn=lambda: {(n,): c.hits for n, c in CACHES.items()})
+metrics.Counter("foody_cache_misses_total", "Cache misses", ["cache"], fn=lambda: {(n,): c.misses for n, c in CACHES.items()})
+metrics.Gauge("foody_cache_entries", "Cache entries", ["cache"], fn=lambda: {(n,): len(c) for n, c in CACHES.items()})
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/internal/stats")
+async def internal_stats():
+    return {"feed_cache": dict(_feed_cache.stats(), version=_feed_version), "auth_cache": _auth_cache.stats(),
+            "qr_cache": _qr_cache.stats(), "read_replica": db.replica_status(),
+            "hot_offers": hot_offers()}
 
 @app.post('/internal/notify')
 async def internal_notify(body: Dict[str, Any] = Body(...)):
@@ -588,11 +1268,3 @@ async def internal_notify(body: Dict[str, Any] = Body(...)):
     return {'ok': True}
 
 
-async def notify_bot(text: str):
-    if not BOT_NOTIFY_URL: return
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            headers = {'x-foody-secret': BOT_NOTIFY_SECRET} if BOT_NOTIFY_SECRET else {}
-            await client.post(BOT_NOTIFY_URL, headers=headers, json={'text': text})
-    except Exception as e:
-        print("notify_bot warn:", repr(e))
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""Minimal Prometheus text-format metrics: counters, gauges and histograms.
+
+Kept dependency-free on purpose; values live in process memory and are rendered
+by ``render()`` for the backend's ``/metrics`` endpoint.
+"""
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List["_Metric"] = []
+
+def _esc(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(v: float) -> str:
+    if v == float("inf"): return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], Any]] = None):
+        self.name, self.help, self.labelnames, self.fn = name, help, tuple(labels), fn
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Iterable[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+    def _current(self) -> Dict[Tuple[str, ...], Any]:
+        if self.fn is None:
+            return self.values
+        v = self.fn()
+        return v if isinstance(v, dict) else {(): v}
+
+    def samples(self):
+        for key, v in self._current().items():
+            yield self.name + self._labels(key), v
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        k = self._key(labels)
+        self.values[k] = self.values.get(k, 0.0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        k = self._key(labels)
+        self.values[k] = self.values.get(k, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        k = self._key(labels)
+        st = self.values.get(k)
+        if st is None:
+            st = self.values[k] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        st[0][bisect_left(self.buckets, value)] += 1
+        st[1] += value
+        st[2] += 1
+
+    def snapshot(self, **labels) -> Dict[str, float]:
+        st = self.values.get(self._key(labels))
+        return {"count": st[2], "sum": st[1]} if st else {"count": 0, "sum": 0.0}
+
+    def samples(self):
+        for key, (counts, total, n) in self.values.items():
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                yield self.name + "_bucket" + self._labels(key, [("le", _num(le))]), acc
+            yield self.name + "_sum" + self._labels(key), total
+            yield self.name + "_count" + self._labels(key), n
+
+def render() -> str:
+    lines: List[str] = []
+    for m in REGISTRY:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for name, v in m.samples():
+            lines.append(f"{name} {_num(v)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,215 @@
+"""Durable merchant notifications: a foody_outbox table drained by a background dispatcher.
+
+Request handlers only insert a row (in the same statement/transaction as the change), so a
+reservation never waits on the bot or Telegram. The dispatcher claims due rows with a lease
+(``FOR UPDATE SKIP LOCKED``, safe across replicas), folds each restaurant's events into one
+message, paces sends with a token bucket plus a per-chat minimum interval, and retries
+failures with exponential backoff (honouring the bot's 429 ``retry_after``).
+"""
+import os, html, json, time, random, asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+from db import acquire
+
+BOT_NOTIFY_URL = os.getenv("BOT_NOTIFY_URL", "").strip()
+BOT_NOTIFY_SECRET = os.getenv("BOT_NOTIFY_SECRET", "").strip()
+ENABLED = bool(BOT_NOTIFY_URL)
+
+OUTBOX_INTERVAL_S = float(os.getenv("OUTBOX_INTERVAL_S", "2"))     # poll period when idle
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))
+OUTBOX_LEASE_S = int(os.getenv("OUTBOX_LEASE_S", "30"))             # claimed rows are retried after this if we die
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))                 # messages/s overall (Telegram allows ~30)
+OUTBOX_CHAT_INTERVAL_S = float(os.getenv("OUTBOX_CHAT_INTERVAL_S", "1"))  # per restaurant chat
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_MAX_S = 600
+OUTBOX_MAX_LINES = 20  # per message; the rest is summarized
+
+SENT = metrics.Counter("foody_outbox_messages_total", "Bot messages by result", ["result"])
+EVENTS_DELIVERED = metrics.Counter("foody_outbox_events_total", "Outbox events by final state", ["state"])
+DELIVERY_LAG = metrics.Histogram("foody_outbox_lag_seconds", "Time from enqueue to delivery",
+                                 buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 1800))
+
+# handlers add this as a CTE / statement next to their write; $1 restaurant_id, $2 kind, $3 payload json
+ENQUEUE_SQL = "INSERT INTO foody_outbox(restaurant_id, kind, payload) VALUES($1, $2, $3::jsonb)"
+
+CLAIM_SQL = """
+    UPDATE foody_outbox o SET next_attempt_at = NOW() + make_interval(secs => $2)
+    FROM (SELECT id FROM foody_outbox
+          WHERE status='pending' AND next_attempt_at <= NOW()
+          ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED) due
+    WHERE o.id = due.id
+    RETURNING o.id, o.restaurant_id, o.kind, o.payload, o.attempts, o.created_at,
+              (SELECT telegram_chat_id FROM foody_restaurants r WHERE r.id = o.restaurant_id) AS chat_id"""
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``burst`` saved up."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.t = burst, time.monotonic()
+
+    async def take(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+LINES = {
+    "reserved": "🛒 Бронь: {title} × {qty} (код {code})",
+    "canceled": "↩️ Отмена брони: {title} × {qty} (код {code})",
+    "unlinked": "🔕 Чат отвязан от ресторана, уведомления сюда больше не придут",
+}
+
+def render(events: List[Dict[str, Any]]) -> str:
+    # the bot sends HTML: merchant titles and codes must not be read as markup
+    lines = [LINES.get(e["kind"], "{kind}").format_map(
+                 {k: html.escape(str(v)) for k, v in dict(e["payload"], kind=e["kind"]).items()}) for e in events]
+    if len(lines) > OUTBOX_MAX_LINES:
+        lines = lines[:OUTBOX_MAX_LINES] + [f"… и ещё {len(lines) - OUTBOX_MAX_LINES}"]
+    return "\n".join(lines)
+
+def backoff_s(attempts: int) -> float:
+    return min(OUTBOX_BACKOFF_MAX_S, 2 ** attempts) * random.uniform(0.8, 1.2)
+
+_client = None  # httpx.AsyncClient; httpx is imported on first use, only with BOT_NOTIFY_URL set
+_bucket = TokenBucket(OUTBOX_RATE, max(1.0, OUTBOX_RATE))
+_last_sent: Dict[str, float] = {}
+_kick = asyncio.Event()
+_task: Optional[asyncio.Task] = None
+
+def client():
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=3.0),
+                                    limits=httpx.Limits(max_connections=OUTBOX_CONCURRENCY, max_keepalive_connections=OUTBOX_CONCURRENCY),
+                                    headers={"x-foody-secret": BOT_NOTIFY_SECRET} if BOT_NOTIFY_SECRET else {})
+    return _client
+
+def kick() -> None:
+    """Wake the dispatcher now instead of at the next poll (call after enqueueing)."""
+    _kick.set()
+
+async def _send(restaurant_id: str, events: List[Dict[str, Any]]) -> Tuple[str, Optional[float], str]:
+    """(result, retry_after_s, error) where result is sent | dropped | dead | retry."""
+    import httpx
+    await _bucket.take()
+    # an unlink notice goes to the chat it left; anything else to the restaurant's linked chat
+    # as of the claim, or none at all (the bot then falls back to its admin chat)
+    unlinked = events[0]["kind"] == "unlinked"
+    if unlinked:
+        chat_id = next((e["payload"].get("chat_id") for e in events if e["payload"].get("chat_id")), None)
+    else:
+        chat_id = next((e["chat_id"] for e in events if e["chat_id"]), None)
+    try:
+        r = await client().post(BOT_NOTIFY_URL, json={"restaurant_id": restaurant_id, "chat_id": chat_id,
+                                                      "text": render(events), "events": len(events),
+                                                      **({"unlinked": True} if unlinked else {})})
+    except httpx.HTTPError as e:
+        return "retry", None, repr(e)
+    if r.status_code == 429:
+        try: retry_after = float(r.json().get("retry_after") or r.headers.get("retry-after") or 1)
+        except Exception: retry_after = 1.0
+        return "retry", retry_after, "429 rate limited"
+    if r.status_code >= 500 or r.status_code == 408:
+        return "retry", None, f"HTTP {r.status_code}"
+    if r.status_code in (401, 403):
+        # wrong shared secret, revoked token, bot blocked: no retry will fix it, so fail it now
+        return "dead", None, f"HTTP {r.status_code}"
+    try: body = r.json()
+    except ValueError: body = {}
+    if r.status_code == 200 and body.get("ok", True):
+        return "sent", None, ""
+    # the bot understood us but cannot deliver (no chat linked, bad request): retrying won't help
+    return "dropped", None, str(body.get("reason") or body.get("detail") or f"HTTP {r.status_code}")[:500]
+
+async def dispatch_once() -> int:
+    """Claim and deliver one batch of due events; returns how many were claimed."""
+    async with acquire() as conn:
+        rows = await conn.fetch(CLAIM_SQL, OUTBOX_BATCH, float(OUTBOX_LEASE_S))
+    if not rows:
+        return 0
+    groups: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+    for r in rows:
+        payload = json.loads(r["payload"]) if isinstance(r["payload"], str) else r["payload"]
+        groups.setdefault(r["restaurant_id"] or "", []).append(
+            {"id": r["id"], "kind": r["kind"], "payload": payload, "attempts": r["attempts"], "created_at": r["created_at"],
+             "chat_id": r["chat_id"]})
+    now = time.monotonic()
+    deferred: List[Tuple[List[int], float]] = []
+    ready = []
+    for restaurant_id, evs in groups.items():
+        wait = _last_sent.get(restaurant_id, 0) + OUTBOX_CHAT_INTERVAL_S - now
+        if wait > 0:
+            deferred.append(([e["id"] for e in evs], wait))
+        else:
+            _last_sent[restaurant_id] = now
+            # unlink notices travel on their own, so the rest of the batch keeps its routing
+            for part in ([e for e in evs if e["kind"] == "unlinked"], [e for e in evs if e["kind"] != "unlinked"]):
+                if part: ready.append((restaurant_id, part))
+    sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    async def one(restaurant_id, evs):
+        async with sem:
+            return await _send(restaurant_id, evs)
+    results = await asyncio.gather(*(one(rid, evs) for rid, evs in ready))
+    async with acquire() as conn:
+        for ids, wait in deferred:
+            await conn.execute("UPDATE foody_outbox SET next_attempt_at = NOW() + make_interval(secs => $2) WHERE id = ANY($1::bigint[])",
+                               ids, wait)
+        for (restaurant_id, evs), (result, retry_after, error) in zip(ready, results):
+            ids = [e["id"] for e in evs]
+            SENT.inc(result=result)
+            if result in ("sent", "dropped"):
+                await conn.execute("UPDATE foody_outbox SET status=$2, sent_at=NOW(), last_error=NULLIF($3, '') WHERE id = ANY($1::bigint[])",
+                                   ids, result, error)
+                EVENTS_DELIVERED.inc(len(ids), state=result)
+                if result == "sent":
+                    for e in evs: DELIVERY_LAG.observe(max(0.0, time.time() - e["created_at"].timestamp()))
+                continue
+            attempts = max(e["attempts"] for e in evs) + 1
+            dead = result == "dead" or attempts >= OUTBOX_MAX_ATTEMPTS
+            await conn.execute(
+                """UPDATE foody_outbox SET attempts=attempts+1, last_error=$2, status=$3,
+                          next_attempt_at = NOW() + make_interval(secs => $4) WHERE id = ANY($1::bigint[])""",
+                ids, error, "dead" if dead else "pending", retry_after if retry_after is not None else backoff_s(attempts))
+            if dead:
+                EVENTS_DELIVERED.inc(len(ids), state="dead")
+                print("OUTBOX dead:", restaurant_id, error)
+    return len(rows)
+
+async def _loop():
+    while True:
+        n = 0
+        try:
+            n = await dispatch_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("OUTBOX WARN:", repr(e))
+        if n < OUTBOX_BATCH:
+            try: await asyncio.wait_for(_kick.wait(), OUTBOX_INTERVAL_S)
+            except asyncio.TimeoutError: pass
+            _kick.clear()
+
+def start() -> None:
+    global _task
+    if ENABLED and _task is None:
+        _task = asyncio.create_task(_loop())
+
+async def stop() -> None:
+    global _task, _client
+    if _task is not None:
+        _task.cancel()
+        try: await _task
+        except asyncio.CancelledError: pass
+        _task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
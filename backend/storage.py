@@ -0,0 +1,125 @@
+"""Upload storage: presigned PUT URLs for offer photos, plus server-side read/write.
+
+``STORAGE_BACKEND=r2`` (default) signs against any S3-compatible endpoint -- Cloudflare R2 in
+production, MinIO locally -- with one boto3 client built on first use and shared afterwards.
+Signing is local CPU work, so it runs in a thread instead of on the event loop.
+
+``STORAGE_BACKEND=local`` keeps files under ``STORAGE_LOCAL_DIR`` and hands out HMAC-signed
+URLs to the backend's own ``/api/v1/uploads/local/...`` route, for offline development.
+"""
+import os, hmac, time, uuid, asyncio, hashlib, secrets, threading
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote, unquote, urlencode
+
+from fastapi import HTTPException
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "r2").strip().lower()
+PRESIGN_EXPIRES_S = int(os.getenv("PRESIGN_EXPIRES_S", "3600"))
+PRESIGN_BATCH_MAX = int(os.getenv("PRESIGN_BATCH_MAX", "10"))
+
+R2_ENDPOINT = os.getenv("R2_ENDPOINT", "").rstrip("/")
+R2_BUCKET = os.getenv("R2_BUCKET", "")
+R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID", "")
+R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY", "")
+R2_PUBLIC_URL = os.getenv("R2_PUBLIC_URL", "").rstrip("/")  # public bucket domain, if any
+
+STORAGE_LOCAL_DIR = os.path.abspath(os.getenv("STORAGE_LOCAL_DIR", "uploads"))
+STORAGE_LOCAL_BASE = os.getenv("STORAGE_LOCAL_BASE", "").rstrip("/")  # absolute base for returned URLs
+STORAGE_MAX_BYTES = int(os.getenv("STORAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+# must be shared by all workers in production; a random default only suits a single dev process
+STORAGE_SECRET = (os.getenv("STORAGE_SECRET") or secrets.token_hex(16)).encode("utf-8")
+LOCAL_PREFIX = "/api/v1/uploads/local/"
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+def s3_client():
+    """The process-wide boto3 S3 client (boto3 is imported on first use)."""
+    global _s3
+    if _s3 is None:
+        with _s3_lock:
+            if _s3 is None:
+                if not (R2_ENDPOINT and R2_BUCKET and R2_ACCESS_KEY_ID and R2_SECRET_ACCESS_KEY):
+                    raise HTTPException(400, "R2 is not configured")
+                import boto3
+                from botocore.config import Config
+                _s3 = boto3.client("s3", endpoint_url=R2_ENDPOINT, aws_access_key_id=R2_ACCESS_KEY_ID,
+                                   aws_secret_access_key=R2_SECRET_ACCESS_KEY, region_name="auto",
+                                   config=Config(signature_version="s3v4", s3={"addressing_style": "path"}))
+    return _s3
+
+def new_key(filename: Optional[str]) -> str:
+    filename = filename or "upload.bin"
+    ext = ""
+    if "." in filename:
+        ext = filename.rsplit(".", 1)[-1].lower()
+        if len(ext) > 8 or not ext.isalnum(): ext = ""
+    return f"offers/{uuid.uuid4().hex}{('.' + ext) if ext else ''}"
+
+def public_url(key: str) -> str:
+    if STORAGE_BACKEND == "local":
+        return f"{STORAGE_LOCAL_BASE}{LOCAL_PREFIX}{quote(key)}"
+    return f"{R2_PUBLIC_URL}/{key}" if R2_PUBLIC_URL else f"{R2_ENDPOINT}/{R2_BUCKET}/{key}"
+
+def key_for_url(url: Optional[str]) -> Optional[str]:
+    """Storage key of one of our own uploads, or None for foreign/unknown URLs."""
+    if not url:
+        return None
+    base = public_url("")
+    if not url.startswith(base) or "?" in url:
+        return None
+    key = unquote(url[len(base):])
+    return key if key.startswith("offers/") and ".." not in key else None
+
+def read(key: str) -> bytes:
+    """Stored object bytes (blocking: call from a thread)."""
+    if STORAGE_BACKEND == "local":
+        with open(local_path(key), "rb") as f:
+            return f.read(STORAGE_MAX_BYTES + 1)
+    return s3_client().get_object(Bucket=R2_BUCKET, Key=key)["Body"].read()
+
+def write(key: str, data: bytes, content_type: str) -> None:
+    """Store ``data`` under ``key`` (blocking: call from a thread)."""
+    if STORAGE_BACKEND == "local":
+        path = local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return
+    s3_client().put_object(Bucket=R2_BUCKET, Key=key, Body=data, ContentType=content_type,
+                           CacheControl="public, max-age=31536000, immutable")
+
+def local_signature(key: str, content_type: str, expires: int) -> str:
+    msg = f"PUT\n{key}\n{content_type}\n{expires}".encode("utf-8")
+    return hmac.new(STORAGE_SECRET, msg, hashlib.sha256).hexdigest()
+
+def local_path(key: str) -> str:
+    path = os.path.abspath(os.path.join(STORAGE_LOCAL_DIR, key))
+    if not path.startswith(STORAGE_LOCAL_DIR + os.sep):
+        raise HTTPException(404, "Not found")
+    return path
+
+def _presign_one(key: str, content_type: str) -> Dict[str, Any]:
+    if STORAGE_BACKEND == "local":
+        expires = int(time.time()) + PRESIGN_EXPIRES_S
+        qs = urlencode({"ct": content_type, "exp": expires, "sig": local_signature(key, content_type, expires)})
+        put_url = f"{STORAGE_LOCAL_BASE}{LOCAL_PREFIX}{quote(key)}?{qs}"
+    else:
+        put_url = s3_client().generate_presigned_url(
+            "put_object", Params={"Bucket": R2_BUCKET, "Key": key, "ContentType": content_type},
+            ExpiresIn=PRESIGN_EXPIRES_S)
+    return {"put_url": put_url, "public_url": public_url(key), "key": key, "content_type": content_type}
+
+def _presign_many(files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [_presign_one(new_key(f.get("filename")), f.get("content_type") or "application/octet-stream") for f in files]
+
+async def presign(files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Presigned PUTs for ``files`` ({filename, content_type}), signed off the event loop in one hop."""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, _presign_many, files)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Cannot presign: {e}")
@@ -0,0 +1,104 @@
+"""Background sweeper: archives expired offers and expires reservations left on them.
+
+It also purges delivered outbox rows and reservation idempotency keys past their retention.
+
+Each pass claims rows in batches with ``FOR UPDATE SKIP LOCKED``, so several replicas can
+run it at once without blocking each other or handling the same row twice.
+"""
+import os, asyncio
+from typing import Optional
+
+import metrics
+from db import acquire
+
+SWEEP_ENABLED = os.getenv("SWEEPER", "1").lower() in ("1", "true", "yes", "on")
+SWEEP_INTERVAL_S = float(os.getenv("SWEEP_INTERVAL_S", "30"))
+SWEEP_BATCH = int(os.getenv("SWEEP_BATCH", "500"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+IDEMPOTENCY_TTL_H = int(os.getenv("IDEMPOTENCY_TTL_H", "24"))
+
+SWEPT = metrics.Counter("foody_sweeper_rows_total", "Rows changed by the expiry sweeper", ["kind"])
+SWEEP_ERRORS = metrics.Counter("foody_sweeper_errors_total", "Failed sweeper passes")
+
+# reservations first: they are found through the offer's expiry, whatever its archived state.
+# Driven from the open reservations (partial index) with a primary-key lookup per offer, so the
+# expired offer history is never scanned.
+EXPIRE_RESERVATIONS = """
+    WITH due AS (
+        SELECT r.id FROM foody_reservations r
+        WHERE r.status='reserved'
+          AND (SELECT o.expires_at FROM foody_offers o WHERE o.id=r.offer_id) <= NOW()
+        LIMIT $1 FOR UPDATE OF r SKIP LOCKED
+    )
+    UPDATE foody_reservations r SET status='expired' FROM due WHERE r.id=due.id"""
+
+ARCHIVE_OFFERS = """
+    UPDATE foody_offers SET archived_at=expires_at
+    WHERE id IN (SELECT id FROM foody_offers
+                 WHERE archived_at IS NULL AND expires_at <= NOW()
+                 ORDER BY expires_at LIMIT $1 FOR UPDATE SKIP LOCKED)"""
+
+PURGE_OUTBOX = f"""
+    WITH old AS (
+        SELECT id FROM foody_outbox
+        WHERE status<>'pending' AND created_at < NOW() - interval '{OUTBOX_RETENTION_DAYS} days'
+        LIMIT $1 FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM foody_outbox o USING old WHERE o.id=old.id"""
+
+PURGE_IDEMPOTENCY = f"""
+    WITH old AS (
+        SELECT key FROM foody_idempotency
+        WHERE created_at < NOW() - interval '{IDEMPOTENCY_TTL_H} hours'
+        LIMIT $1 FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM foody_idempotency i USING old WHERE i.key=old.key"""
+
+def _count(status: str) -> int:
+    # "UPDATE 123" / "DELETE 123"
+    try: return int(status.rsplit(" ", 1)[-1])
+    except ValueError: return 0
+
+async def _drain(kind: str, sql: str) -> int:
+    total = 0
+    while True:
+        async with acquire() as conn:
+            n = _count(await conn.execute(sql, SWEEP_BATCH))
+        total += n
+        SWEPT.inc(n, kind=kind)
+        if n < SWEEP_BATCH:
+            return total
+
+async def sweep_once() -> dict:
+    return {"reservations_expired": await _drain("reservation", EXPIRE_RESERVATIONS),
+            "offers_archived": await _drain("offer", ARCHIVE_OFFERS),
+            "outbox_purged": await _drain("outbox", PURGE_OUTBOX),
+            "idempotency_purged": await _drain("idempotency", PURGE_IDEMPOTENCY)}
+
+async def _loop():
+    while True:
+        try:
+            done = await sweep_once()
+            if any(done.values()):
+                print("SWEEP:", done)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            SWEEP_ERRORS.inc()
+            print("SWEEP WARN:", repr(e))
+        await asyncio.sleep(SWEEP_INTERVAL_S)
+
+_task: Optional[asyncio.Task] = None
+
+def start() -> None:
+    global _task
+    if SWEEP_ENABLED and _task is None:
+        _task = asyncio.create_task(_loop())
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try: await _task
+        except asyncio.CancelledError: pass
+        _task = None
@@ -0,0 +1,50 @@
+"""Shared helpers for the backend benchmarks: an app client and latency summaries."""
+import os, sys, json, time, asyncio, contextlib
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+TEST_RID = "RID_TEST"
+TEST_KEY = "KEY_TEST"
+
+def percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    if not samples_ms:
+        return {"n": 0}
+    xs = sorted(samples_ms)
+    def pct(p): return round(xs[min(len(xs)-1, int(round(p/100.0*(len(xs)-1))))], 3)
+    return {"n": len(xs), "mean": round(sum(xs)/len(xs), 3), "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": round(xs[-1], 3)}
+
+@contextlib.asynccontextmanager
+async def app_client(base_url: Optional[str] = None):
+    """HTTP client against ``base_url``, or against the backend app in-process (needs DATABASE_URL)."""
+    import httpx
+    if base_url:
+        async with httpx.AsyncClient(base_url=base_url.rstrip("/"), timeout=60) as c:
+            yield c
+        return
+    os.environ.setdefault("RUN_MIGRATIONS", "1")
+    os.environ.setdefault("SEED_DEMO", "1")  # RID_TEST / KEY_TEST
+    import main
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=60) as c:
+            await wait_ready(c)
+            yield c
+
+async def wait_ready(c, timeout: float = 60.0) -> float:
+    """Poll /ready until the app has finished warming up; returns the seconds waited."""
+    t0 = time.perf_counter()
+    while (await c.get("/ready")).status_code != 200:
+        if time.perf_counter() - t0 > timeout:
+            raise RuntimeError(f"backend not ready after {timeout}s: {(await c.get('/ready')).json()}")
+        await asyncio.sleep(0.02)
+    return time.perf_counter() - t0
+
+class Timer:
+    def __enter__(self):
+        self.t0 = time.perf_counter(); return self
+    def __exit__(self, *exc):
+        self.ms = (time.perf_counter() - self.t0) * 1000
+
+def report(name: str, payload: Dict) -> None:
+    print(json.dumps(dict(benchmark=name, **payload), ensure_ascii=False, indent=2))
@@ -0,0 +1,132 @@
+"""Assert that the backend's hot queries are planned on the indexes the migrations create.
+
+Inside a transaction that is rolled back, it first loads a production-shaped history (--restaurants
+restaurants, --history expired and archived offers with finished reservations, a few live offers
+and open reservations) and ANALYZEs it. Each query is then EXPLAINed with ``enable_seqscan`` off,
+and the check fails if the plan does not touch one of the expected indexes, or if it still scans
+a whole history table (no usable index at all). With default settings the planner's choice
+between index and scan flips with the size of the loaded history, so only the sweeper statements,
+whose shape makes the index the cheap path at any size, are also checked with the defaults.
+Feed queries are built by ``main.fetch_active_offers`` itself; they are also checked with
+``enable_sort`` off, to show the keyset index serves each order.
+
+    python bench/explain_check.py --history 200000
+"""
+import os, sys, asyncio, argparse, datetime as dt
+from typing import List, Tuple
+
+import common  # noqa: F401  (puts backend/ on sys.path)
+
+import asyncpg
+
+# (name, sql, args, indexes any of which should appear in the plan)
+CHECKS: List[Tuple[str, str, tuple, Tuple[str, ...]]] = [
+    ("merchant offers", "SELECT * FROM foody_offers WHERE restaurant_id=$1 ORDER BY created_at DESC",
+     (common.TEST_RID,), ("foody_offers_restaurant_created_idx", "foody_offers_active_restaurant_idx")),
+    ("merchant active offers",
+     "SELECT * FROM foody_offers WHERE restaurant_id=$1 AND (archived_at IS NULL) AND (expires_at IS NULL OR expires_at > NOW()) "
+     "AND (qty_left IS NULL OR qty_left > 0) ORDER BY created_at DESC",
+     (common.TEST_RID,), ("foody_offers_active_restaurant_idx",)),
+    ("auth by api key", "SELECT id FROM foody_restaurants WHERE api_key=$1", (common.TEST_KEY,), ("foody_restaurants_api_key_idx",)),
+    ("recover by phone", "SELECT id, api_key, title FROM foody_restaurants WHERE phone=$1 ORDER BY created_at DESC LIMIT 1",
+     ("+70000000000",), ("foody_restaurants_phone_idx",)),
+    ("kpi rollup", "SELECT SUM(reserved) FROM foody_kpi_daily WHERE restaurant_id=$1 AND day >= $2::date",
+     (common.TEST_RID, dt.date(2024, 1, 1)), ("foody_kpi_daily_pkey",)),
+]
+
+# filled in with --restaurants, --history (archived offers, two finished reservations each) and
+# --live (live offers, one open reservation each)
+HISTORY_SQL = [
+    """INSERT INTO foody_restaurants(id, api_key, title, phone, city, lat, lon)
+       SELECT 'RID_EXPLAIN_'||g, 'KEY_EXPLAIN_'||g, 'explain '||g, '+7999'||lpad(g::text, 7, '0'),
+              (ARRAY['Москва','Казань','Тверь'])[1 + g % 3], 55 + g % 100 / 100.0, 37 + g % 100 / 100.0
+       FROM generate_series(1, {restaurants}) g""",
+    """INSERT INTO foody_offers(id, restaurant_id, title, price_cents, qty_left, qty_total, expires_at, archived_at, created_at)
+       SELECT 'OFF_EXPLAIN_H'||g, 'RID_EXPLAIN_'||(1 + g % {restaurants}), 'history', 100 + g % 900, 0, 2,
+              NOW() - g * interval '1 minute', NOW() - g * interval '1 minute', NOW() - g * interval '1 minute' - interval '3 hours'
+       FROM generate_series(1, {history}) g""",
+    """INSERT INTO foody_offers(id, restaurant_id, title, price_cents, qty_left, qty_total, expires_at, created_at)
+       SELECT 'OFF_EXPLAIN_L'||g, 'RID_EXPLAIN_'||(1 + g % {restaurants}), 'live', 100 + g % 900, 5, 6,
+              NOW() + (1 + g % 240) * interval '1 minute', NOW() - (g % 60) * interval '1 minute'
+       FROM generate_series(1, {live}) g""",
+    """INSERT INTO foody_reservations(id, offer_id, code, status, qty, created_at)
+       SELECT 'RES_EXPLAIN_H'||g, 'OFF_EXPLAIN_H'||(1 + g % {history}), 'EXPLAINH'||g,
+              (ARRAY['redeemed','redeemed','redeemed','expired','canceled'])[1 + g % 5], 1, NOW() - g * interval '30 seconds'
+       FROM generate_series(1, 2 * {history}) g""",
+    """INSERT INTO foody_reservations(id, offer_id, code, status, qty)
+       SELECT 'RES_EXPLAIN_L'||g, 'OFF_EXPLAIN_L'||g, 'EXPLAINL'||g, 'reserved', 1 FROM generate_series(1, {live}) g""",
+    """INSERT INTO foody_kpi_daily(restaurant_id, day, reserved)
+       SELECT 'RID_EXPLAIN_'||g, CURRENT_DATE - d, 1 FROM generate_series(1, {restaurants}) g, generate_series(0, 89) d""",
+]
+HISTORY_TABLES = "foody_restaurants, foody_offers, foody_reservations, foody_kpi_daily"
+# partial indexes over unarchived offers: reading through one is bounded by the live set
+LIVE_OFFER_INDEXES = ("foody_offers_feed_expiry_idx", "foody_offers_feed_new_idx",
+                      "foody_offers_active_restaurant_idx", "foody_offers_unarchived_expiry_idx")
+# a full scan of one of these makes the query grow with the history
+WHOLE_SCANS = tuple(f"Seq Scan on {t}" for t in HISTORY_TABLES.split(", "))
+
+async def load_history(conn, args) -> None:
+    for sql in HISTORY_SQL:
+        await conn.execute(sql.format(restaurants=int(args.restaurants), history=int(args.history), live=int(args.live)))
+    await conn.execute(f"ANALYZE {HISTORY_TABLES}")
+
+async def explain(conn, sql: str, args) -> str:
+    return "\n".join(r[0] for r in await conn.fetch("EXPLAIN " + sql, *args))
+
+class ExplainConn:
+    """Stands in for a connection in fetch_active_offers and returns the plan instead of rows."""
+    def __init__(self, conn): self.conn, self.plan = conn, ""
+    async def fetch(self, sql, *args):
+        self.plan = await explain(self.conn, sql, args); return []
+
+async def main(args) -> int:
+    import main as app_main, sweeper
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    results, failed = [], 0
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        await load_history(conn, args)
+        sweeps = (("offers", sweeper.ARCHIVE_OFFERS, ("foody_offers_unarchived_expiry_idx",)),
+                  ("reservations", sweeper.EXPIRE_RESERVATIONS, ("foody_reservations_reserved_offer_idx",)))
+        plans = [(f"sweeper {name} (default settings)", await explain(conn, sql, (500,)), want) for name, sql, want in sweeps]
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        plans += [(name, await explain(conn, sql, params), want) for name, sql, params, want in CHECKS]
+        plans += [(f"sweeper {name}", await explain(conn, sql, (500,)), want) for name, sql, want in sweeps]
+        plans.append(("redeem by code", await explain(conn, app_main.REDEEM_SQL, ("ABC", common.TEST_KEY)),
+                      ("foody_reservations_code_key",)))
+        plans.append(("cancel by code", await explain(conn, app_main.CANCEL_SQL[True], ("ABC",)),
+                      ("foody_reservations_code_key",)))
+        # feed pages only ever read live offers; with few of them a top-N sort is fine
+        feed_sorts = (("expiry", "foody_offers_feed_expiry_idx"), ("new", "foody_offers_feed_new_idx"))
+        for sort in ("expiry", "price", "new"):
+            ec = ExplainConn(conn)
+            await app_main.fetch_active_offers(ec, 200, sort, None, None)
+            plans.append((f"feed sort={sort}", ec.plan, LIVE_OFFER_INDEXES))
+        # and the keyset index can serve each order; sort=price is by the time-dependent
+        # effective price, which no index can order
+        await conn.execute("SET LOCAL enable_sort = off")
+        for sort, want in feed_sorts:
+            ec = ExplainConn(conn)
+            await app_main.fetch_active_offers(ec, 200, sort, None, None)
+            plans.append((f"feed order sort={sort}", ec.plan, (want,)))
+    finally:
+        await tr.rollback()
+        await conn.execute(f"ANALYZE {HISTORY_TABLES}")  # statistics back to the real tables
+        await conn.close()
+    for name, plan, want in plans:
+        scans = [s for s in WHOLE_SCANS if s in plan]
+        ok = any(idx in plan for idx in want) and not scans
+        failed += not ok
+        results.append({"query": name, "ok": ok, "expected": list(want), **({"full_scans": scans} if scans else {})})
+        if not ok:
+            print(f"--- {name}: expected one of {want}, no full scans; plan:\n{plan}", file=sys.stderr)
+    common.report("explain_check", {"history": args.history, "checks": results, "failed": failed})
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--restaurants", type=int, default=2000)
+    ap.add_argument("--history", type=int, default=200000, help="archived offers (each with two finished reservations)")
+    ap.add_argument("--live", type=int, default=2000, help="live offers (each with one open reservation)")
+    sys.exit(asyncio.run(main(ap.parse_args())))
@@ -0,0 +1,74 @@
+"""Per-row cost of the /api/v1/offers enrichment pipeline for a 500-row page.
+
+``before`` is the pipeline as it was prior to enrich_feed (row_offer -> with_timer_discount
+re-parsing ISO strings with utcnow() per row -> eta() sort parsing them again); ``after``
+is main.enrich_feed. No database needed.
+
+    python bench/feed_enrich_bench.py --rows 500 --repeat 200
+"""
+import random, argparse, timeit, datetime as dt
+from common import report
+import main
+
+def with_timer_discount_before(r):
+    out = dict(r)
+    now = dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
+    expires_at = None
+    if r["expires_at"]:
+        try: expires_at = dt.datetime.fromisoformat(r["expires_at"].replace("Z","+00:00"))
+        except Exception: expires_at = None
+    discount_percent = 0; step = None
+    if expires_at:
+        delta = (expires_at - now).total_seconds() / 60.0
+        if delta <= 30: discount_percent=70; step="-70%"
+        elif delta <= 60: discount_percent=50; step="-50%"
+        elif delta <= 120: discount_percent=30; step="-30%"
+    original = r.get("original_price_cents") or r.get("price_cents")
+    current = r.get("price_cents")
+    if (original and original>0) and discount_percent>0:
+        current = int(round(original * (1 - discount_percent/100)))
+    out["timer_discount_percent"] = discount_percent
+    out["timer_step"] = step
+    out["price_cents_effective"] = current
+    return out
+
+def before(rows):
+    base = [with_timer_discount_before(main.row_offer(r)) for r in rows]
+    for o, raw in zip(base, rows):
+        o["distance_km"] = raw["distance_km"]; o["city"] = raw["rcity"]
+    def eta(o):
+        if not o.get("expires_at"): return 10**12
+        t = dt.datetime.fromisoformat(o["expires_at"].replace("Z","+00:00"))
+        return (t - dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)).total_seconds()
+    base.sort(key=eta)
+    return base
+
+def after(rows):
+    return main.enrich_feed(rows, dt.datetime.now(dt.timezone.utc))[0]
+
+def fake_rows(n):
+    now = dt.datetime.now(dt.timezone.utc)
+    rows = []
+    for i in range(n):
+        rows.append({"id": f"OFF_{i:06d}", "restaurant_id": "RID_BENCH", "title": "Набор", "description": None,
+                     "price_cents": 19900, "original_price_cents": random.choice((None, 34900)),
+                     "qty_left": 3, "qty_total": 5, "archived_at": None, "photo_url": None,
+                     "expires_at": random.choice((None, now + dt.timedelta(minutes=random.randint(1, 600)))),
+                     "created_at": now, "distance_km": random.random() * 10, "rcity": "Москва"})
+    rows.sort(key=lambda r: r["expires_at"] or dt.datetime.max.replace(tzinfo=dt.timezone.utc))
+    return rows
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rows", type=int, default=500)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+    rows = fake_rows(args.rows)
+    # compare by id: the old eta() sort called utcnow() per row, so equal expiries could swap
+    assert {o["id"]: o["price_cents_effective"] for o in before(rows)} == {o["id"]: o["price_cents_effective"] for o in after(rows)}
+    res = {}
+    for name, fn in (("before", before), ("after", after)):
+        best = min(timeit.repeat(lambda: fn(rows), number=args.repeat, repeat=3)) / args.repeat
+        res[name] = {"page_ms": round(best * 1000, 3), "per_row_us": round(best / args.rows * 1e6, 3)}
+    res["speedup"] = round(res["before"]["page_ms"] / res["after"]["page_ms"], 2)
+    report("feed_enrich", dict(rows=args.rows, **res))
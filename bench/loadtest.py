@@ -0,0 +1,162 @@
+"""Mixed-workload load test for the backend's hot endpoints.
+
+Seeds --restaurants restaurants with --offers offers between them (through the public API,
+so it works in-process or against --base-url), then runs --concurrency workers for
+--duration seconds. Each worker picks an operation by --mix weight:
+
+    feed     GET  /api/v1/offers, cycling through every sort (distance with a location)
+    reserve  POST /api/v1/reservations
+    redeem   POST /api/v1/reservations/redeem (codes from earlier reservations)
+    kpi      GET  /api/v1/merchant/kpi with a daily series
+    csv      GET  /api/v1/merchant/offers/csv
+
+It prints throughput, status counts and p50/p95/p99 latency per operation as JSON (also to
+--out). With --max-p95-ms it exits 1 when any operation's p95 is above the limit, for CI.
+Seeded offers expire after two hours, so the sweeper clears them out of later runs.
+
+    DATABASE_URL=postgresql://localhost/foody python bench/loadtest.py --restaurants 50 --offers 5000
+"""
+import sys, json, time, random, asyncio, argparse
+import datetime as dt
+from typing import Any, Dict, List
+from common import app_client, percentiles, report, Timer
+
+CITIES = {"Москва": (55.7558, 37.6173), "Санкт-Петербург": (59.9343, 30.3351), "Казань": (55.7961, 49.1064)}
+FEED_SORTS = ("expiry", "price", "new", "distance")
+DEFAULT_MIX = "feed=60,reserve=20,redeem=10,kpi=5,csv=5"
+BULK_CHUNK = 1000
+
+def parse_mix(s: str) -> Dict[str, float]:
+    mix = {}
+    for part in s.split(","):
+        name, _, w = part.partition("=")
+        if name.strip() not in ("feed", "reserve", "redeem", "kpi", "csv"):
+            raise SystemExit(f"unknown operation in --mix: {name}")
+        mix[name.strip()] = float(w or 1)
+    return mix
+
+async def seed(c, args, rnd: random.Random) -> List[Dict[str, Any]]:
+    """Register restaurants and bulk-create their offers; returns [{id, key, city, lat, lon, offers}]."""
+    tag = f"{int(time.time())}-{args.seed}"
+    restaurants = []
+    for i in range(args.restaurants):
+        city = list(CITIES)[i % len(CITIES)]
+        lat, lon = CITIES[city]
+        lat, lon = lat + rnd.uniform(-0.1, 0.1), lon + rnd.uniform(-0.15, 0.15)
+        r = await c.post("/api/v1/merchant/register_public", json={
+            "title": f"loadtest {tag} #{i}", "city": city, "address": f"ул. Тестовая, {i}", "lat": lat, "lon": lon})
+        r.raise_for_status()
+        restaurants.append({"id": r.json()["restaurant_id"], "key": r.json()["api_key"], "city": city,
+                            "lat": lat, "lon": lon, "offers": []})
+    now = dt.datetime.now(dt.timezone.utc)
+    rows: Dict[str, List[Dict[str, Any]]] = {r["id"]: [] for r in restaurants}
+    for j in range(args.offers):
+        rest = restaurants[j % len(restaurants)]
+        qty = rnd.randint(20, 100)
+        price = rnd.randint(50, 900)
+        rows[rest["id"]].append({"title": f"offer {j}", "price": price, "original_price": price * rnd.choice((2, 3)),
+                                 "qty_total": qty, "qty_left": qty,
+                                 "expires_at": (now + dt.timedelta(minutes=rnd.randint(20, 120))).isoformat()})
+    for rest in restaurants:
+        todo = rows[rest["id"]]
+        for k in range(0, len(todo), BULK_CHUNK):
+            r = await c.post("/api/v1/merchant/offers/bulk", params={"restaurant_id": rest["id"]},
+                             headers={"X-Foody-Key": rest["key"]}, json=todo[k:k + BULK_CHUNK])
+            r.raise_for_status()
+            rest["offers"] += [x["id"] for x in r.json()["results"] if x["ok"]]
+    return restaurants
+
+async def run(args):
+    rnd = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    async with app_client(args.base_url) as c:
+        with Timer() as t_seed:
+            restaurants = await seed(c, args, rnd)
+        offers = [(o, rest) for rest in restaurants for o in rest["offers"]]
+        codes: List[tuple] = []  # (code, restaurant) awaiting redeem
+        lat: Dict[str, List[float]] = {op: [] for op in mix}
+        status: Dict[str, Dict[int, int]] = {op: {} for op in mix}
+        sort_i = [0]
+        today = dt.date.today()
+
+        async def feed():
+            sort = FEED_SORTS[sort_i[0] % len(FEED_SORTS)]; sort_i[0] += 1
+            rest = rnd.choice(restaurants)
+            params = {"sort": sort, "city": rest["city"], "limit": args.feed_limit}
+            if sort == "distance": params.update(lat=rest["lat"], lon=rest["lon"])
+            return await c.get("/api/v1/offers", params=params)
+
+        async def reserve():
+            oid, rest = rnd.choice(offers)
+            r = await c.post("/api/v1/reservations", json={"offer_id": oid, "qty": 1, "qr": args.qr})
+            if r.status_code == 200:
+                codes.append((r.json()["code"], rest))
+            return r
+
+        async def redeem():
+            if not codes:
+                return await reserve()  # nothing to redeem yet: count it as a reservation
+            code, rest = codes.pop(rnd.randrange(len(codes)))
+            return await c.post("/api/v1/reservations/redeem", headers={"X-Foody-Key": rest["key"]}, json={"code": code})
+
+        async def kpi():
+            rest = rnd.choice(restaurants)
+            return await c.get("/api/v1/merchant/kpi", headers={"X-Foody-Key": rest["key"]}, params={
+                "restaurant_id": rest["id"], "from": (today - dt.timedelta(days=30)).isoformat(),
+                "to": today.isoformat(), "granularity": "day"})
+
+        async def csv():
+            rest = rnd.choice(restaurants)
+            return await c.get("/api/v1/merchant/offers/csv", headers={"X-Foody-Key": rest["key"]},
+                               params={"restaurant_id": rest["id"]})
+
+        ops = {"feed": feed, "reserve": reserve, "redeem": redeem, "kpi": kpi, "csv": csv}
+        names, weights = list(mix), list(mix.values())
+        deadline = time.perf_counter() + args.duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                op = rnd.choices(names, weights)[0]
+                if op == "redeem" and not codes: op = "reserve" if "reserve" in mix else op
+                with Timer() as t:
+                    r = await ops[op]()
+                lat.setdefault(op, []).append(t.ms)
+                st = status.setdefault(op, {})
+                st[r.status_code] = st.get(r.status_code, 0) + 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+        total = sum(len(v) for v in lat.values())
+        result = {
+            "restaurants": len(restaurants), "offers": len(offers), "seed_s": round(t_seed.ms / 1000, 2),
+            "concurrency": args.concurrency, "duration_s": round(wall, 2), "requests": total, "rps": round(total / wall, 1),
+            "ops": {op: {"rps": round(len(xs) / wall, 1), "status": status[op], "latency_ms": percentiles(xs)}
+                    for op, xs in lat.items() if xs},
+        }
+        report("loadtest", result)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        slow = {op: v["latency_ms"]["p95"] for op, v in result["ops"].items()
+                if args.max_p95_ms and v["latency_ms"]["p95"] > args.max_p95_ms}
+        errors = {op: {s: n for s, n in st.items() if s >= 500} for op, st in status.items()}
+        errors = {op: e for op, e in errors.items() if e}
+        if slow or errors:
+            print(f"FAIL: p95 above {args.max_p95_ms} ms: {slow}; 5xx: {errors}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--base-url", help="running backend; default runs the app in-process")
+    ap.add_argument("--restaurants", type=int, default=20)
+    ap.add_argument("--offers", type=int, default=2000, help="total, spread over the restaurants")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load after seeding")
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    ap.add_argument("--feed-limit", type=int, default=50)
+    ap.add_argument("--qr", default="png", choices=("png", "svg", "none"), help="QR format requested by reservations")
+    ap.add_argument("--seed", type=int, default=1, help="random seed for data and request choices")
+    ap.add_argument("--out", help="also write the JSON result here")
+    ap.add_argument("--max-p95-ms", type=float, default=0, help="exit 1 if any operation's p95 exceeds this")
+    asyncio.run(run(ap.parse_args()))
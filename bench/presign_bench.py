@@ -0,0 +1,65 @@
+"""Presign throughput: a boto3 client per request (old path) vs. storage.py's cached client.
+
+Signing is local, so no bucket or network is needed; dummy R2 credentials are set if none
+are configured. Also drives the HTTP endpoints (single and batch) through the app in-process.
+
+    python bench/presign_bench.py --n 500 --concurrency 50
+"""
+import os, time, asyncio, argparse
+
+for k, v in (("R2_ENDPOINT", "https://example.r2.cloudflarestorage.com"), ("R2_BUCKET", "foody"),
+             ("R2_ACCESS_KEY_ID", "bench"), ("R2_SECRET_ACCESS_KEY", "bench")):
+    os.environ.setdefault(k, v)
+from common import app_client, percentiles, report, Timer
+
+def legacy_presign(key: str) -> str:
+    import boto3
+    s3 = boto3.client("s3", endpoint_url=os.environ["R2_ENDPOINT"], aws_access_key_id=os.environ["R2_ACCESS_KEY_ID"],
+                      aws_secret_access_key=os.environ["R2_SECRET_ACCESS_KEY"], region_name="auto")
+    return s3.generate_presigned_url("put_object", Params={"Bucket": os.environ["R2_BUCKET"], "Key": key,
+                                                          "ContentType": "image/jpeg"}, ExpiresIn=3600)
+
+async def loop_lag(stop: asyncio.Event, out: list):
+    """Max event-loop stall while the workload runs (how much presigning blocks other requests)."""
+    while not stop.is_set():
+        t = time.perf_counter(); await asyncio.sleep(0.001)
+        out.append((time.perf_counter() - t - 0.001) * 1000)
+
+async def run(args):
+    import storage
+    results = {}
+    # direct calls
+    with Timer() as t:
+        for i in range(min(args.n, args.legacy_n)): legacy_presign(f"offers/{i}.jpg")
+    results["legacy_client_per_call"] = {"calls": min(args.n, args.legacy_n), "ms_per_call": round(t.ms / min(args.n, args.legacy_n), 3)}
+    storage.s3_client()  # build once, as the first request would
+    with Timer() as t:
+        for i in range(args.n): storage._presign_one(f"offers/{i}.jpg", "image/jpeg")
+    results["cached_client"] = {"calls": args.n, "ms_per_call": round(t.ms / args.n, 3)}
+    # HTTP
+    async with app_client(args.base_url) as c:
+        for name, path, body, per in (("http_single", "/api/v1/uploads/presign", {"filename": "a.jpg", "content_type": "image/jpeg"}, 1),
+                                      ("http_batch", "/api/v1/uploads/presign/batch",
+                                       {"files": [{"filename": f"{i}.jpg", "content_type": "image/jpeg"} for i in range(args.batch)]}, args.batch)):
+            sem, lat, lag, stop = asyncio.Semaphore(args.concurrency), [], [], asyncio.Event()
+            async def one():
+                async with sem:
+                    with Timer() as t:
+                        r = await c.post(path, json=body)
+                    r.raise_for_status(); lat.append(t.ms)
+            lag_task = asyncio.create_task(loop_lag(stop, lag))
+            with Timer() as wall:
+                await asyncio.gather(*(one() for _ in range(max(1, args.n // per))))
+            stop.set(); await lag_task
+            results[name] = {"urls_per_s": round(len(lat) * per / (wall.ms / 1000), 1), "latency_ms": percentiles(lat),
+                             "max_loop_stall_ms": round(max(lag or [0]), 3)}
+    report("presign_bench", results)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=500)
+    ap.add_argument("--legacy-n", type=int, default=100, help="client-per-call runs (slow)")
+    ap.add_argument("--batch", type=int, default=10)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--base-url")
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,91 @@
+"""Cashier scan throughput: POST /api/v1/reservations/redeem, plus duplicate-scan correctness.
+
+Reserves --codes codes on a few offers, then redeems every code once at --concurrency and
+reports scans per second and latency. After that, --dup-codes fresh codes are each scanned
+--dup-scans times at once (two tills scanning the same QR); exactly one scan per code must
+report "redeemed", and the KPI rollup must count each code once. Exits 1 on a double redeem
+or when throughput is below --min-sps.
+
+    DATABASE_URL=postgresql://localhost/foody python bench/redeem_bench.py --codes 2000
+"""
+import sys, time, asyncio, argparse
+from collections import Counter
+from typing import List
+from common import app_client, percentiles, report, Timer, TEST_RID, TEST_KEY
+
+async def reserve_codes(c, offers: List[str], n: int, concurrency: int) -> List[str]:
+    sem, codes = asyncio.Semaphore(concurrency), []
+    async def one(i):
+        async with sem:
+            r = await c.post("/api/v1/reservations", json={"offer_id": offers[i % len(offers)], "qty": 1, "qr": "none"})
+        r.raise_for_status()
+        codes.append(r.json()["code"])
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return codes
+
+async def redeemed_total(c, H, restaurant_id: str) -> int:
+    r = await c.get("/api/v1/merchant/kpi", headers=H, params={"restaurant_id": restaurant_id})
+    r.raise_for_status()
+    return int(r.json()["redeemed"])
+
+async def run(args):
+    H = {"X-Foody-Key": args.key}
+    async with app_client(args.base_url) as c:
+        per_offer = (args.codes + args.dup_codes) // args.offers + 1
+        r = await c.post("/api/v1/merchant/offers/bulk", params={"restaurant_id": args.restaurant_id}, headers=H,
+                         json=[{"title": f"redeem-bench-{i}", "price": 100, "original_price": 300, "qty_total": per_offer}
+                               for i in range(args.offers)])
+        r.raise_for_status()
+        offers = [x["id"] for x in r.json()["results"] if x["ok"]]
+        codes = await reserve_codes(c, offers, args.codes + args.dup_codes, args.concurrency)
+        unique, dup = codes[:args.codes], codes[args.codes:]
+        before = await redeemed_total(c, H, args.restaurant_id)
+
+        sem, lat, status = asyncio.Semaphore(args.concurrency), [], Counter()
+        async def scan(code):
+            async with sem:
+                with Timer() as t:
+                    r = await c.post("/api/v1/reservations/redeem", headers=H, json={"code": code})
+            lat.append(t.ms)
+            status[r.json().get("status") if r.status_code == 200 else r.status_code] += 1
+        t0 = time.perf_counter()
+        await asyncio.gather(*(scan(code) for code in unique))
+        wall = time.perf_counter() - t0
+
+        winners = Counter()
+        async def dup_scan(code):
+            r = await c.post("/api/v1/reservations/redeem", headers=H, json={"code": code})
+            if r.status_code == 200 and r.json().get("status") == "redeemed":
+                winners[code] += 1
+        await asyncio.gather(*(dup_scan(code) for code in dup for _ in range(args.dup_scans)))
+        double = {code: n for code, n in winners.items() if n > 1}
+        missed = [code for code in dup if not winners[code]]
+        kpi_delta = await redeemed_total(c, H, args.restaurant_id) - before
+
+        for oid in offers:
+            await c.delete(f"/api/v1/merchant/offers/{oid}", params={"restaurant_id": args.restaurant_id}, headers=H)
+    sps = len(unique) / wall
+    report("redeem_bench", {
+        "codes": len(unique), "concurrency": args.concurrency, "wall_s": round(wall, 3), "scans_per_s": round(sps, 1),
+        "status": dict(status), "latency_ms": percentiles(lat),
+        "duplicate_scans": {"codes": len(dup), "scans_per_code": args.dup_scans, "double_redeemed": len(double),
+                            "never_redeemed": len(missed)},
+        "kpi_redeemed_delta": kpi_delta, "kpi_expected": len(unique) + len(dup)})
+    ok = not double and not missed and status.get("redeemed") == len(unique) and kpi_delta == len(unique) + len(dup)
+    if not ok:
+        print("FAIL: double or missed redeems, or KPI count off", file=sys.stderr); sys.exit(1)
+    if sps < args.min_sps:
+        print(f"FAIL: {sps:.1f} scans/s < {args.min_sps}", file=sys.stderr); sys.exit(1)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--base-url")
+    ap.add_argument("--restaurant-id", default=TEST_RID)
+    ap.add_argument("--key", default=TEST_KEY)
+    ap.add_argument("--offers", type=int, default=5)
+    ap.add_argument("--codes", type=int, default=1000, help="codes redeemed once each for the throughput figure")
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--dup-codes", type=int, default=50, help="codes scanned several times at once")
+    ap.add_argument("--dup-scans", type=int, default=5)
+    ap.add_argument("--min-sps", type=float, default=0, help="exit 1 below this many scans per second")
+    asyncio.run(run(ap.parse_args()))
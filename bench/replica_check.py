@@ -0,0 +1,114 @@
+"""Read-replica routing check against a primary and a streaming standby.
+
+Runs the app in-process with DATABASE_URL (primary) and DATABASE_READ_URL (replica) and
+verifies that: public reads go to the replica; a merchant's reads right after a write are
+pinned to the primary and see the write; a lagging replica (replay paused with
+pg_wal_replay_pause, which needs a superuser on the standby) sends reads to the primary
+until it catches up; an unreachable replica does the same, without failed requests.
+
+A throwaway standby next to a local primary:
+
+    pg_basebackup -h /tmp/pg -D /tmp/pg-replica -R -X stream
+    echo "port=5433" >> /tmp/pg-replica/postgresql.auto.conf && pg_ctl -D /tmp/pg-replica start
+    DATABASE_URL=postgresql://localhost/foody DATABASE_READ_URL=postgresql://localhost:5433/foody \\
+        python bench/replica_check.py
+
+Against two independent instances (no replication) only the routing and pin checks apply:
+pass --skip-lag; the replica needs the schema (run once with it as DATABASE_URL).
+"""
+import os, sys, time, asyncio, argparse
+
+os.environ.setdefault("DB_READ_CHECK_S", "0.2")
+os.environ.setdefault("DB_READ_MAX_LAG_S", "1")
+os.environ.setdefault("DB_READ_PIN_S", "2")
+os.environ.setdefault("SWEEPER", "0")
+from common import app_client, report, TEST_RID, TEST_KEY
+
+import asyncpg
+
+async def wait_route(db, want: str, timeout: float = 10.0) -> float:
+    t0 = time.perf_counter()
+    while db.route() != want:
+        if time.perf_counter() - t0 > timeout:
+            raise AssertionError(f"route stayed {db.route()!r}, wanted {want!r} (replica: {db.replica_status()})")
+        await asyncio.sleep(0.05)
+    return round(time.perf_counter() - t0, 3)
+
+def reads(db):
+    return {k[0]: v for k, v in db.READS.values.items()}
+
+def delta(before, after):
+    return {k: after.get(k, 0) - before.get(k, 0) for k in after if after.get(k, 0) != before.get(k, 0)}
+
+async def run(args):
+    if not os.getenv("DATABASE_READ_URL"):
+        sys.exit("DATABASE_READ_URL is not set")
+    import db
+    out, H = {}, {"X-Foody-Key": TEST_KEY}
+    async with app_client() as c:
+        out["replica_ready_s"] = await wait_route(db, "replica")
+
+        before = reads(db)
+        for i in range(5):
+            assert (await c.get("/api/v1/offers", params={"limit": 100 + i})).status_code == 200
+        out["feed_reads"] = d = delta(before, reads(db))
+        assert d.get("replica") == 5, f"feed reads did not use the replica: {d}"
+
+        before = reads(db)
+        o = (await c.post("/api/v1/merchant/offers", headers=H, json={
+            "restaurant_id": TEST_RID, "title": "replica-check", "price": 100, "qty_total": 1})).json()
+        mine = (await c.get("/api/v1/merchant/offers", params={"restaurant_id": TEST_RID}, headers=H)).json()
+        out["read_your_writes"] = d = delta(before, reads(db))
+        assert any(x["id"] == o["id"] for x in mine), "merchant did not see their own new offer"
+        assert d.get("pinned") == 1, f"merchant read after a write was not pinned: {d}"
+        out["pin_expired_s"] = await wait_route_pin(db, TEST_RID)
+
+        if not args.skip_lag:
+            rep = await asyncpg.connect(os.environ["DATABASE_READ_URL"])
+            try:
+                if not await rep.fetchval("SELECT pg_is_in_recovery()"):
+                    sys.exit("DATABASE_READ_URL is not a standby: pass --skip-lag")
+                await rep.execute("SELECT pg_wal_replay_pause()")
+                t0 = time.perf_counter()
+                # replayed commit timestamps only move with new writes on the primary
+                while db.route() != "lagging" and time.perf_counter() - t0 < 10:
+                    await c.post(f"/api/v1/merchant/offers/{o['id']}", headers=H, json={"restaurant_id": TEST_RID, "qty_left": 1})
+                    await asyncio.sleep(0.2)
+                out["lag_detected_s"] = round(time.perf_counter() - t0, 3)
+                before = reads(db)
+                r = await c.get("/api/v1/offers", params={"limit": 200})
+                out["reads_while_lagging"] = d = delta(before, reads(db))
+                assert r.status_code == 200 and d.get("lagging") == 1, f"lagging replica still used: {d}"
+            finally:
+                await rep.execute("SELECT pg_wal_replay_resume()")
+                await rep.close()
+            out["caught_up_s"] = await wait_route(db, "replica")
+
+        # replica unreachable: the watcher marks it down, reads go to the primary
+        good_url = db.DB_READ_URL
+        db.DB_READ_URL = "postgresql://postgres@127.0.0.1:1/foody"
+        await db._read_pool.close(); db._read_pool = None
+        try:
+            out["down_detected_s"] = await wait_route(db, "down")
+            before = reads(db)
+            r = await c.get("/api/v1/offers", params={"limit": 201})
+            out["reads_while_down"] = d = delta(before, reads(db))
+            assert r.status_code == 200 and d.get("down") == 1, f"down replica not bypassed: {d}"
+        finally:
+            db.DB_READ_URL = good_url
+        out["recovered_s"] = await wait_route(db, "replica")
+        await c.delete(f"/api/v1/merchant/offers/{o['id']}", params={"restaurant_id": TEST_RID}, headers=H)
+    report("replica_check", dict(out, ok=True))
+
+async def wait_route_pin(db, restaurant_id: str) -> float:
+    t0 = time.perf_counter()
+    while db.route(restaurant_id) == "pinned":
+        if time.perf_counter() - t0 > db.READ_PIN_S + 5:
+            raise AssertionError("pin did not expire")
+        await asyncio.sleep(0.05)
+    return round(time.perf_counter() - t0, 3)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--skip-lag", action="store_true", help="replica is not a streaming standby")
+    asyncio.run(run(ap.parse_args()))
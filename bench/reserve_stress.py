@@ -0,0 +1,57 @@
+"""Concurrency stress for POST /api/v1/reservations on a few hot offers.
+
+Fires --requests reservations at --concurrency against --offers offers of --qty items
+each, then asserts that no offer oversold (successful qty == qty_total - qty_left,
+qty_left >= 0) and that throughput stayed above --min-rps.
+
+    DATABASE_URL=postgresql://localhost/foody python bench/reserve_stress.py
+"""
+import time, random, asyncio, argparse
+from common import app_client, percentiles, report, Timer, TEST_RID, TEST_KEY
+
+async def run(args):
+    async with app_client(args.base_url) as c:
+        H = {"X-Foody-Key": args.key}
+        offers = []
+        for i in range(args.offers):
+            r = await c.post("/api/v1/merchant/offers", headers=H, json={
+                "restaurant_id": args.restaurant_id, "title": f"stress-{i}", "price_cents": 10000,
+                "original_price_cents": 30000, "qty_total": args.qty, "qty_left": args.qty})
+            r.raise_for_status()
+            offers.append(r.json()["id"])
+        sem = asyncio.Semaphore(args.concurrency)
+        lat, won, status = [], {o: 0 for o in offers}, {}
+        async def one():
+            oid = random.choice(offers); qty = random.choice((1, 1, 1, 2))
+            async with sem:
+                with Timer() as t:
+                    r = await c.post("/api/v1/reservations", json={"offer_id": oid, "qty": qty})
+            lat.append(t.ms)
+            status[r.status_code] = status.get(r.status_code, 0) + 1
+            if r.status_code == 200: won[oid] += qty
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+        wall = time.perf_counter() - t0
+        rows = (await c.get("/api/v1/merchant/offers", params={"restaurant_id": args.restaurant_id}, headers=H)).json()
+        left = {o["id"]: o["qty_left"] for o in rows if o["id"] in won}
+        oversold = {o: {"reserved": won[o], "qty_left": left[o]} for o in offers if left[o] < 0 or won[o] != args.qty - left[o]}
+        rps = args.requests / wall
+        report("reserve_stress", {"requests": args.requests, "concurrency": args.concurrency, "offers": args.offers,
+                                  "qty_per_offer": args.qty, "status": status, "wall_s": round(wall, 3),
+                                  "rps": round(rps, 1), "latency_ms": percentiles(lat), "oversold": oversold})
+        for o in offers:
+            await c.delete(f"/api/v1/merchant/offers/{o}", params={"restaurant_id": args.restaurant_id}, headers=H)
+        assert not oversold, f"oversold offers: {oversold}"
+        assert rps >= args.min_rps, f"throughput {rps:.1f} rps below --min-rps {args.min_rps}"
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--base-url", help="running backend; default runs the app in-process")
+    ap.add_argument("--restaurant-id", default=TEST_RID)
+    ap.add_argument("--key", default=TEST_KEY)
+    ap.add_argument("--offers", type=int, default=3)
+    ap.add_argument("--qty", type=int, default=200)
+    ap.add_argument("--requests", type=int, default=3000)
+    ap.add_argument("--concurrency", type=int, default=300)
+    ap.add_argument("--min-rps", type=float, default=50.0)
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,57 @@
+"""Cold-start timing: fresh processes importing the app and running startup.
+
+Each run is a new interpreter (no warm imports) that records: import time of ``main``; time
+until startup hooks return, i.e. when uvicorn would start accepting; the first ``/health``
+answer; time until ``/ready`` turns 200 (migrations, seed, pool warm-up done); and which
+heavy optional modules were already imported at that point (they should load lazily).
+
+    DATABASE_URL=postgresql://localhost/foody python bench/startup_bench.py --runs 5
+"""
+import os, sys, json, time, asyncio, argparse, statistics, subprocess
+
+HEAVY_MODULES = ("boto3", "botocore", "segno", "httpx", "PIL")
+CONFIGS = {
+    "migrate+seed": {"RUN_MIGRATIONS": "1", "SEED_DEMO": "1"},
+    "plain": {"RUN_MIGRATIONS": "0", "SEED_DEMO": "0"},
+}
+
+async def child():
+    t0 = time.perf_counter()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+    import main
+    out = {"import_s": time.perf_counter() - t0, "modules_at_import": [m for m in HEAVY_MODULES if m in sys.modules]}
+    import httpx  # the test client, imported only after the check above
+    async with main.app.router.lifespan_context(main.app):
+        out["accept_s"] = time.perf_counter() - t0
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as c:
+            await c.get("/health")
+            out["first_health_s"] = time.perf_counter() - t0
+            while (await c.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.005)
+            out["ready_s"] = time.perf_counter() - t0
+            out["steps"] = (await c.get("/ready")).json()["steps"]
+    print(json.dumps(out))
+
+def run(args):
+    from common import report
+    result = {}
+    for name, env in CONFIGS.items():
+        samples = []
+        for _ in range(args.runs):
+            p = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], capture_output=True, text=True,
+                               env=dict(os.environ, SWEEPER="0", **env), timeout=120)
+            line = next((l for l in reversed(p.stdout.splitlines()) if l.startswith("{")), None)
+            if p.returncode or not line:
+                sys.exit(f"child failed ({name}):\n{p.stdout}\n{p.stderr}")
+            samples.append(json.loads(line))
+        med = lambda k: round(statistics.median(s[k] for s in samples), 3)
+        result[name] = {"runs": args.runs, **{k: med(k) for k in ("import_s", "accept_s", "first_health_s", "ready_s")},
+                        "modules_at_import": samples[-1]["modules_at_import"], "steps": samples[-1]["steps"]}
+    report("startup", result)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    a = ap.parse_args()
+    asyncio.run(child()) if a.child else run(a)
@@ -1,16 +1,24 @@
-import os
+import os, time, asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Set
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 from aiogram import Bot, Dispatcher
 from aiogram.enums.parse_mode import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Update, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+import chat_link_handlers
 
 BOT_TOKEN = os.getenv("BOT_TOKEN","")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET","foodySecret123")
 WEBAPP_PUBLIC = os.getenv("WEBAPP_PUBLIC","https://example.com").rstrip("/")
 WEBAPP_BUYER_URL = os.getenv("WEBAPP_BUYER_URL", f"{WEBAPP_PUBLIC}/web/buyer/")
 WEBAPP_MERCHANT_URL = os.getenv("WEBAPP_MERCHANT_URL", f"{WEBAPP_PUBLIC}/web/merchant/")
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "2000"))    # across all workers
+UPDATE_DEDUPE_SIZE = int(os.getenv("UPDATE_DEDUPE_SIZE", "4096"))  # recent update_ids remembered
 
 def _https(u:str)->str:
     u = (u or "").strip()
@@ -23,6 +31,7 @@ WEBAPP_MERCHANT_URL = _https(WEBAPP_MERCHANT_URL)
 
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+dp.include_router(chat_link_handlers.router)  # /id, /link
 app = FastAPI()
 
 def kb_main():
@@ -57,34 +66,147 @@ async def cmd_guide(m): await m.answer(GUIDE)
 @dp.message(Command("rules"))
 async def cmd_rules(m): await m.answer(RULES)
 
+# ---- Webhook: ack at once, handle in the background ----
+# Telegram redelivers an update whose webhook call is slow or fails, so the endpoint only
+# drops repeats and enqueues; workers run the handlers. Updates are sharded by chat, so one
+# chat's updates keep their order while different chats run in parallel.
+
+class RecentIds:
+    """Ring buffer of the last ``size`` ids with O(1) membership."""
+
+    def __init__(self, size: int):
+        self.order: Deque[int] = deque()
+        self.seen: Set[int] = set()
+        self.size = size
+
+    def add(self, i: int) -> bool:
+        """False if ``i`` is already known."""
+        if i in self.seen:
+            return False
+        self.seen.add(i)
+        self.order.append(i)
+        if len(self.order) > self.size:
+            self.seen.discard(self.order.popleft())
+        return True
+
+    def discard(self, i: int) -> None:
+        # only forgotten when it could not be queued, so Telegram's retry is accepted
+        self.seen.discard(i)
+
+LATENCY_WINDOW = 2048
+_recent = RecentIds(UPDATE_DEDUPE_SIZE)
+_queues: List[asyncio.Queue] = []
+_workers: List[asyncio.Task] = []
+_counts: Dict[str, int] = {"accepted": 0, "duplicate": 0, "rejected": 0, "processed": 0, "failed": 0}
+_handler_s: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+_wait_s: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+def _chat_of(data: Dict[str, Any]) -> int:
+    for kind in ("message", "edited_message", "callback_query", "my_chat_member", "chat_member", "inline_query"):
+        ev = data.get(kind)
+        if isinstance(ev, dict):
+            chat = ev.get("chat") or (ev.get("message") or {}).get("chat") or ev.get("from") or {}
+            if chat.get("id") is not None:
+                return int(chat["id"])
+    return int(data.get("update_id") or 0)
+
+async def _worker(q: asyncio.Queue):
+    while True:
+        queued_at, data = await q.get()
+        t0 = time.monotonic()
+        _wait_s.append(t0 - queued_at)
+        try:
+            await dp.feed_update(bot, Update.model_validate(data))
+            _counts["processed"] += 1
+        except Exception as e:
+            _counts["failed"] += 1
+            print("BOT update failed:", data.get("update_id"), repr(e))
+        finally:
+            _handler_s.append(time.monotonic() - t0)
+            q.task_done()
+
+@app.on_event("startup")
+async def _start_workers():
+    per_worker = max(1, UPDATE_QUEUE_SIZE // max(1, UPDATE_WORKERS))
+    for _ in range(max(1, UPDATE_WORKERS)):
+        q: asyncio.Queue = asyncio.Queue(per_worker)
+        _queues.append(q)
+        _workers.append(asyncio.create_task(_worker(q)))
+    chat_link_handlers.start()
+
+@app.on_event("shutdown")
+async def _stop_workers():
+    try:  # let queued updates finish; whatever is left, Telegram never got a failure for
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in _queues)), 10)
+    except asyncio.TimeoutError:
+        print("BOT shutdown: dropped", sum(q.qsize() for q in _queues), "queued updates")
+    for t in _workers: t.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    await chat_link_handlers.stop()
+    await bot.session.close()
+
 @app.post("/tg/webhook")
 async def tg_webhook(request: Request):
     if request.headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
         raise HTTPException(401, "bad secret")
     data = await request.json()
-    upd = Update.model_validate(data)
-    await dp.feed_update(bot, upd)
+    update_id = data.get("update_id")
+    if update_id is not None and not _recent.add(update_id):
+        _counts["duplicate"] += 1
+        return "OK"
+    try:
+        _queues[_chat_of(data) % len(_queues)].put_nowait((time.monotonic(), data))
+    except asyncio.QueueFull:
+        # non-2xx: Telegram keeps the update and retries it later
+        _counts["rejected"] += 1
+        if update_id is not None: _recent.discard(update_id)
+        return JSONResponse({"ok": False, "reason": "busy"}, status_code=503, headers={"Retry-After": "1"})
+    _counts["accepted"] += 1
     return "OK"
 
+def _quantiles(xs) -> Dict[str, float]:
+    s = sorted(xs)
+    if not s: return {}
+    return {q: s[min(len(s) - 1, int(float(q) * len(s)))] for q in ("0.5", "0.95", "0.99")}
+
+@app.get("/metrics")
+async def metrics():
+    lines = ["# TYPE foody_bot_updates_total counter"]
+    lines += [f'foody_bot_updates_total{{result="{k}"}} {v}' for k, v in _counts.items()]
+    lines += ["# TYPE foody_bot_queue_depth gauge", f"foody_bot_queue_depth {sum(q.qsize() for q in _queues)}",
+              "# TYPE foody_bot_queue_capacity gauge", f"foody_bot_queue_capacity {sum(q.maxsize for q in _queues)}"]
+    for name, xs, desc in (("foody_bot_handler_seconds", _handler_s, "Handler time per update"),
+                           ("foody_bot_queue_wait_seconds", _wait_s, "Time from ack to a worker picking the update up")):
+        lines += [f"# HELP {name} {desc} (last {LATENCY_WINDOW} updates)", f"# TYPE {name} summary"]
+        lines += [f'{name}{{quantile="{q}"}} {v:.6f}' for q, v in _quantiles(xs).items()]
+        lines += [f"{name}_count {len(xs)}", f"{name}_sum {sum(xs):.6f}"]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health(): return {"ok": True}
 
 
 @app.post("/tg/notify")
 async def tg_notify(request: Request):
+    """Message from the backend outbox: {restaurant_id, chat_id?, text, unlinked?}.
+
+    429 + retry_after when Telegram throttles us, so the backend backs off instead of dropping.
+    """
     if request.headers.get("x-foody-secret") != WEBHOOK_SECRET:
         raise HTTPException(401, "bad secret")
     data = await request.json()
     text = data.get("text") or "(пусто)"
-    # Send to the chat the user most recently used (store in env for MVP)
-    chat_id = int(os.getenv("ADMIN_CHAT_ID","0")) if os.getenv("ADMIN_CHAT_ID") else None
+    # the chat sent along, else the restaurant's chat from our map, else the admin chat from env
+    chat_id = chat_link_handlers.remember(data) or (int(os.getenv("ADMIN_CHAT_ID")) if os.getenv("ADMIN_CHAT_ID") else None)
     if not chat_id:
-        # As a fallback, do nothing (could be extended to a store of restaurant chat ids).
         return {"ok": False, "reason": "no chat configured"}
-    await bot.send_message(chat_id, text)
+    try:
+        await bot.send_message(int(chat_id), text)
+    except TelegramRetryAfter as e:
+        return JSONResponse({"ok": False, "retry_after": e.retry_after}, status_code=429,
+                            headers={"Retry-After": str(e.retry_after)})
+    except TelegramForbiddenError as e:
+        return {"ok": False, "reason": f"blocked: {e.message}"}
+    except TelegramBadRequest as e:
+        return {"ok": False, "reason": e.message}
     return {"ok": True}
-
-
-@dp.message(Command("id"))
-async def cmd_id(m): 
-    await m.answer(f"Ваш chat_id: <code>{m.chat.id}</code>")
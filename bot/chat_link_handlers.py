@@ -1,26 +1,101 @@
-# Minimal aiogram handlers for chat linking (adapt to your bot structure)
-from aiogram import Router, F
+# Chat linking: /link CODE binds this chat to a restaurant through the backend, and the
+# restaurant -> chat map the notify endpoint routes by (loaded from the backend, kept fresh
+# by link results and by the chat_id the backend sends with each notification).
+import os, html, asyncio
+from typing import Any, Dict, Optional
+import aiohttp
+from aiogram import Router
 from aiogram.types import Message
 from aiogram.filters import Command
 
+BACKEND_URL = os.getenv("BACKEND_URL", "").rstrip("/")
+BACKEND_SECRET = os.getenv("BACKEND_SECRET") or os.getenv("WEBHOOK_SECRET", "foodySecret123")
+CHAT_MAP_REFRESH_S = float(os.getenv("CHAT_MAP_REFRESH_S", "600"))
+
 router = Router()
+chat_map: Dict[str, int] = {}  # restaurant_id -> chat_id
+_session: Optional[aiohttp.ClientSession] = None
+_refresh_task: Optional[asyncio.Task] = None
+
+def session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10),
+                                         headers={"x-foody-secret": BACKEND_SECRET})
+    return _session
+
+async def load_chat_map() -> int:
+    async with session().get(f"{BACKEND_URL}/api/v1/telegram/chats") as r:
+        r.raise_for_status()
+        fresh = await r.json()
+    chat_map.clear()
+    chat_map.update({rid: int(c) for rid, c in fresh.items()})
+    return len(chat_map)
+
+async def _refresh_loop():
+    while True:
+        try:
+            print("BOT chat map:", await load_chat_map(), "linked restaurants")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("BOT chat map WARN:", repr(e))
+        await asyncio.sleep(CHAT_MAP_REFRESH_S)
+
+def start() -> None:
+    global _refresh_task
+    if BACKEND_URL and _refresh_task is None:
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+async def stop() -> None:
+    global _refresh_task, _session
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        await asyncio.gather(_refresh_task, return_exceptions=True)
+        _refresh_task = None
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+def remember(data: Dict[str, Any]) -> Optional[int]:
+    """Chat for a notification {restaurant_id, chat_id?, unlinked?}; updates the map on the way.
+
+    A chat_id key sent by the backend is authoritative, null included (nothing linked: the
+    caller falls back to the admin chat); the map only answers when the key is absent."""
+    rid, chat_id = data.get("restaurant_id"), data.get("chat_id")
+    if rid and data.get("unlinked"):
+        chat_map.pop(rid, None)
+    elif rid and chat_id:
+        chat_map[rid] = int(chat_id)
+    elif rid and "chat_id" in data:
+        chat_map.pop(rid, None)
+    if "chat_id" in data:
+        return int(chat_id) if chat_id else None
+    return chat_map.get(rid or "")
 
 @router.message(Command("id"))
 async def cmd_id(msg: Message):
-    await msg.answer(f"Ваш chat_id: {msg.chat.id}")
+    await msg.answer(f"Ваш chat_id: <code>{msg.chat.id}</code>")
 
 @router.message(Command("link"))
 async def cmd_link(msg: Message):
-    # Expected: /link ABCDEF  (ABCDEF - one-time code displayed in restaurant LK)
-    parts = msg.text.strip().split()
+    # /link ABCD2345 — one-time code from the restaurant's cabinet
+    parts = (msg.text or "").strip().split()
     if len(parts) != 2:
-        return await msg.answer("Использование: /link <код>\nПолучите код в личном кабинете ресторана.")
-    code = parts[1].strip()
-    # TODO: verify the code with backend and bind chat_id to the restaurant:
-    # POST {backend}/api/v1/telegram/link  body: { code, chat_id }
-    # On success -> backend stores telegram_chat_id in restaurant row
-    # Example:
-    # async with session.post(f"{BACKEND_URL}/api/v1/telegram/link", json={"code": code, "chat_id": msg.chat.id}) as r:
-    #     if r.status == 200: await msg.answer("Чат успешно привязан ✅")
-    #     else: await msg.answer("Код не найден или просрочен ❌")
-    await msg.answer("(демо) Код принят. Привязка будет выполнена бекендом.")
+        return await msg.answer("Использование: /link &lt;код&gt;\nПолучите код в личном кабинете ресторана.")
+    if not BACKEND_URL:
+        return await msg.answer("Привязка недоступна: бот не подключён к бекенду.")
+    try:
+        async with session().post(f"{BACKEND_URL}/api/v1/telegram/link",
+                                  json={"code": parts[1], "chat_id": msg.chat.id}) as r:
+            body = await r.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("BOT link WARN:", repr(e))
+        return await msg.answer("Сервис временно недоступен, попробуйте позже.")
+    if r.status == 404:
+        return await msg.answer("Код не найден или просрочен ❌")
+    if r.status != 200:
+        return await msg.answer(f"Не удалось привязать чат (HTTP {r.status}).")
+    chat_map[body["restaurant_id"]] = msg.chat.id
+    await msg.answer(f"Чат привязан к ресторану «{html.escape(body.get('title') or body['restaurant_id'])}» ✅\n"
+                     "Сюда будут приходить уведомления о бронях.")